@@ -25,6 +25,8 @@ from fastapi.templating import Jinja2Templates
 
 from bot.config import settings, logger
 from bot.database import db
+from bot.broadcast import ensure_delivery
+from bot.leader import is_leader
 from bot.utils import get_user_lang, is_demo_expired, get_demo_config, get_user_tz, get_level_info, get_progress_bar
 from bot.localization import t
 
@@ -61,6 +63,12 @@ else:
 
 templates = Jinja2Templates(directory=str(templates_dir))
 
+# Колонки для таблицы пользователей в админке
+DASHBOARD_COLUMNS = (
+    "name", "username", "language", "is_paid", "demo_expiration",
+    "active", "timezone", "challenge_streak",
+)
+
 # --- JWT Константы ---
 JWT_ALGORITHM = "HS256"
 JWT_EXPIRY = timedelta(days=7)
@@ -242,12 +250,7 @@ async def profile_webapp(request: Request, user_id: int):
     demo_count = user_data.get("demo_count", 1)
     status_label = t('status_premium', lang) if is_paid else f"{t('status_demo', lang)} {demo_count}"
 
-    challenges = user_data.get("challenges", [])
-    if isinstance(challenges, str):
-        try: challenges = json.loads(challenges)
-        except: challenges = []
-
-    completed_challenges = len([c for c in challenges if isinstance(c, dict) and c.get("completed")])
+    challenge_counts = await db.get_challenge_counts(user_id)
     
     # ✅ ДОБАВЛЕНО: Полная система уровней на основе стрика
     streak = user_data.get("challenge_streak", 0)
@@ -278,8 +281,8 @@ async def profile_webapp(request: Request, user_id: int):
         "streak": streak,
         "is_max_level": level_info["is_max_level"],
         "days_to_next": level_info["days_to_next"],
-        "accepted": len(challenges),
-        "completed": completed_challenges,
+        "accepted": challenge_counts["accepted"],
+        "completed": challenge_counts["completed"],
         "likes": user_data.get("stats_likes", 0),
         "dislikes": user_data.get("stats_dislikes", 0),
         "days_left": days_val,
@@ -317,10 +320,12 @@ async def logout(response: Response):
 
 @router.get("/", response_class=HTMLResponse)
 async def users_dashboard(request: Request, auth = Depends(require_admin)):
-    all_users_data = await db.get_all_users()
     users_list = []
-    
-    for user_id_str, user_data in all_users_data.items():
+    total_users = 0
+
+    async for user_data in db.iter_users(columns=DASHBOARD_COLUMNS):
+        total_users += 1
+        user_id_str = str(user_data["user_id"])
         try:
             is_expired = await is_demo_expired(user_data)
             remaining_days = get_remaining_days(user_data)
@@ -349,7 +354,7 @@ async def users_dashboard(request: Request, auth = Depends(require_admin)):
     return templates.TemplateResponse("admin.html", {
         "request": request, 
         "users": users_list, 
-        "total_users": len(all_users_data), 
+        "total_users": total_users,
         "admin_secret": settings.ADMIN_SECRET
     })
 
@@ -359,7 +364,9 @@ async def admin_action(request: Request, user_id: str = Form(...), action: str =
     uid = int(user_id)
     if action == "delete_user": await db.delete_user(uid)
     elif action == "give_premium": await db.update_user(uid, is_paid=True, status="active_paid", active=True)
-    elif action == "reset_demo": await db.update_user(uid, is_paid=False, demo_count=1, active=True, status="active_demo", challenges=[], challenge_streak=0, last_level_checked="level_0")
+    elif action == "reset_demo":
+        await db.update_user(uid, is_paid=False, demo_count=1, active=True, status="active_demo", challenge_streak=0, last_level_checked="level_0")
+        await db.clear_challenge_history(uid)
     elif action == "toggle_ban":
         user_data = await db.get_user(uid)
         if user_data:
@@ -371,6 +378,52 @@ async def admin_action(request: Request, user_id: str = Form(...), action: str =
                 await db.update_user(uid, active=True)
     return RedirectResponse("/admin", status_code=303)
 
+@router.get("/plan")
+async def send_plan_preview(auth = Depends(require_admin)):
+    """Предпросмотр плана отправок: остаток сегодняшних UTC-суток и завтра (по типам и часам)."""
+    now = datetime.now(timezone.utc)
+    tomorrow = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    day_after = tomorrow + timedelta(days=1)
+    return {
+        "today": await db.get_plan_summary(now.isoformat(), tomorrow.isoformat()),
+        "tomorrow": await db.get_plan_summary(tomorrow.isoformat(), day_after.isoformat()),
+    }
+
+@router.get("/jobs")
+async def jobs_report(hours: int = 24, auth = Depends(require_admin)):
+    """Какая задача сколько времени заняла за последние hours часов, аренды и последние запуски."""
+    since = (datetime.now(timezone.utc) - timedelta(hours=max(1, hours))).isoformat()
+    return {
+        "summary": await db.get_job_run_stats(since),
+        "leases": await db.get_leases(),
+        "recent": await db.get_job_runs(50),
+    }
+
+@router.get("/dead_letters")
+async def dead_letters_list(limit: int = 100, replayed: bool = False, auth = Depends(require_admin)):
+    """Недоставленные после всех попыток сообщения: сводка по ошибкам и последние записи."""
+    return {
+        "open_by_error": await db.get_dead_letter_stats(),
+        "items": await db.get_dead_letters(min(max(1, limit), 1000), replayed),
+    }
+
+@router.post("/dead_letters/replay")
+async def dead_letters_replay(request: Request, secret_token: str = Form(...), ids: str = Form(""), auth = Depends(require_admin)):
+    """Повтор через outbox: ids через запятую или все непереотправленные, если пусто."""
+    if secret_token != settings.ADMIN_SECRET: raise HTTPException(status_code=403)
+    try:
+        id_list = [int(x) for x in ids.replace(" ", "").split(",") if x] or None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids: comma-separated integers")
+    run_id = f"replay_{datetime.now(timezone.utc).strftime('%Y%m%d%H%M%S')}"
+    queued = await db.replay_dead_letters(run_id, id_list)
+    bot = getattr(request.app.state, "bot", None)
+    # Доставляет лидер (иначе очередь подберёт его диспетчер в течение минуты)
+    if queued and bot is not None and is_leader():
+        ensure_delivery(bot)
+    logger.info(f"Admin: {queued} dead letters replayed as {run_id}.")
+    return {"status": "ok", "queued": queued, "run_id": run_id}
+
 @router.post("/set_timezone_auto")
 async def set_timezone_auto():
     return {"status": "ok", "message": "Endpoint fixed"}
@@ -381,11 +434,7 @@ async def reset_testers_action(request: Request, secret: str, auth = Depends(req
     target_ids = [290711961, 6112492697]
     for uid in target_ids:
         try:
-            await db.execute("DELETE FROM users WHERE user_id = ?", (uid,))
-            await db.execute("DELETE FROM fsm_storage WHERE user_id = ?", (uid,))
+            # FSM хранится в той же строке users; кэш Database сбрасывается внутри delete_user
+            await db.delete_user(uid)
         except Exception as e: logger.error(f"Error deleting tester {uid}: {e}")
-    await db.commit()
-    if hasattr(request.app.state, "users_db"):
-        for uid in target_ids:
-            request.app.state.users_db.pop(str(uid), None)
     return {"status": "success", "message": f"Users {target_ids} purged from DB and Cache."}
\ No newline at end of file
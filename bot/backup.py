@@ -0,0 +1,258 @@
+# 16 - bot/backup.py
+# ✅ Согласованные онлайн-бэкапы через SQLite backup API (учитывает WAL)
+# ✅ Полный снимок раз в N дней + ежедневные постраничные дельты к нему
+# ✅ Сжатие gzip, проверка восстановления после каждого бэкапа
+#
+# Восстановление (не требует .env и запущенного бота):
+#   python -m bot.backup restore data/backups/fotinia_full_2026-10-18_03-05.db.gz \
+#       --delta data/backups/fotinia_delta_2026-10-20_03-05.bin.gz --out fotinia.db
+#   python -m bot.backup verify fotinia.db
+# Дельта всегда строится от последнего полного снимка, поэтому для восстановления
+# нужен только полный снимок и одна (самая свежая) дельта после него.
+
+import argparse
+import gzip
+import hashlib
+import json
+import logging
+import shutil
+import sqlite3
+import struct
+import sys
+import tempfile
+from dataclasses import dataclass
+from datetime import datetime, timezone, timedelta
+from pathlib import Path
+from typing import IO, List, Optional
+
+logger = logging.getLogger(__name__)
+
+DELTA_MAGIC = b"FOTDELTA1\n"
+BASE_META = "base.json"      # Какой полный снимок сейчас базовый
+BASE_HASHES = "base.pages"   # Хэши его страниц (по 16 байт на страницу)
+HASH_SIZE = 16
+FULL_IF_CHANGED_RATIO = 0.5  # Если изменилось больше половины страниц — дешевле полный снимок
+
+@dataclass
+class BackupResult:
+    path: Path
+    kind: str  # "full" или "delta"
+    size: int
+    pages_total: int
+    pages_changed: int
+    verified: bool
+
+# ========== 🔧 СТРАНИЦЫ И ФАЙЛЫ ==========
+
+def _open(path: Path, mode: str) -> IO[bytes]:
+    """Открывает файл, прозрачно (раз)жимая .gz."""
+    if path.suffix == ".gz":
+        return gzip.open(path, mode, compresslevel=6) if "w" in mode else gzip.open(path, mode)
+    return open(path, mode)
+
+def _page_size(db_file: Path) -> int:
+    """Размер страницы из заголовка файла SQLite (1 означает 65536)."""
+    with open(db_file, "rb") as f:
+        header = f.read(100)
+    size = struct.unpack(">H", header[16:18])[0]
+    return 65536 if size == 1 else size
+
+def _page_hashes(db_file: Path, page_size: int) -> List[bytes]:
+    hashes = []
+    with open(db_file, "rb") as f:
+        while page := f.read(page_size):
+            hashes.append(hashlib.blake2b(page, digest_size=HASH_SIZE).digest())
+    return hashes
+
+def _file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def snapshot(db_file: Path, dest: Path):
+    """Согласованная копия живой базы (backup API видит и основной файл, и WAL)."""
+    src = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    dst = sqlite3.connect(dest)
+    try:
+        with dst:
+            src.backup(dst, pages=1024)
+    finally:
+        dst.close()
+        src.close()
+
+# ========== 📦 СОЗДАНИЕ БЭКАПА ==========
+
+def _load_base(backup_dir: Path) -> Optional[dict]:
+    meta_path, hashes_path = backup_dir / BASE_META, backup_dir / BASE_HASHES
+    if not meta_path.exists() or not hashes_path.exists():
+        return None
+    try:
+        meta = json.loads(meta_path.read_text(encoding="utf-8"))
+        raw = hashes_path.read_bytes()
+        meta["hashes"] = [raw[i:i + HASH_SIZE] for i in range(0, len(raw), HASH_SIZE)]
+        if not (backup_dir / meta["full"]).exists():
+            return None
+        return meta
+    except Exception as e:
+        logger.warning(f"Backup: base state is unreadable, next backup will be full: {e}")
+        return None
+
+def _save_base(backup_dir: Path, full_name: str, page_size: int, hashes: List[bytes], created: datetime):
+    (backup_dir / BASE_HASHES).write_bytes(b"".join(hashes))
+    (backup_dir / BASE_META).write_text(json.dumps({
+        "full": full_name,
+        "page_size": page_size,
+        "page_count": len(hashes),
+        "created": created.isoformat(),
+    }), encoding="utf-8")
+
+def _write_delta(path: Path, snap: Path, base: dict, page_size: int, changed: List[int], page_count: int):
+    header = json.dumps({
+        "base": base["full"],
+        "page_size": page_size,
+        "page_count": page_count,
+        "pages": len(changed),
+    }).encode("utf-8") + b"\n"
+    with open(snap, "rb") as src, _open(path, "wb") as out:
+        out.write(DELTA_MAGIC)
+        out.write(header)
+        for page_no in changed:
+            src.seek(page_no * page_size)
+            out.write(struct.pack(">I", page_no))
+            out.write(src.read(page_size))
+
+def make_backup(
+    db_file: Path,
+    backup_dir: Path,
+    full_every_days: int = 7,
+    compress: bool = True,
+    now: Optional[datetime] = None,
+) -> BackupResult:
+    """
+    Снимок базы + полный файл или дельта страниц к последнему полному снимку.
+    Блокирующая функция — в боте вызывается через asyncio.to_thread.
+    """
+    now = now or datetime.now(timezone.utc)
+    stamp = now.strftime("%Y-%m-%d_%H-%M")
+    gz = ".gz" if compress else ""
+    backup_dir.mkdir(parents=True, exist_ok=True)
+
+    snap = backup_dir / "snapshot.tmp.db"
+    snap.unlink(missing_ok=True)
+    try:
+        snapshot(db_file, snap)
+        page_size = _page_size(snap)
+        hashes = _page_hashes(snap, page_size)
+
+        base = _load_base(backup_dir)
+        changed: List[int] = []
+        need_full = (
+            base is None
+            or base["page_size"] != page_size
+            or now - datetime.fromisoformat(base["created"]) >= timedelta(days=full_every_days)
+        )
+        if not need_full:
+            old = base["hashes"]
+            changed = [i for i, h in enumerate(hashes) if i >= len(old) or old[i] != h]
+            need_full = len(changed) > len(hashes) * FULL_IF_CHANGED_RATIO
+
+        if need_full:
+            path = backup_dir / f"fotinia_full_{stamp}.db{gz}"
+            with open(snap, "rb") as src, _open(path, "wb") as out:
+                shutil.copyfileobj(src, out, 1 << 20)
+            _save_base(backup_dir, path.name, page_size, hashes, now)
+            result = BackupResult(path, "full", path.stat().st_size, len(hashes), len(hashes), False)
+            full_path, delta_path = path, None
+        else:
+            path = backup_dir / f"fotinia_delta_{stamp}.bin{gz}"
+            _write_delta(path, snap, base, page_size, changed, len(hashes))
+            result = BackupResult(path, "delta", path.stat().st_size, len(hashes), len(changed), False)
+            full_path, delta_path = backup_dir / base["full"], path
+
+        # Проверка: восстановленная база побайтно совпадает со снимком
+        with tempfile.TemporaryDirectory(dir=backup_dir) as tmp:
+            restored = Path(tmp) / "restored.db"
+            restore(full_path, delta_path, restored)
+            result.verified = _file_sha256(restored) == _file_sha256(snap) and verify(restored)["ok"]
+        if not result.verified:
+            logger.error(f"Backup: restore check FAILED for {path.name}")
+        return result
+    finally:
+        snap.unlink(missing_ok=True)
+
+def cleanup(backup_dir: Path, keep_days: int = 30, now: Optional[datetime] = None):
+    """Удаляет старые файлы, но никогда не трогает текущий базовый полный снимок."""
+    now = now or datetime.now(timezone.utc)
+    base = _load_base(backup_dir)
+    keep = base["full"] if base else None
+    limit = now - timedelta(days=keep_days)
+    for old in backup_dir.glob("fotinia_*"):
+        if old.name != keep and datetime.fromtimestamp(old.stat().st_mtime, tz=timezone.utc) < limit:
+            old.unlink()
+
+# ========== ♻️ ВОССТАНОВЛЕНИЕ ==========
+
+def restore(full_path: Path, delta_path: Optional[Path], out_path: Path):
+    """Собирает базу из полного снимка и (необязательно) дельты к нему."""
+    for suffix in ("-wal", "-shm"):
+        Path(f"{out_path}{suffix}").unlink(missing_ok=True)
+    with _open(full_path, "rb") as src, open(out_path, "wb") as out:
+        shutil.copyfileobj(src, out, 1 << 20)
+    if delta_path is None:
+        return
+
+    with _open(delta_path, "rb") as src:
+        if src.read(len(DELTA_MAGIC)) != DELTA_MAGIC:
+            raise ValueError(f"{delta_path} is not a backup delta")
+        header = json.loads(src.readline())
+        if header["base"] != full_path.name:
+            raise ValueError(f"Delta {delta_path.name} was made against {header['base']}, not {full_path.name}")
+        page_size = header["page_size"]
+        with open(out_path, "r+b") as out:
+            for _ in range(header["pages"]):
+                page_no = struct.unpack(">I", src.read(4))[0]
+                out.seek(page_no * page_size)
+                out.write(src.read(page_size))
+            out.truncate(header["page_count"] * page_size)
+
+def verify(db_file: Path) -> dict:
+    """integrity_check + число пользователей в восстановленной базе."""
+    conn = sqlite3.connect(f"file:{db_file}?mode=ro", uri=True)
+    try:
+        integrity = conn.execute("PRAGMA integrity_check").fetchone()[0]
+        users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+    finally:
+        conn.close()
+    return {"ok": integrity == "ok", "integrity": integrity, "users": users}
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m bot.backup", description="Восстановление бэкапов fotinia.db")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_restore = sub.add_parser("restore", help="Собрать базу из полного снимка и дельты")
+    p_restore.add_argument("full", type=Path)
+    p_restore.add_argument("--delta", type=Path, default=None)
+    p_restore.add_argument("--out", type=Path, required=True)
+
+    p_verify = sub.add_parser("verify", help="Проверить целостность базы")
+    p_verify.add_argument("db", type=Path)
+
+    args = parser.parse_args(argv)
+    if args.command == "restore":
+        if args.out.exists():
+            print(f"❌ {args.out} already exists, refusing to overwrite", file=sys.stderr)
+            return 1
+        restore(args.full, args.delta, args.out)
+        print(f"✅ Restored to {args.out}")
+        db_file = args.out
+    else:
+        db_file = args.db
+
+    report = verify(db_file)
+    print(f"{'✅' if report['ok'] else '❌'} integrity: {report['integrity']}, users: {report['users']}")
+    return 0 if report["ok"] else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,227 @@
+# 22 - bot/bench.py
+# ✅ Воспроизводимые замеры оптимизаций (вместо разовых скриптов)
+# ✅ zones — локальное время по поясам: на каждого юзера против ZoneClock, группировка поясов в SQLite
+# ✅ routing — текстовые кнопки через Dispatcher.feed_update: фильтр на кнопку против ButtonFilter
+#
+# Работает на временной базе, живая база и data/ не трогаются. Примеры:
+#   python -m bot.bench zones
+#   python -m bot.bench zones --users 100000 --rounds 3
+#   python -m bot.bench routing --buttons 15 40
+
+import argparse
+import asyncio
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from bot.config import settings
+from bot.database import db
+
+# Пояса, в которых живут реальные пользователи, плюс DST-пояса обоих полушарий и получасовые
+BENCH_ZONES = (
+    "Europe/Kiev", "Europe/Kyiv", "Europe/Moscow", "Europe/Warsaw", "Europe/Berlin", "Europe/London",
+    "Europe/Lisbon", "Europe/Madrid", "Europe/Rome", "Europe/Prague", "Europe/Vilnius", "Europe/Riga",
+    "Europe/Tallinn", "Europe/Helsinki", "Europe/Istanbul", "Europe/Minsk", "Europe/Chisinau",
+    "Asia/Tbilisi", "Asia/Yerevan", "Asia/Baku", "Asia/Almaty", "Asia/Tashkent", "Asia/Karachi",
+    "Asia/Kolkata", "Asia/Kathmandu", "Asia/Bangkok", "Asia/Shanghai", "Asia/Tokyo", "Asia/Dubai",
+    "Asia/Jerusalem", "America/New_York", "America/Chicago", "America/Denver", "America/Los_Angeles",
+    "America/Toronto", "America/Sao_Paulo", "Australia/Sydney", "Pacific/Auckland", "UTC",
+)
+
+def _best(rounds: int, func: Callable[[], Any]) -> float:
+    """Лучшее время из rounds прогонов, мс."""
+    best = float("inf")
+    for _ in range(rounds):
+        started = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - started)
+    return round(best * 1000, 1)
+
+async def _best_async(rounds: int, func: Callable[[], Awaitable[Any]]) -> float:
+    best = float("inf")
+    for _ in range(rounds):
+        started = time.perf_counter()
+        await func()
+        best = min(best, time.perf_counter() - started)
+    return round(best * 1000, 1)
+
+# ========== 🌍 ПОЯСА (user-013) ==========
+
+async def _fill_users(count: int, seed: int):
+    rng = random.Random(seed)
+    rows = [(uid, f"u{uid}", "ru", rng.choice(BENCH_ZONES), 1) for uid in range(1, count + 1)]
+    async with db.pool.writer() as conn:
+        await conn.executemany(
+            "INSERT INTO users (user_id, name, language, timezone, active) VALUES (?, ?, ?, ?, ?)", rows
+        )
+        await conn.commit()
+
+async def bench_zones(users: int = 100_000, rounds: int = 3, seed: int = 0) -> Dict[str, Any]:
+    """
+    Локальное время для users строк на один UTC-момент: zoneinfo + astimezone на каждого
+    против ZoneClock (раз на пояс); get_timezone_buckets и build_send_plan на той же базе.
+    """
+    from bot.scheduler import ZoneClock, _safe_get_user_tz, build_send_plan
+
+    report: Dict[str, Any] = {"users": users, "zones": len(BENCH_ZONES)}
+    with tempfile.TemporaryDirectory(prefix="fotinia_bench_") as tmp:
+        db.use_file(str(Path(tmp) / "bench.db"))
+        await db.init()
+        try:
+            await _fill_users(users, seed)
+            rows = [u async for u in db.iter_users(columns=("timezone",), where="active = 1")]
+            now = datetime(2026, 10, 19, 3, tzinfo=timezone.utc)
+
+            # Результаты не храним, как и планировщик: иначе живые datetime держат ZoneInfo
+            # в слабом кэше zoneinfo, а в сильном кэше только 8 поясов — замер был бы нечестным
+            def per_user():
+                return sum(now.astimezone(_safe_get_user_tz(r)).hour for r in rows)
+
+            def per_zone():
+                clock = ZoneClock(now)
+                return sum(clock.local(r.get("timezone", settings.DEFAULT_TZ_KEY)).hour for r in rows)
+
+            report["per_user_ms"] = _best(rounds, per_user)
+            report["zone_clock_ms"] = _best(rounds, per_zone)
+
+            # Совпадение каждые 30 минут через переход на зимнее время 2026-10-25
+            moment, mismatches = datetime(2026, 10, 24, tzinfo=timezone.utc), 0
+            while moment < datetime(2026, 10, 27, tzinfo=timezone.utc):
+                clock = ZoneClock(moment)
+                for tz_name in BENCH_ZONES:
+                    if clock.local(tz_name) != moment.astimezone(_safe_get_user_tz({"timezone": tz_name})):
+                        mismatches += 1
+                moment += timedelta(minutes=30)
+            report["dst_mismatches"] = mismatches
+
+            report["timezone_buckets_ms"] = await _best_async(rounds, db.get_timezone_buckets)
+            async with db.pool.reader() as conn:
+                async with conn.execute(
+                    "EXPLAIN QUERY PLAN SELECT timezone, COUNT(*) FROM users WHERE active = 1 GROUP BY timezone"
+                ) as cursor:
+                    report["timezone_buckets_plan"] = [r[-1] for r in await cursor.fetchall()]
+
+            started = time.perf_counter()
+            day = datetime(2026, 10, 19, tzinfo=timezone.utc)
+            report["send_plan_rows"] = await build_send_plan(day, day + timedelta(days=1))
+            report["send_plan_ms"] = round((time.perf_counter() - started) * 1000, 1)
+        finally:
+            await db.close()
+    return report
+
+# ========== 🔀 КНОПКИ (user-025) ==========
+
+def _routing_labels(count: int) -> Dict[str, List[str]]:
+    """count кнопок: настоящие btn_* из переводов, дальше синтетические надписи на трёх языках."""
+    from bot.buttons import button_labels
+    from bot.localization import translations
+
+    # btn_* с плейсхолдерами — тексты сообщений, а не надписи кнопок
+    keys = [key for key, text in translations["ru"].items() if key.startswith("btn_") and "{" not in text][:count]
+    labels = {key: button_labels(key) for key in keys}
+    for i in range(len(labels), count):
+        labels[f"bench_{i}"] = [f"🧪 Кнопка {i} ({lang})" for lang in ("ru", "ua", "en")]
+    return labels
+
+def _routing_dispatchers(labels: Dict[str, List[str]]):
+    """Старая схема (хэндлер с F.text.in_ на каждую кнопку) и новая (один ButtonFilter), обе с fallback."""
+    from aiogram import Dispatcher, F, Router
+    from bot.buttons import ButtonFilter, button
+
+    async def noop(message, **kwargs):
+        return None
+
+    old = Router()
+    for key, texts in labels.items():
+        old.message(F.text.in_(texts))(noop)
+
+    actions: Dict[str, Any] = {}
+    index: Dict[str, str] = {}
+    for key, texts in labels.items():
+        button(key, texts, actions=actions, index=index)(noop)
+    new = Router()
+
+    @new.message(ButtonFilter(index))
+    async def handle_text_button(message, button_action: str, **kwargs):
+        await actions[button_action](message, **kwargs)
+
+    dispatchers = {}
+    for name, router in (("old", old), ("new", new)):
+        unknown = Router()
+        unknown.message(F.text)(noop)
+        dp = Dispatcher()
+        dp.include_routers(router, unknown)
+        dispatchers[name] = dp
+    return dispatchers
+
+def _text_update(update_id: int, text: str):
+    from aiogram.types import Chat, Message, Update, User
+
+    return Update(update_id=update_id, message=Message(
+        message_id=update_id, date=datetime.now(timezone.utc), text=text,
+        chat=Chat(id=1, type="private"), from_user=User(id=1, is_bot=False, first_name="bench"),
+    ))
+
+async def bench_routing(buttons: List[int], updates: int = 2000, rounds: int = 3) -> Dict[str, Any]:
+    """
+    Время на апдейт (мкс) через Dispatcher.feed_update для первой, последней и неизвестной надписи.
+    Сеть не нужна: хэндлеры ничего не отправляют, токен фиктивный.
+    """
+    from aiogram import Bot
+
+    report: Dict[str, Any] = {"updates": updates}
+    bot = Bot("123:abc")
+    try:
+        for count in buttons:
+            labels = _routing_labels(count)
+            texts = {
+                "first": next(iter(labels.values()))[0],
+                "last": list(labels.values())[-1][-1],
+                "unknown": "просто текст",
+            }
+            for name, dp in _routing_dispatchers(labels).items():
+                for case, text in texts.items():
+                    batch = [_text_update(i, text) for i in range(updates)]
+
+                    async def feed():
+                        for update in batch:
+                            await dp.feed_update(bot, update)
+
+                    await feed()  # прогрев: резолв фильтров и magic-filter
+                    ms = await _best_async(rounds, feed)
+                    report[f"{name}_{count}_{case}_us"] = round(ms * 1000 / updates, 1)
+    finally:
+        await bot.session.close()
+    return report
+
+# ========== 🖥️ CLI ==========
+
+def _print(report: Dict[str, Any]):
+    for key, value in report.items():
+        print(f"⏱️ {key}: {value}")
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m bot.bench", description="Замеры оптимизаций бота")
+    sub = parser.add_subparsers(dest="bench", required=True)
+    zones = sub.add_parser("zones", help="Локальное время по поясам и план рассылок")
+    zones.add_argument("--users", type=int, default=100_000)
+    zones.add_argument("--rounds", type=int, default=3)
+    zones.add_argument("--seed", type=int, default=0)
+    routing = sub.add_parser("routing", help="Маршрутизация текстовых кнопок")
+    routing.add_argument("--buttons", type=int, nargs="+", default=[15, 40])
+    routing.add_argument("--updates", type=int, default=2000)
+    routing.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    if args.bench == "zones":
+        _print(asyncio.run(bench_zones(args.users, args.rounds, args.seed)))
+    elif args.bench == "routing":
+        _print(asyncio.run(bench_routing(args.buttons, args.updates, args.rounds)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
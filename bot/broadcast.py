@@ -0,0 +1,392 @@
+# 17 - bot/broadcast.py
+# ✅ Движок рассылок: N воркеров поверх send_with_error (safe_send + текст ошибки)
+# ✅ Глобальный token bucket (лимит Telegram ~30 сообщений/с на бота)
+# ✅ Лимит на чат (не чаще 1 сообщения в секунду в один чат)
+# ✅ Прогресс в логах и в health check (broadcast_progress)
+# ✅ Доставка из таблицы broadcast_outbox с продолжением после рестарта
+# ✅ Flood control и сбои сети: сообщение откладывается в кучу повторов, остальные чаты не ждут
+# ✅ Исчерпавшие попытки сообщения → таблица dead_letters (просмотр и повтор из админки)
+
+import asyncio
+import heapq
+import inspect
+import itertools
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterable, Callable, Dict, Iterable, List, Optional, Tuple, Union
+
+from aiogram import Bot
+from aiogram.types import InlineKeyboardMarkup
+
+from bot.config import logger, settings
+from bot.database import db
+from bot.utils import TRANSIENT_ERRORS, is_block_error, retry_delay, send_once
+
+# ========== 🚦 ЛИМИТЕРЫ ==========
+
+class TokenBucket:
+    """Глобальный лимит скорости: rate токенов в секунду, всплеск не больше capacity."""
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        # Под замком: ожидающие обслуживаются по очереди, а не наперегонки
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+class PerChatLimiter:
+    """Не чаще одного сообщения в interval секунд в один чат."""
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._next: Dict[int, float] = {}
+
+    async def acquire(self, chat_id: int):
+        now = time.monotonic()
+        at = max(now, self._next.get(chat_id, 0.0))
+        self._next[chat_id] = at + self.interval
+        if at > now:
+            await asyncio.sleep(at - now)
+
+    def defer(self, chat_id: int, seconds: float):
+        """Telegram попросил подождать: следующий слот чата не раньше чем через seconds."""
+        self._next[chat_id] = max(self._next.get(chat_id, 0.0), time.monotonic() + seconds)
+
+    def prune(self):
+        """Забывает чаты, для которых ограничение уже истекло."""
+        now = time.monotonic()
+        self._next = {k: v for k, v in self._next.items() if v > now}
+
+# Общие на процесс: параллельные рассылки делят один лимит Telegram
+global_limiter = TokenBucket(settings.BROADCAST_RATE)
+chat_limiter = PerChatLimiter(settings.BROADCAST_PER_CHAT_INTERVAL)
+
+async def _wait_any(*events: asyncio.Event, timeout: Optional[float] = None):
+    """Ждёт первое из событий (или таймаут)."""
+    waiters = [asyncio.ensure_future(e.wait()) for e in events]
+    try:
+        await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for w in waiters:
+            w.cancel()
+
+# ========== 📨 СООБЩЕНИЯ И ОТЧЁТ ==========
+
+@dataclass
+class Outgoing:
+    chat_id: int
+    text: str
+    kwargs: Dict[str, Any] = field(default_factory=dict)  # reply_markup и т.п. для safe_send
+    meta: Any = None  # Произвольные данные для on_result
+    attempts: int = 0  # Сделанные попытки отправки (для лимита повторов)
+
+@dataclass
+class BroadcastReport:
+    name: str
+    queued: int = 0
+    sent: int = 0
+    failed: int = 0
+    retried: int = 0  # Отложено на повтор (Flood control, сеть)
+    dead: int = 0  # Записано в dead_letters
+    started: float = field(default_factory=time.monotonic)
+    finished: Optional[float] = None
+
+    @property
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    def as_dict(self) -> Dict[str, Any]:
+        elapsed = self.elapsed
+        done = self.sent + self.failed
+        return {
+            "name": self.name,
+            "queued": self.queued,
+            "sent": self.sent,
+            "failed": self.failed,
+            "retried": self.retried,
+            "dead": self.dead,
+            "running": self.finished is None,
+            "elapsed_s": round(elapsed, 1),
+            "rate_per_s": round(done / elapsed, 2) if elapsed > 0 else 0.0,
+        }
+
+# Последний отчёт по каждому имени рассылки (для health check)
+_reports: Dict[str, BroadcastReport] = {}
+
+def broadcast_progress() -> Dict[str, Any]:
+    return {name: report.as_dict() for name, report in _reports.items()}
+
+# ========== 🚀 ДВИЖОК ==========
+
+OnResult = Callable[[Outgoing, bool, Optional[str]], Any]  # (сообщение, доставлено, ошибка)
+
+class BroadcastEngine:
+    """
+    Ограниченная по конкуренции отправка: производитель кладёт Outgoing в очередь,
+    воркеры ждут оба лимитера и отправляют через send_once.
+    Временная ошибка не держит воркер: сообщение уходит в кучу повторов со сроком,
+    после SEND_MAX_ATTEMPTS попыток — в dead_letters.
+    """
+    def __init__(
+        self,
+        bot: Bot,
+        workers: Optional[int] = None,
+        limiter: Optional[TokenBucket] = None,
+        per_chat: Optional[PerChatLimiter] = None,
+        progress_every: Optional[float] = None,
+        max_attempts: Optional[int] = None,
+        dead_letters: bool = True,
+    ):
+        self.bot = bot
+        self.workers = max(1, workers or settings.BROADCAST_WORKERS)
+        self.limiter = limiter or global_limiter
+        self.per_chat = per_chat or chat_limiter
+        self.progress_every = progress_every if progress_every is not None else settings.BROADCAST_PROGRESS_SECONDS
+        self.max_attempts = max(1, max_attempts or settings.SEND_MAX_ATTEMPTS)
+        self.dead_letters = dead_letters
+
+    async def run(
+        self,
+        items: Union[Iterable[Outgoing], AsyncIterable[Outgoing]],
+        name: str = "broadcast",
+        on_result: Optional[OnResult] = None,
+    ) -> BroadcastReport:
+        report = BroadcastReport(name)
+        _reports[name] = report
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.workers * 4)
+        last_log = [time.monotonic()]
+        # Куча повторов: (срок по monotonic, порядковый номер, сообщение)
+        retries: List[Tuple[float, int, Outgoing]] = []
+        seq = itertools.count()
+        wakeup = asyncio.Event()
+        finished = asyncio.Event()  # Всё произведено и ни одного сообщения в работе или в куче
+        produced = [False]
+        open_items = [0]
+
+        def settle():
+            open_items[0] -= 1
+            if produced[0] and open_items[0] == 0:
+                finished.set()
+
+        async def produce():
+            try:
+                if hasattr(items, "__aiter__"):
+                    async for item in items:
+                        open_items[0] += 1
+                        await queue.put(item)
+                        report.queued += 1
+                else:
+                    for item in items:
+                        open_items[0] += 1
+                        await queue.put(item)
+                        report.queued += 1
+            except BaseException:
+                # При сбое производителя отложенные повторы не ждём (строки outbox вернёт recover_outbox)
+                finished.set()
+                raise
+            finally:
+                produced[0] = True
+                if open_items[0] == 0:
+                    finished.set()
+
+        async def schedule_retries():
+            while not finished.is_set():
+                if not retries:
+                    wakeup.clear()
+                    await _wait_any(wakeup, finished)
+                    continue
+                delay = retries[0][0] - time.monotonic()
+                if delay > 0:
+                    wakeup.clear()
+                    await _wait_any(wakeup, finished, timeout=delay)
+                    continue
+                await queue.put(heapq.heappop(retries)[2])
+
+        async def stop_workers():
+            await finished.wait()
+            for _ in range(self.workers):
+                await queue.put(None)
+
+        async def finish(item: Outgoing, ok: bool, error: Optional[str]):
+            if ok:
+                report.sent += 1
+            else:
+                report.failed += 1
+                if self.dead_letters and not is_block_error(error):
+                    await self._dead_letter(name, item, error)
+                    report.dead += 1
+            if on_result is not None:
+                try:
+                    res = on_result(item, ok, error)
+                    if inspect.isawaitable(res):
+                        await res
+                except Exception as e:
+                    logger.error(f"Broadcast {name}: on_result failed for {item.chat_id}: {e}")
+            settle()
+
+        async def work():
+            while (item := await queue.get()) is not None:
+                ok, error = False, None
+                try:
+                    await self.per_chat.acquire(item.chat_id)
+                    await self.limiter.acquire()
+                    item.attempts += 1
+                    message, error = await send_once(self.bot, item.chat_id, item.text, **item.kwargs)
+                    ok = message is not None
+                except TRANSIENT_ERRORS as e:
+                    error = str(e)
+                    delay = retry_delay(e, item.attempts)
+                    if item.attempts < self.max_attempts and delay <= settings.BROADCAST_RETRY_MAX_WAIT:
+                        # Воркер свободен сразу, в этот чат до срока ничего не уйдёт
+                        self.per_chat.defer(item.chat_id, delay)
+                        heapq.heappush(retries, (time.monotonic() + delay, next(seq), item))
+                        wakeup.set()
+                        report.retried += 1
+                        continue
+                    logger.error(f"Broadcast {name}: giving up on {item.chat_id} after {item.attempts} attempts: {e}")
+                except Exception as e:
+                    error = str(e)
+                    logger.error(f"Broadcast {name}: error for {item.chat_id}: {e}")
+                await finish(item, ok, error)
+                if self.progress_every and time.monotonic() - last_log[0] >= self.progress_every:
+                    last_log[0] = time.monotonic()
+                    self._log(report)
+
+        try:
+            # return_exceptions: сбой производителя не должен оставить воркеров без присмотра
+            results = await asyncio.gather(
+                produce(), schedule_retries(), stop_workers(), *(work() for _ in range(self.workers)),
+                return_exceptions=True,
+            )
+        finally:
+            report.finished = time.monotonic()
+            self.per_chat.prune()
+        errors = [r for r in results if isinstance(r, BaseException)]
+        if errors:
+            raise errors[0]
+        if report.queued:
+            self._log(report)
+        return report
+
+    @staticmethod
+    async def _dead_letter(name: str, item: Outgoing, error: Optional[str]):
+        try:
+            await db.add_dead_letters(name, [{**outbox_row(item), "error": error, "attempts": item.attempts}])
+        except Exception as e:
+            logger.error(f"Broadcast {name}: could not store dead letter for {item.chat_id}: {e}")
+
+    @staticmethod
+    def _log(report: BroadcastReport):
+        p = report.as_dict()
+        logger.info(
+            f"📊 Broadcast {p['name']}: {p['sent']} sent, {p['failed']} failed ({p['dead']} dead), "
+            f"{p['retried']} retries of {p['queued']} queued, "
+            f"{p['rate_per_s']} msg/s, {p['elapsed_s']} s"
+        )
+
+# ========== 📮 OUTBOX: ОЧЕРЕДЬ В БАЗЕ ==========
+# Планирование пишет строки в broadcast_outbox (быстрый SQL), доставка забирает их пачками.
+# После падения машины незавершённые строки досылаются при старте (resume_outbox).
+
+def outbox_row(item: Outgoing) -> Dict[str, Any]:
+    """Outgoing → строка для db.enqueue_outbox (клавиатура сериализуется в JSON)."""
+    markup = item.kwargs.get("reply_markup")
+    return {
+        "user_id": item.chat_id,
+        "text": item.text,
+        "reply_markup": markup.model_dump_json(exclude_none=True) if markup is not None else None,
+    }
+
+def _outgoing_from_row(row: Dict[str, Any]) -> Outgoing:
+    kwargs: Dict[str, Any] = {}
+    if row.get("reply_markup"):
+        try:
+            kwargs["reply_markup"] = InlineKeyboardMarkup.model_validate_json(row["reply_markup"])
+        except Exception as e:
+            logger.error(f"Outbox: bad reply_markup in row {row['id']}, sending without it: {e}")
+    return Outgoing(row["user_id"], row["text"], kwargs, meta=row["id"])
+
+async def deliver_outbox(
+    bot: Bot, run_id: Optional[str] = None, name: str = "outbox", engine: Optional[BroadcastEngine] = None
+) -> BroadcastReport:
+    """
+    Доставляет ожидающие строки очереди (только run_id или все). Строки забираются пачками,
+    результат (sent/failed + ошибка Telegram) пишется пачками и обязательно в finally.
+    """
+    engine = engine or BroadcastEngine(bot)
+    batch = engine.workers * 4
+    done: List[Tuple[int, bool, Optional[str]]] = []
+
+    async def rows():
+        while True:
+            claimed, touched = await db.claim_outbox(batch, run_id)
+            if not touched:
+                return
+            # Пачка целиком из неактивных (всё skipped) — берём следующую, а не заканчиваем
+            for row in claimed:
+                yield _outgoing_from_row(row)
+
+    async def on_result(item: Outgoing, ok: bool, error: Optional[str]):
+        done.append((item.meta, ok, error))
+        if len(done) >= batch:
+            chunk = done[:]
+            done.clear()
+            await db.finish_outbox(chunk)
+
+    try:
+        return await engine.run(rows(), name=name, on_result=on_result)
+    finally:
+        if done:
+            await db.finish_outbox(done)
+
+# Фоновая доставка: одна задача на процесс, перезапускается диспетчером плана при необходимости
+_delivery_task: Optional[asyncio.Task] = None
+
+async def _deliver_in_background(bot: Bot):
+    try:
+        await deliver_outbox(bot, name="outbox")
+    except Exception as e:
+        # Фоновая задача: без лога ошибка потерялась бы до остановки бота
+        logger.error(f"Outbox: delivery failed: {e}")
+
+def ensure_delivery(bot: Bot) -> asyncio.Task:
+    """Запускает доставку очереди, если она ещё не идёт (идущая сама подберёт новые строки)."""
+    global _delivery_task
+    if _delivery_task is None or _delivery_task.done():
+        _delivery_task = asyncio.create_task(_deliver_in_background(bot))
+    return _delivery_task
+
+async def stop_delivery():
+    """Остановка: недоставленные строки останутся в outbox и уйдут после следующего старта."""
+    global _delivery_task
+    if _delivery_task is not None:
+        _delivery_task.cancel()
+        await asyncio.gather(_delivery_task, return_exceptions=True)
+        _delivery_task = None
+
+async def wait_delivery():
+    """Дожидается конца текущей фоновой доставки (симуляция, bot/simulate.py)."""
+    if _delivery_task is not None:
+        await asyncio.gather(_delivery_task, return_exceptions=True)
+
+async def resume_outbox(bot: Bot) -> Dict[str, int]:
+    """При старте (до любой доставки): возвращает в очередь прерванные строки и запускает досылку."""
+    expire_before = (datetime.now(timezone.utc) - timedelta(hours=settings.OUTBOX_MAX_AGE_HOURS)).isoformat()
+    recovered = await db.recover_outbox(expire_before)
+    if recovered["requeued"] or recovered["expired"]:
+        logger.warning(
+            f"Outbox: {recovered['requeued']} interrupted rows requeued, {recovered['expired']} expired."
+        )
+    ensure_delivery(bot)
+    return recovered
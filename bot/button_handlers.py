@@ -4,6 +4,7 @@
 # ✅ Админские кнопки (Статистика, Обновить, Тест рассылки)
 # ✅ Fallback для неизвестных команд
 # ✅ Защита от дублей вызовов
+# ✅ Текстовые кнопки: один обработчик и словарь "надпись → действие" вместо фильтра на каждую (bot/buttons.py)
 
 # 11 - bot/button_handlers.py - ФИНАЛЬНАЯ ВЕРСИЯ (30.01.2026)
 # Обработчики текстовых кнопок
@@ -18,7 +19,7 @@ from aiogram.fsm.context import FSMContext
 from bot.config import logger, settings
 from bot.localization import t, Lang
 from bot.database import db
-from bot.keyboards import get_settings_keyboard, get_reply_keyboard_for_user
+from bot.keyboards import get_settings_keyboard, get_reply_keyboard_for_user, KEYBOARD_FIELDS
 from bot.content_handlers import (
     send_from_list, send_rules, send_profile,
     send_payment_instructions, activate_new_demo
@@ -27,38 +28,18 @@ from bot.challenges import send_new_challenge_message, accept_challenge, complet
 from bot.utils import get_user_tz
 from bot.commands import send_stats_report, show_users_command, broadcast_test_command
 from bot.scheduler import setup_jobs_and_cache
-from bot.user_loader import load_static_data
+from bot.leader import is_leader
+from bot.buttons import BUTTON_ACTIONS, ButtonFilter, button
+from bot.user_loader import refresh_static_data
 
 router = Router()
 router_unknown = Router()
 
-def btn_filter(key: str):
-    """Создает фильтр для кнопки на всех языках (RU/UA/EN)."""
-    return F.text.in_([t(key, lang) for lang in ['ru', 'ua', 'en']])
-
-async def _get_user_data(user_id: int, kwargs: dict, force_db: bool = False) -> dict:
-    """Получение данных пользователя с опцией синхронизации."""
-    try:
-        if force_db:
-            u = await db.get_user(user_id)
-            if u and "users_db" in kwargs:
-                kwargs["users_db"][str(user_id)] = u
-            logger.debug(f"Handlers: force_db=True → fetched fresh data for {user_id}")
-            return u or {}
-        
-        ud = kwargs.get("user_data")
-        if ud and isinstance(ud, dict) and ud.get("user_id") == user_id:
-            return ud
-            
-        users_db = kwargs.get("users_db")
-        if users_db and isinstance(users_db, dict):
-            cached = users_db.get(str(user_id))
-            if cached: return cached
-            
-        return await db.get_user(user_id) or {}
-    except Exception as e:
-        logger.error(f"Handlers: Error getting user data for {user_id}: {e}")
-        return {}
+# Колонки users, которые реально читают обработчики: get_user_fields вместо полной строки
+NAME_FIELDS = ("name", "language")
+MENU_FIELDS = ("language", *KEYBOARD_FIELDS)
+RULES_FIELDS = ("language", "timezone", "last_rules_date", "rules_shown_count", "rules_indices_today")
+CHALLENGE_FIELDS = ("name", "language", "timezone")
 
 # --- 🖱️ CALLBACKS (Inline) ---
 
@@ -68,7 +49,7 @@ async def handle_lang_callback(callback: CallbackQuery, **kwargs):
     new_lang = callback.data.replace("set_lang_", "")
     await db.update_user(user_id, language=new_lang, active=True)
     
-    user_data = await _get_user_data(user_id, kwargs, force_db=True)
+    user_data = await db.get_user_fields(user_id, KEYBOARD_FIELDS) or {}
     
     await callback.answer()
     await callback.message.answer(
@@ -80,94 +61,106 @@ async def handle_lang_callback(callback: CallbackQuery, **kwargs):
 
 @router.callback_query(F.data.startswith("accept_challenge"))
 async def handle_accept_challenge_callback(callback: CallbackQuery, state: FSMContext, **kwargs):
-    user_data = await _get_user_data(callback.from_user.id, kwargs, force_db=True)
+    user_data = await db.get_user_fields(callback.from_user.id, CHALLENGE_FIELDS) or {}
     await accept_challenge(callback, kwargs.get("static_data", {}), user_data, kwargs.get("lang", "ru"), state)
 
 @router.callback_query(F.data == "new_challenge")
 async def handle_new_challenge_callback_inline(callback: CallbackQuery, state: FSMContext, **kwargs):
-    user_data = await _get_user_data(callback.from_user.id, kwargs, force_db=True)
+    user_data = await db.get_user_fields(callback.from_user.id, CHALLENGE_FIELDS) or {}
     await send_new_challenge_message(callback, kwargs.get("static_data", {}), user_data, kwargs.get("lang", "ru"), state, is_edit=True)
 
 @router.callback_query(F.data.startswith("complete_challenge"))
 async def handle_complete_challenge_callback(callback: CallbackQuery, state: FSMContext, **kwargs):
-    user_data = await _get_user_data(callback.from_user.id, kwargs, force_db=True)
+    user_data = await db.get_user_fields(callback.from_user.id, CHALLENGE_FIELDS) or {}
     await complete_challenge(callback, user_data, kwargs.get("lang", "ru"), state)
 
 # --- ⌨️ MESSAGES (Text Buttons) ---
 
-@router.message(btn_filter('btn_motivate'))
+# Кнопки выбора языка в настройках (см. get_settings_keyboard)
+LANG_SWITCH_LABELS = ("🇺🇦 Українська", "🇬🇧 English", "🇷🇺 Русский")
+
+@router.message(ButtonFilter())
+async def handle_text_button(message: Message, button_action: str, **kwargs):
+    """Единственный хэндлер текстовых кнопок: поиск обработчика за O(1)."""
+    await BUTTON_ACTIONS[button_action](message, **kwargs)
+
+@button('btn_motivate')
 async def handle_motivate_button(message: Message, **kwargs):
-    user_data = await _get_user_data(message.from_user.id, kwargs)
+    user_data = await db.get_user_fields(message.from_user.id, NAME_FIELDS) or {}
     await send_from_list(message, kwargs.get("static_data", {}), user_data, user_data.get("language", "ru"), "motivations", "title_motivation")
 
-@router.message(btn_filter('btn_settings'))
+@button('btn_settings')
 async def handle_settings_button(message: Message, **kwargs):
     lang = kwargs.get("lang", "ru")
     await message.answer(t('msg_choose_action', lang), reply_markup=get_settings_keyboard(lang))
 
-@router.message(F.text.in_(["🇺🇦 Українська", "🇬🇧 English", "🇷🇺 Русский"]))
+@button('lang_switch', labels=LANG_SWITCH_LABELS)
 async def handle_lang_switch_buttons(message: Message, **kwargs):
     new_lang = "ua" if "Українська" in message.text else ("en" if "English" in message.text else "ru")
     await db.update_user(message.from_user.id, language=new_lang)
-    user_data = await _get_user_data(message.from_user.id, kwargs, force_db=True)
+    user_data = await db.get_user_fields(message.from_user.id, KEYBOARD_FIELDS) or {}
     await message.answer(t('lang_chosen', new_lang), reply_markup=get_reply_keyboard_for_user(message.from_user.id, new_lang, user_data))
 
-@router.message(btn_filter('btn_back'))
+@button('btn_back')
 async def handle_back_button(message: Message, **kwargs):
-    user_data = await _get_user_data(message.from_user.id, kwargs)
+    user_data = await db.get_user_fields(message.from_user.id, MENU_FIELDS) or {}
     lang = user_data.get("language", "ru")
     await message.answer(t('msg_welcome_back', lang), reply_markup=get_reply_keyboard_for_user(message.from_user.id, lang, user_data))
 
-@router.message(btn_filter('btn_rules'))
+@button('btn_rules')
 async def handle_rules_button(message: Message, **kwargs):
-    user_data = await _get_user_data(message.from_user.id, kwargs)
+    user_data = await db.get_user_fields(message.from_user.id, RULES_FIELDS) or {}
     await send_rules(message, kwargs.get("static_data", {}), user_data, user_data.get("language", "ru"))
 
-@router.message(btn_filter('btn_rhythm'))
+@button('btn_rhythm')
 async def handle_rhythm_button(message: Message, **kwargs):
-    user_data = await _get_user_data(message.from_user.id, kwargs)
+    user_data = await db.get_user_fields(message.from_user.id, NAME_FIELDS) or {}
     await send_from_list(message, kwargs.get("static_data", {}), user_data, user_data.get("language", "ru"), "ritm", "title_rhythm")
 
-@router.message(btn_filter('btn_challenge'))
+@button('btn_challenge')
 async def handle_challenge_button(message: Message, state: FSMContext, **kwargs):
-    user_data = await _get_user_data(message.from_user.id, kwargs, force_db=True)
+    user_data = await db.get_user_fields(message.from_user.id, CHALLENGE_FIELDS) or {}
     await send_new_challenge_message(message, kwargs.get("static_data", {}), user_data, user_data.get("language", "ru"), state, is_edit=False)
 
-@router.message(btn_filter('btn_profile'))
+@button('btn_profile')
 async def handle_profile_button(message: Message, **kwargs):
-    user_data = await _get_user_data(message.from_user.id, kwargs, force_db=True)
+    # Свежие поля профиля send_profile читает сам
+    user_data = await db.get_user_fields(message.from_user.id, NAME_FIELDS) or {}
     await send_profile(message, user_data, user_data.get("language", "ru"))
 
-@router.message(btn_filter('btn_stats'))
+@button('btn_stats')
 async def handle_stats_button(message: Message, **kwargs):
     if not (int(message.from_user.id) == int(settings.ADMIN_CHAT_ID) or kwargs.get("is_admin")): return
-    await send_stats_report(message, kwargs.get("users_db", {}), kwargs.get("lang", "ru"))
+    await send_stats_report(message, kwargs.get("lang", "ru"))
 
-@router.message(btn_filter('btn_pay_premium'))
+@button('btn_pay_premium')
 async def handle_pay_button(message: Message, **kwargs):
-    user_data = await _get_user_data(message.from_user.id, kwargs, force_db=True)
+    user_data = await db.get_user_fields(message.from_user.id, NAME_FIELDS) or {}
     await send_payment_instructions(message, user_data, user_data.get("language", "ru"))
 
-@router.message(btn_filter('btn_want_demo'))
+@button('btn_want_demo')
 async def handle_want_demo_button(message: Message, **kwargs):
-    user_data = await _get_user_data(message.from_user.id, kwargs, force_db=True)
+    user_data = await db.get_user_fields(message.from_user.id, NAME_FIELDS) or {}
     await activate_new_demo(message, user_data, user_data.get("language", "ru"))
 
-@router.message(btn_filter('btn_reload_data'))
+@button('btn_reload_data')
 async def handle_reload_data(message: Message, bot: Bot, **kwargs):
     if not (int(message.from_user.id) == int(settings.ADMIN_CHAT_ID) or kwargs.get("is_admin")): return
-    new_static = await load_static_data()
-    if "static_data" in kwargs: kwargs["static_data"].update(new_static)
-    if "users_db" in kwargs: kwargs["users_db"].update(await db.get_all_users())
-    await setup_jobs_and_cache(bot, kwargs.get("users_db", {}), new_static)
+    # Тот же объект, что у middleware: планировщик не должен получить отдельную копию
+    static_data = kwargs.get("static_data")
+    if static_data is None:
+        return
+    await refresh_static_data(static_data)
+    if is_leader():
+        await setup_jobs_and_cache(bot, static_data)
     await message.answer(t('reload_confirm', kwargs.get("lang", "ru")))
 
-@router.message(btn_filter('btn_show_users'))
+@button('btn_show_users')
 async def handle_show_users_button(message: Message, **kwargs):
     if not (int(message.from_user.id) == int(settings.ADMIN_CHAT_ID) or kwargs.get("is_admin")): return
-    await show_users_command(message, kwargs.get("users_db", {}), True)
+    await show_users_command(message, True)
 
-@router.message(btn_filter('btn_test_broadcast'))
+@button('btn_test_broadcast')
 async def handle_test_broadcast_button(message: Message, bot: Bot, **kwargs):
     if not (int(message.from_user.id) == int(settings.ADMIN_CHAT_ID) or kwargs.get("is_admin")): return
     await broadcast_test_command(message, bot, kwargs.get("static_data", {}), True)
@@ -176,6 +169,6 @@ async def handle_test_broadcast_button(message: Message, bot: Bot, **kwargs):
 
 @router_unknown.message(F.text)
 async def handle_unknown_text(message: Message, **kwargs):
-    user_data = await _get_user_data(message.from_user.id, kwargs)
+    user_data = await db.get_user_fields(message.from_user.id, MENU_FIELDS) or {}
     lang = user_data.get("language", "ru")
-    await message.answer(t('unknown_command', lang), reply_markup=get_reply_keyboard_for_user(message.from_user.id, lang, user_data)
\ No newline at end of file
+    await message.answer(t('unknown_command', lang), reply_markup=get_reply_keyboard_for_user(message.from_user.id, lang, user_data))
@@ -0,0 +1,49 @@
+# 23 - bot/buttons.py
+# ✅ Диспетчер текстовых кнопок: надпись на любом языке → id действия (ключ перевода) → обработчик
+# ✅ Один фильтр со словарём вместо фильтра F.text.in_(...) на каждую кнопку
+# ✅ Без хэндлеров и базы — импортируется отдельно (обработчики в button_handlers, замер в bench)
+
+from typing import Any, Awaitable, Callable, Dict, Iterable, Mapping, Optional
+from aiogram.filters import Filter
+from aiogram.types import Message
+
+from bot.localization import t
+
+# Раньше каждая кнопка была отдельным хэндлером с F.text.in_(...), и aiogram проверял их
+# по очереди на каждое сообщение. Теперь один хэндлер и два словаря:
+# надпись на любом языке → id действия (ключ перевода) → обработчик.
+
+ButtonHandler = Callable[..., Awaitable[Any]]
+BUTTON_ACTIONS: Dict[str, ButtonHandler] = {}
+BUTTON_INDEX: Dict[str, str] = {}
+
+def button_labels(key: str) -> list:
+    """Надписи кнопки на всех языках (RU/UA/EN), как на клавиатурах."""
+    return [t(key, lang) for lang in ['ru', 'ua', 'en']]
+
+def button(
+    key: str,
+    labels: Optional[Iterable[str]] = None,
+    actions: Dict[str, ButtonHandler] = BUTTON_ACTIONS,
+    index: Dict[str, str] = BUTTON_INDEX,
+):
+    """
+    Регистрирует обработчик текстовой кнопки. labels — свои надписи (по умолчанию перевод key).
+    Совпадение надписей: побеждает зарегистрированный раньше, как при порядке хэндлеров.
+    actions/index — свои словари (для замеров), по умолчанию общие.
+    """
+    def wrap(func: ButtonHandler) -> ButtonHandler:
+        actions[key] = func
+        for label in (labels if labels is not None else button_labels(key)):
+            index.setdefault(label, key)
+        return func
+    return wrap
+
+class ButtonFilter(Filter):
+    """Пропускает только известные надписи и передаёт хэндлеру id действия (button_action)."""
+    def __init__(self, index: Optional[Mapping[str, str]] = None):
+        self.index = BUTTON_INDEX if index is None else index
+
+    async def __call__(self, message: Message) -> bool | Dict[str, Any]:
+        action = self.index.get(message.text) if message.text else None
+        return {"button_action": action} if action is not None else False
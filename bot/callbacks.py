@@ -46,15 +46,9 @@ async def handle_lang_select(query: CallbackQuery, bot: Bot, static_data: dict,
     
     logger.info(f"User {chat_id} selected language {lang} (new: {is_new_user})")
     
-    # Обновляем язык в БД
+    # Обновляем язык в БД и в уже загруженном user_data (перечитывать строку не нужно)
     await db.update_user(chat_id, language=lang, name=name)
-    
-    # Получаем свежие данные
-    fresh_data = await db.get_user(chat_id)
-    if fresh_data:
-        user_data.update(fresh_data)
-        if "users_db" in kwargs:
-            kwargs["users_db"][str(chat_id)] = fresh_data
+    user_data.update(language=lang, name=name)
     
     # 1. Убираем inline-кнопки выбора языка
     try:
@@ -13,10 +13,8 @@
 # 09 - bot/challenges.py - ФИНАЛЬНАЯ ВЕРСИЯ (27.02.2026)
 # Логика челленджей и системы уровней
 # ✅ ПРОВЕРЕНО: Стрики, напоминания, расчёт уровней, Level Up сообщения
-# ✅ ДОБАВЛЕНО: check_challenges_reminder для scheduler.py
+# ✅ ДОБАВЛЕНО: challenge_day_reminder_text / send_challenge_hour_reminder для scheduler.py
 
-import random
-import json
 import logging
 from datetime import datetime, date, timedelta
 from typing import Dict, Any, Optional, Tuple
@@ -30,7 +28,8 @@ from aiogram.utils.keyboard import InlineKeyboardBuilder
 from bot.config import logger
 from bot.localization import t, Lang
 from bot.database import db
-from bot.utils import safe_send, get_user_tz
+from bot.content import get_category
+from bot.utils import safe_send, get_user_tz, get_user_lang
 
 # --- 🏆 КОНСТАНТЫ УРОВНЕЙ ---
 LEVEL_EMOJIS = {
@@ -43,18 +42,6 @@ LEVEL_EMOJIS = {
 
 # --- 🛠️ ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 
-def _ensure_list(data: Any) -> list:
-    """Безопасное преобразование в список."""
-    if isinstance(data, list):
-        return data
-    if isinstance(data, str):
-        try:
-            return json.loads(data)
-        except json.JSONDecodeError:
-            return []
-    return []
-
-
 def get_level_info(streak: int) -> Dict[str, Any]:
     """
     Определяет информацию об уровне на основе стрика.
@@ -173,28 +160,32 @@ async def send_level_up_message(bot: Bot, user_id: int, user_data: Dict[str, Any
 
 # --- ⚔️ ОСНОВНАЯ ЛОГИКА ЧЕЛЛЕНДЖЕЙ ---
 
-def _get_challenge_state(user_data: dict) -> Tuple[str, Optional[dict], Optional[int]]:
-    """Определяет текущий статус челленджа: none / active / completed."""
-    challenges = _ensure_list(user_data.get("challenges", []))
-    if not challenges:
-        return "none", None, None
+def _today_str(user_data: dict) -> str:
+    """Текущая дата в часовом поясе пользователя (ключ истории челленджей)."""
+    return datetime.now(get_user_tz(user_data)).date().isoformat()
+
+
+def _is_iso_day(value: str) -> bool:
+    try:
+        date.fromisoformat(value)
+        return True
+    except (TypeError, ValueError):
+        return False
 
-    last_challenge = challenges[-1]
-    challenge_index = len(challenges) - 1
-    user_tz = get_user_tz(user_data)
-    today_str = datetime.now(user_tz).date().isoformat()
 
-    challenge_date = last_challenge.get("date")
-    if challenge_date != today_str:
-        return "none", None, None
+async def _get_challenge_state(user_id: int, user_data: dict) -> Tuple[str, Optional[dict]]:
+    """Определяет текущий статус челленджа: none / active / completed (одна строка по ключу)."""
+    challenge = await db.get_challenge(user_id, _today_str(user_data))
+    if not challenge:
+        return "none", None
 
-    if last_challenge.get("completed"):
-        return "completed", last_challenge, challenge_index
+    if challenge.get("completed_at"):
+        return "completed", challenge
 
-    if user_data.get("challenge_accepted", 0):
-        return "active", last_challenge, challenge_index
+    if challenge.get("accepted_at"):
+        return "active", challenge
 
-    return "none", None, None
+    return "none", None
 
 
 async def send_new_challenge_message(
@@ -207,11 +198,11 @@ async def send_new_challenge_message(
 ):
     """Выдача нового челленджа или сообщение о существующем."""
     chat_id = event.from_user.id
-    fresh_user = await db.get_user(chat_id)
+    fresh_user = await db.get_user_fields(chat_id, ("name", "timezone", "challenges_today"))
     if not fresh_user:
         return
 
-    state_type, active_c, idx = _get_challenge_state(fresh_user)
+    state_type, active_c = await _get_challenge_state(chat_id, fresh_user)
     user_name = fresh_user.get("name") or event.from_user.first_name or ""
 
     if state_type == "completed":
@@ -225,7 +216,7 @@ async def send_new_challenge_message(
     if state_type == "active" and active_c:
         text_msg = f"{t('challenge_pending_acceptance', lang)}\n\n💪 <b>Текущий челлендж:</b>\n<i>{active_c.get('text')}</i>"
         builder = InlineKeyboardBuilder()
-        builder.button(text=t("btn_challenge_complete", lang), callback_data=f"complete_challenge:{idx}")
+        builder.button(text=t("btn_challenge_complete", lang), callback_data=f"complete_challenge:{active_c['day']}")
         builder.button(text=t("btn_challenge_new", lang), callback_data="new_challenge")
         builder.adjust(1)
 
@@ -235,16 +226,15 @@ async def send_new_challenge_message(
             await event.answer(text_msg, reply_markup=builder.as_markup(), parse_mode=ParseMode.HTML)
         return
 
-    # Выдача нового челленджа
-    challenges_list = static_data.get("challenges", {}).get(lang, []) or static_data.get("challenges", {}).get("ru", [])
-    if not challenges_list:
+    # Выдача нового челленджа (id записи — её позиция в списке, без поиска по списку)
+    entry = get_category(static_data, "challenges").choice(lang)
+    if entry is None:
         return
 
-    item = random.choice(challenges_list)
-    final_text = (item.get("text") if isinstance(item, dict) else item).format(name=user_name)
+    final_text = entry.render(user_name)
 
     builder = InlineKeyboardBuilder()
-    builder.button(text=t('btn_challenge_accept', lang), callback_data=f"accept_challenge_idx:{challenges_list.index(item)}")
+    builder.button(text=t('btn_challenge_accept', lang), callback_data=f"accept_challenge_idx:{entry.id}")
     builder.button(text=t('btn_challenge_new', lang), callback_data="new_challenge")
     builder.adjust(1)
 
@@ -267,23 +257,15 @@ async def accept_challenge(query: CallbackQuery, static_data: dict, user_data: d
     except:
         idx = 0
 
-    challenges_list = static_data.get("challenges", {}).get(lang, []) or static_data.get("challenges", {}).get("ru", [])
-    item = challenges_list[idx] if idx < len(challenges_list) else {"text": "Challenge"}
-    text_raw = item.get("text") if isinstance(item, dict) else item
+    entry = get_category(static_data, "challenges").get(lang, idx)
+    final_text = entry.render(user_data.get("name", "друг")) if entry else "Challenge"
+    day = _today_str(user_data)
 
-    final_text = text_raw.format(name=user_data.get("name", "друг"))
-    hist = _ensure_list(user_data.get("challenges") or [])
-    hist.append({
-        "text": final_text,
-        "accepted": datetime.now().isoformat(),
-        "completed": None,
-        "date": datetime.now().date().isoformat()
-    })
-
-    await db.update_user(query.from_user.id, challenges=hist, challenge_accepted=1)
+    await db.accept_challenge(query.from_user.id, day, idx, final_text)
+    await db.update_user(query.from_user.id, challenge_accepted=1)
 
     builder = InlineKeyboardBuilder()
-    builder.button(text=t("btn_challenge_complete", lang), callback_data=f"complete_challenge:{len(hist)-1}")
+    builder.button(text=t("btn_challenge_complete", lang), callback_data=f"complete_challenge:{day}")
 
     await query.message.edit_text(
         t('challenge_accepted_msg', lang, challenge_text=final_text),
@@ -295,22 +277,23 @@ async def accept_challenge(query: CallbackQuery, static_data: dict, user_data: d
 
 async def complete_challenge(query: CallbackQuery, user_data: dict, lang: Lang, state: FSMContext):
     """Завершение челленджа и обновление стрика."""
-    try:
-        idx = int(query.data.split(":")[-1])
-    except:
-        return
+    fresh_user = await db.get_user_fields(query.from_user.id, ("name", "timezone", "challenge_streak"))
+    if not fresh_user:
+        return await query.answer()
+
+    # Старые кнопки несут индекс в JSON-списке — для них берём сегодняшний день
+    day = query.data.split(":")[-1]
+    if not _is_iso_day(day):
+        day = _today_str(fresh_user)
 
-    fresh_user = await db.get_user(query.from_user.id)
-    hist = _ensure_list(fresh_user.get("challenges"))
+    challenge = await db.get_challenge(query.from_user.id, day)
 
-    if hist and idx < len(hist) and not hist[idx].get("completed"):
-        hist[idx]["completed"] = datetime.now().isoformat()
+    if challenge and await db.complete_challenge(query.from_user.id, day):
         old_streak = int(fresh_user.get("challenge_streak", 0))
         new_streak = old_streak + 1
 
         await db.update_user(
             query.from_user.id,
-            challenges=hist,
             challenge_streak=new_streak,
             challenge_accepted=0
         )
@@ -322,7 +305,7 @@ async def complete_challenge(query: CallbackQuery, user_data: dict, lang: Lang,
             await send_level_up_message(query.bot, query.from_user.id, fresh_user, lang, new_lvl_info)
 
         await query.message.edit_text(
-            f"✅ {t('challenge_completed_msg', lang)}\n\n<i>{hist[idx]['text']}</i>",
+            f"✅ {t('challenge_completed_msg', lang)}\n\n<i>{challenge.get('text') or ''}</i>",
             parse_mode=ParseMode.HTML
         )
 
@@ -331,44 +314,31 @@ async def complete_challenge(query: CallbackQuery, user_data: dict, lang: Lang,
 
 # --- ⏰ НАПОМИНАНИЯ О ЧЕЛЛЕНДЖАХ ---
 
-async def check_challenges_reminder(bot: Bot, user_id: int, user_data: dict, lang: Lang):
+def challenge_day_reminder_text(user_data: dict) -> str:
     """
-    Проверка и отправка напоминаний о челленджах.
-    Вызывается из scheduler.py каждые 30 минут (в 5 и 35 минутах часа).
+    Напоминание в 16:00, если челлендж сегодня ещё не принят.
+    Отправку планирует scheduler.py (строки send_plan → outbox).
     """
-    try:
-        user_tz = get_user_tz(user_data)
-        local_now = datetime.now(user_tz)
-        local_hour = local_now.hour
-
-        state_type, active_c, idx = _get_challenge_state(user_data)
-
-        # 1. Напоминание в 16:00–16:59, если челлендж ещё не выдан/не принят
-        if local_hour == 16 and state_type == "none":
-            reminder_text = t(
-                'challenge_new_day_reminder',
-                lang,
-                name=user_data.get("name", "друг")
-            )
-            await safe_send(bot, user_id, reminder_text)
-
-        # 2. Напоминание через ~1 час после принятия, если не выполнен
-        if state_type == "active" and active_c:
-            accepted_time = active_c.get("accepted")
-            if accepted_time:
-                accepted_dt = datetime.fromisoformat(accepted_time).astimezone(user_tz)
-                time_passed_hours = (local_now - accepted_dt).total_seconds() / 3600
-
-                # Окно 60–90 минут после принятия
-                if 1.0 <= time_passed_hours < 1.5:
-                    challenge_text = active_c.get("text", "")
-                    reminder_text = t(
-                        'challenge_hour_reminder',
-                        lang,
-                        name=user_data.get("name", ""),
-                        challenge=challenge_text
-                    )
-                    await safe_send(bot, user_id, reminder_text)
+    return t(
+        'challenge_new_day_reminder',
+        get_user_lang(user_data),
+        name=user_data.get("name") or "друг"
+    )
 
+async def send_challenge_hour_reminder(bot: Bot, row: dict):
+    """
+    Напоминание через ~1 час после принятия, если челлендж не выполнен.
+    Кандидатов отбирает scheduler.py (db.take_due_followups — строки due_reminders со сроком).
+    """
+    user_id = row["user_id"]
+    try:
+        lang = get_user_lang(row)
+        reminder_text = t(
+            'challenge_hour_reminder',
+            lang,
+            name=row.get("name") or "",
+            challenge=row.get("text") or ""
+        )
+        return await safe_send(bot, user_id, reminder_text)
     except Exception as e:
-        logger.error(f"Error in check_challenges_reminder for user {user_id}: {e}", exc_info=True)
+        logger.error(f"Error in send_challenge_hour_reminder for user {user_id}: {e}", exc_info=True)
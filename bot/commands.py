@@ -20,7 +20,8 @@ from bot.keyboards import get_lang_keyboard, get_reply_keyboard_for_user
 from bot.content_handlers import handle_start_command, send_payment_instructions, notify_admins
 from bot.utils import safe_send, get_user_lang, is_demo_expired
 from bot.scheduler import setup_jobs_and_cache
-from bot.user_loader import load_static_data
+from bot.leader import is_leader
+from bot.user_loader import refresh_static_data
 
 router = Router()
 
@@ -33,25 +34,24 @@ class TimezoneStates(StatesGroup):
 async def user_blocked_bot(event: ChatMemberUpdated, bot: Bot):
     user_id = event.chat.id
     name = event.from_user.first_name if event.from_user else "User"
-    await db.update_user(user_id, active=False)
+    await db.mark_blocked(user_id, "blocked_by_user")
     logger.info(f"⛔ User {user_id} blocked the bot.")
     await notify_admins(bot, f"⛔ <b>Пользователь заблокировал бота:</b>\n👤 {name} (ID: <code>{user_id}</code>)")
 
 @router.my_chat_member(ChatMemberUpdatedFilter(member_status_changed=MEMBER))
 async def user_unblocked_bot(event: ChatMemberUpdated, bot: Bot):
     user_id = event.chat.id
-    await db.update_user(user_id, active=True)
+    await db.mark_unblocked(user_id)
     logger.info(f"✅ User {user_id} unblocked the bot.")
 
 # --- 🚀 START & PAY ---
 
 @router.message(CommandStart())
-async def start_command(message: Message, bot: Bot, static_data: dict, users_db: dict):
+async def start_command(message: Message, bot: Bot, static_data: dict):
     if not message.from_user:
         return
     
     user_id = message.from_user.id
-    user_id_str = str(user_id)
     user_data = await db.get_user(user_id)
     
     # 1️⃣ НОВЫЙ ПОЛЬЗОВАТЕЛЬ (Формула 3+1+3)
@@ -80,7 +80,6 @@ async def start_command(message: Message, bot: Bot, static_data: dict, users_db:
         return await message.answer("Пожалуйста, выберите язык:", reply_markup=get_lang_keyboard())
 
     # 3️⃣ ВЕРНУВШИЙСЯ ПОЛЬЗОВАТЕЛЬ (Логика кулдауна 1 день)
-    users_db[user_id_str] = user_data
     
     if user_data.get("status") == "cooldown":
         exp_str = user_data.get("demo_expiration")
@@ -96,11 +95,11 @@ async def start_command(message: Message, bot: Bot, static_data: dict, users_db:
                     new_expiry = now_utc + timedelta(days=3)
                     await db.update_user(
                         user_id, demo_count=2, status="active_demo", demo_expiration=new_expiry.isoformat(),
-                        challenge_streak=0, challenge_accepted=0, challenges=[],
+                        challenge_streak=0, challenge_accepted=0,
                         sent_expiry_warning=0, active=True
                     )
+                    await db.clear_challenge_history(user_id)
                     user_data = await db.get_user(user_id)
-                    users_db[user_id_str] = user_data
                     await safe_send(bot, user_id, t("demo_restarted_info", lang, name=user_data.get("name", "")))
                 else:
                     remaining = cooldown_end - now_utc
@@ -168,7 +167,7 @@ async def broadcast_test_command(message: Message, bot: Bot, static_data: dict,
     await message.answer("✅ Тест завершен. Остальные типы сообщений выведены в логи сервера.")
 
 @router.message(Command("grant"))
-async def grant_command(message: Message, bot: Bot, users_db: dict, is_admin: bool = False, lang: Lang = "ru"):
+async def grant_command(message: Message, bot: Bot, is_admin: bool = False, lang: Lang = "ru"):
     if not is_admin: return
     try:
         args = message.text.split()
@@ -181,7 +180,6 @@ async def grant_command(message: Message, bot: Bot, users_db: dict, is_admin: bo
             return
         
         await db.update_user(target_id_int, is_paid=True, active=True, status="active_paid")
-        users_db[str(target_id_int)] = await db.get_user(target_id_int)
         
         await message.answer(f"✅ Доступ Premium выдан: {target_user.get('name')} (ID: {target_id_int})")
         await safe_send(bot, target_id_int, t('user_grant_notification', get_user_lang(target_user)))
@@ -191,7 +189,7 @@ async def grant_command(message: Message, bot: Bot, users_db: dict, is_admin: bo
 @router.message(Command("stats"))
 async def stats_cmd_handler(message: Message, is_admin: bool = False):
     if not is_admin: return
-    await send_stats_report(message, {}, "ru")
+    await send_stats_report(message, "ru")
 
 @router.message(Command("delete_user"))
 async def delete_user_command(message: Message, is_admin: bool = False):
@@ -205,16 +203,18 @@ async def delete_user_command(message: Message, is_admin: bool = False):
         await message.answer("Использование: <code>/delete_user [USER_ID]</code>")
 
 @router.message(Command("reload"))
-async def reload_command(message: Message, bot: Bot, users_db: dict, static_data: dict, is_admin: bool = False):
+async def reload_command(message: Message, bot: Bot, static_data: dict, is_admin: bool = False):
     if not is_admin: return
-    static_data.update(await load_static_data())
-    users_db.update(await db.get_all_users())
-    await setup_jobs_and_cache(bot, users_db, static_data)
+    # Только изменившиеся файлы, в том же объекте static_data
+    await refresh_static_data(static_data)
+    # Задачи пересобирает только лидер: на остальных процессах планировщик не работает
+    if is_leader():
+        await setup_jobs_and_cache(bot, static_data)
     await message.answer("🔄 Система успешно перезагружена.")
 
 # --- 📊 ФУНКЦИИ СТАТИСТИКИ (Вызываются из button_handlers) ---
 
-async def send_stats_report(message: Message, users_db: dict, lang: Lang = "ru"):
+async def send_stats_report(message: Message, lang: Lang = "ru"):
     """Функция для кнопки 'Статистика'"""
     total = await db.get_total_users_count()
     active_7d = await db.get_active_users_count(days=7)
@@ -225,7 +225,7 @@ async def send_stats_report(message: Message, users_db: dict, lang: Lang = "ru")
     )
     await message.answer(report, parse_mode="HTML")
 
-async def show_users_command(message: Message, users_db: dict, is_admin: bool = False):
+async def show_users_command(message: Message, is_admin: bool = False):
     """Функция для кнопки 'Показать юзеров'"""
     if not is_admin: return
-    await send_stats_report(message, users_db)  # Пока делаем упрощенно через статы
\ No newline at end of file
+    await send_stats_report(message)  # Пока делаем упрощенно через статы
\ No newline at end of file
@@ -81,6 +81,42 @@ class Settings(BaseSettings):
 
     BOT_USERNAME: str = "FotiniaBot"
 
+    # === База данных ===
+    DB_POOL_READERS: int = 3  # Читающие соединения пула (писатель всегда один)
+    DB_WRITE_BEHIND: bool = False  # Отложенная запись update_user (сброс пачками)
+    DB_FLUSH_INTERVAL_MS: int = 200
+    DB_FLUSH_MAX_ROWS: int = 500
+    USER_CACHE_SIZE: int = 5000  # Строк users в LRU-кэше Database (0 или LEADER_ELECTION — кэш выключен)
+    USER_CACHE_TTL: int = 300  # Секунд; страховка от правок в обход Database
+
+    # === Рассылки (лимиты Telegram: ~30 сообщений/с на бота, ~1/с в один чат) ===
+    BROADCAST_WORKERS: int = 8
+    BROADCAST_RATE: float = 25.0  # Сообщений в секунду на весь бот (с запасом до 30)
+    BROADCAST_PER_CHAT_INTERVAL: float = 1.0  # Секунд между сообщениями в один чат
+    BROADCAST_PROGRESS_SECONDS: float = 15.0  # Как часто писать прогресс в лог
+    OUTBOX_MAX_AGE_HOURS: int = 6  # Недоставленное старше этого после рестарта не отправляется
+    OUTBOX_KEEP_DAYS: int = 14  # Сколько хранить журнал отправленных (и dead letters)
+    # === Повторы при временных ошибках (Flood control, сеть, 5xx) ===
+    SEND_MAX_ATTEMPTS: int = 5  # Попыток на одно сообщение, потом — dead letter
+    SEND_RETRY_MAX_WAIT: float = 30.0  # safe_send ждёт на месте не дольше (секунд за раз)
+    BROADCAST_RETRY_MAX_WAIT: float = 600.0  # Рассылка откладывает сообщение не дальше (секунд)
+    # === Задачи планировщика (bot/jobs.py) ===
+    JOB_LEASE_SECONDS: float = 120.0  # Аренда задачи; продлевается каждые треть срока, пока задача идёт
+    JOB_RUNS_KEEP_DAYS: int = 14  # Сколько хранить журнал запусков
+    # Только для нескольких процессов на одной базе (bot/leader.py): задачи выполняет лидер,
+    # кэш users и write-behind выключаются (они живут в одном процессе). Один процесс — False
+    LEADER_ELECTION: bool = False
+    LEADER_LEASE_SECONDS: float = 30.0  # Срок аренды лидера = максимальное время переключения
+    # === Контент (bot/user_loader.py) ===
+    CONTENT_WATCH_SECONDS: float = 30.0  # Проверка файлов контента на изменения (0 — только /reload)
+    LOCALIZATION_CACHE_SIZE: int = 4096  # Результатов t() с аргументами в LRU-кэше
+    KEYBOARD_CACHE_SIZE: int = 2048  # Клавиатур по пользователю/фразе в LRU-кэше (bot/keyboards.py)
+
+    # === Бэкапы ===
+    BACKUP_FULL_EVERY_DAYS: int = 7  # Полный снимок раз в N дней, между ними — дельты страниц
+    BACKUP_KEEP_DAYS: int = 30
+    BACKUP_COMPRESS: bool = True  # gzip для снимков и дельт
+
     # === Пути ===
     DATA_DIR: Path = Path(os.getenv("DATA_DIR", "data")).resolve()
 
@@ -114,6 +150,11 @@ class Settings(BaseSettings):
         """Путь к файлу базы данных SQLite."""
         return self.DATA_DIR / "fotinia.db"
 
+    @property
+    def BACKUP_DIR(self) -> Path:
+        """Папка ежедневных бэкапов базы."""
+        return self.DATA_DIR / "backups"
+
     @property
     def DATA_INITIAL_DIR(self) -> Path:
         """Путь к исходным данным (челленджи, правила и т.д.)."""
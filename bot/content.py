@@ -0,0 +1,196 @@
+# 21 - bot/content.py
+# ✅ Каталог контента: собирается один раз при загрузке из сырых JSON (static_data)
+# ✅ Категория → язык → неизменяемый кортеж проверенных записей со стабильными id
+# ✅ Запасной язык (DEFAULT_LANG) подставляется при сборке, а не при каждой отправке
+# ✅ Поиск по id за O(1) (id = позиция в исходном списке, как в старых callback_data)
+#
+# Проверка контента и замер поиска:
+#   python -m bot.content [папка с JSON]
+
+import random
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from types import MappingProxyType
+from typing import Any, Dict, Iterable, Mapping, Optional, Tuple
+
+from bot.config import logger, settings
+
+DEFAULT_LANG = settings.DEFAULT_LANG
+LANGUAGES = ("ru", "ua", "en")
+
+@dataclass(frozen=True, slots=True)
+class ContentEntry:
+    id: int  # Позиция в исходном списке языка (для callback_data и rules_indices_today)
+    text: str
+    parts: Tuple[str, ...]  # Текст, разрезанный по {name}: подстановка имени — один join
+
+    @property
+    def has_name(self) -> bool:
+        return len(self.parts) > 1
+
+    def render(self, name: Optional[str]) -> str:
+        """Текст с именем (без имени плейсхолдер убирается)."""
+        if len(self.parts) == 1:
+            return self.parts[0]
+        if not name:
+            return "".join(self.parts).strip()
+        return name.join(self.parts)
+
+def _entry_text(raw: Any) -> Optional[str]:
+    """Строка или словарь с text/content; пустое и неизвестное отбрасывается."""
+    if isinstance(raw, dict):
+        raw = raw.get("text") or raw.get("content")
+    if isinstance(raw, str) and raw.strip():
+        return raw
+    return None
+
+def _split(text: str) -> Tuple[str, ...]:
+    """Шаблон один раз через format (экранирование {{ }} как раньше), битый — простой заменой."""
+    if "{name}" not in text:
+        return (text,)
+    try:
+        return tuple(text.format(name="\0").split("\0"))
+    except Exception as e:
+        logger.error(f"Content: bad template {text[:40]!r}: {e}")
+        return tuple(text.split("{name}"))
+
+def _compile(items: Iterable[Any]) -> Tuple[ContentEntry, ...]:
+    entries = []
+    for idx, raw in enumerate(items):
+        text = _entry_text(raw)
+        if text is not None:
+            entries.append(ContentEntry(idx, text, _split(text)))
+    return tuple(entries)
+
+class ContentCategory:
+    """Записи одной категории по языкам. После сборки не меняется — замена только целиком."""
+    __slots__ = ("key", "_entries", "_by_id", "dropped")
+
+    def __init__(self, key: str, entries: Mapping[str, Tuple[ContentEntry, ...]], dropped: int = 0):
+        self.key = key
+        # Обычные dict (proxy медленнее на горячем пути); снаружи меняются только через build
+        self._entries: Dict[str, Tuple[ContentEntry, ...]] = dict(entries)
+        self._by_id: Dict[str, Dict[int, ContentEntry]] = {
+            lang: {e.id: e for e in items} for lang, items in self._entries.items()
+        }
+        self.dropped = dropped  # Сколько записей не прошло проверку
+
+    @classmethod
+    def build(cls, key: str, raw: Any) -> "ContentCategory":
+        """raw — {язык: [записи]} или просто [записи] (тогда это DEFAULT_LANG)."""
+        if isinstance(raw, list):
+            raw = {DEFAULT_LANG: raw}
+        if not isinstance(raw, dict):
+            raw = {}
+        compiled: Dict[str, Tuple[ContentEntry, ...]] = {}
+        dropped = 0
+        for lang, items in raw.items():
+            if isinstance(items, list):
+                compiled[lang] = _compile(items)
+                dropped += len(items) - len(compiled[lang])
+        # Запасной язык: пустые и отсутствующие языки берут записи DEFAULT_LANG
+        fallback = compiled.get(DEFAULT_LANG) or next((v for v in compiled.values() if v), ())
+        for lang in {*LANGUAGES, *compiled}:
+            if not compiled.get(lang):
+                compiled[lang] = fallback
+        return cls(key, compiled, dropped)
+
+    def languages(self) -> Mapping[str, Tuple[ContentEntry, ...]]:
+        return MappingProxyType(self._entries)
+
+    def entries(self, lang: str) -> Tuple[ContentEntry, ...]:
+        return self._entries.get(lang) or self._entries.get(DEFAULT_LANG, ())
+
+    def get(self, lang: str, entry_id: int) -> Optional[ContentEntry]:
+        by_id = self._by_id.get(lang) or self._by_id.get(DEFAULT_LANG, {})
+        return by_id.get(entry_id)
+
+    def choice(self, lang: str) -> Optional[ContentEntry]:
+        entries = self.entries(lang)
+        return random.choice(entries) if entries else None
+
+    def __bool__(self) -> bool:
+        return any(self._entries.values())
+
+    def stats(self) -> Dict[str, int]:
+        return {lang: len(items) for lang, items in sorted(self._entries.items())}
+
+EMPTY_CATEGORY = ContentCategory("", {})
+
+class ContentCatalog(dict):
+    """
+    static_data: ключ категории → ContentCategory. Остаётся dict, поэтому middleware и планировщик
+    держат один объект, а перезагрузка заменяет в нём категории по одной (swap).
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stamps: Dict[str, Any] = {}  # Ключ → подпись файла, из которого собрана категория
+
+    @classmethod
+    def build(cls, raw: Mapping[str, Any]) -> "ContentCatalog":
+        catalog = cls()
+        for key, value in raw.items():
+            catalog.swap(key, value if isinstance(value, ContentCategory) else ContentCategory.build(key, value))
+        return catalog
+
+    def swap(self, key: str, category: ContentCategory, stamp: Any = None):
+        """Замена категории целиком: читатели видят либо старую, либо новую, не смесь."""
+        if category.dropped:
+            logger.warning(f"Content: {category.dropped} invalid entries dropped from {key}.")
+        if stamp is not None:
+            self.stamps[key] = stamp
+        self[key] = category
+
+def get_category(static_data: Mapping[str, Any], key: str) -> ContentCategory:
+    """Категория из static_data; сырые данные (тесты, старые вызовы) собираются на лету."""
+    value = static_data.get(key) if static_data else None
+    if isinstance(value, ContentCategory):
+        return value
+    if not value:
+        return EMPTY_CATEGORY
+    return ContentCategory.build(key, value)
+
+# ========== ⏱️ ПРОВЕРКА И ЗАМЕР ==========
+
+def benchmark(catalog: ContentCatalog, rounds: int = 100_000) -> Dict[str, float]:
+    """Микросекунды на операцию: случайная запись + текст с именем, поиск челленджа по id."""
+    results = {}
+    for key in ("challenges", "morning_phrases", "motivations"):
+        category = get_category(catalog, key)
+        if not category:
+            continue
+        started = time.perf_counter()
+        for i in range(rounds):
+            entry = category.choice(LANGUAGES[i % 3])
+            entry.render("Оля")
+        results[f"{key}.choice+render"] = round((time.perf_counter() - started) / rounds * 1e6, 3)
+    challenges = get_category(catalog, "challenges")
+    if challenges:
+        ids = [e.id for e in challenges.entries(DEFAULT_LANG)]
+        started = time.perf_counter()
+        for i in range(rounds):
+            challenges.get(LANGUAGES[i % 3], ids[i % len(ids)])
+        results["challenges.get_by_id"] = round((time.perf_counter() - started) / rounds * 1e6, 3)
+    return results
+
+def main(argv: Optional[list] = None) -> int:
+    import asyncio
+    import tempfile
+    from bot.user_loader import load_static_data
+
+    argv = sys.argv[1:] if argv is None else argv
+    source = Path(argv[0]) if argv else settings.DATA_INITIAL_DIR
+    with tempfile.TemporaryDirectory() as tmp:
+        catalog = asyncio.run(load_static_data(data_dir=Path(tmp), source_dir=source))
+    for key, category in catalog.items():
+        print(f"{'✅' if category else '❌'} {key}: {category.stats()}, dropped {category.dropped}")
+    for name, us in benchmark(catalog).items():
+        print(f"⏱️ {name}: {us} µs")
+    return 0 if all(catalog.values()) else 1
+
+if __name__ == "__main__":
+    # Через bot.content, а не __main__: каталог из user_loader собран классами этого модуля
+    from bot.content import main as _main
+    sys.exit(_main())
@@ -20,6 +20,7 @@ from aiogram.enums import ParseMode
 from bot.config import settings, logger
 from bot.localization import t, Lang
 from bot.database import db
+from bot.content import get_category
 from bot.keyboards import (
     get_main_keyboard, get_broadcast_keyboard,
     get_payment_keyboard
@@ -145,24 +146,17 @@ async def send_from_list(message: Message, static_data: dict, user_data: dict, l
         return
     setattr(message, f"_handled_{list_key}", True)
 
-    content_data = static_data.get(list_key, {})
-    phrases = content_data.get(lang, content_data.get("ru", [])) if isinstance(content_data, dict) else content_data
-
-    if not phrases or not isinstance(phrases, list):
+    entry = get_category(static_data, list_key).choice(lang)
+    if entry is None:
         logger.error(f"Handlers: Content list {list_key} is empty/invalid.")
         await message.answer(t('list_empty', lang, title=t(title_key, lang)))
         return
 
-    phrase_raw = random.choice(phrases)
-    phrase = str(phrase_raw.get("text") or phrase_raw.get("content") or phrase_raw) if isinstance(phrase_raw, dict) else str(phrase_raw)
-
     user_name = user_data.get("name") or message.from_user.first_name
-    try:
-        phrase = phrase.format(name=user_name)
-    except Exception as e:
-        logger.error(f"Format error in {list_key}: {e}")
+    phrase = entry.render(user_name)
 
-    kb = get_broadcast_keyboard(lang, quote_text=phrase, category=list_key, user_name=user_name)
+    # В "Поделиться" — та же фраза с именем; ссылка собирается из заготовки фразы
+    kb = get_broadcast_keyboard(lang, user_name=user_name, entry=entry)
     await message.answer(phrase, reply_markup=kb, parse_mode=ParseMode.HTML)
 
 # --- ⚖️ ПРАВИЛА ---
@@ -184,31 +178,32 @@ async def send_rules(message: Message, static_data: dict, user_data: dict, lang:
         await message.answer(t('rules_limit_reached', lang))
         return
 
-    rules_list = static_data.get("rules", {}).get(lang) or static_data.get("rules", {}).get("ru", [])
-    if not rules_list:
+    rules = get_category(static_data, "rules").entries(lang)
+    if not rules:
         await message.answer(t('list_empty', lang, title="Rules"))
         return
 
     shown_indices = user_data.get("rules_indices_today") or []
-    available = [i for i in range(len(rules_list)) if i not in shown_indices] or list(range(len(rules_list)))
-
-    idx = random.choice(available)
-    rule_text = rules_list[idx]
-    new_count, new_indices = shown_count + 1, shown_indices + [idx]
+    shown = set(shown_indices)
+    entry = random.choice([r for r in rules if r.id not in shown] or rules)
+    rule_text = entry.text
+    new_count, new_indices = shown_count + 1, shown_indices + [entry.id]
 
     await db.update_user(user_id, rules_shown_count=new_count, rules_indices_today=new_indices)
     header = t('title_rules_daily', lang, title=t('title_rules', lang), count=new_count, limit=settings.RULES_PER_DAY_LIMIT)
-    kb = get_broadcast_keyboard(lang, rule_text, "rules", user_name=user_data.get("name") or message.from_user.first_name)
+    kb = get_broadcast_keyboard(lang, rule_text)
     await message.answer(f"<b>{header}</b>\n\n{rule_text}", reply_markup=kb, parse_mode=ParseMode.HTML)
 
 # --- 📊 ПРОФИЛЬ ---
 
+PROFILE_FIELDS = ("name", "is_paid", "challenge_streak", "last_level_checked", "stats_likes", "stats_dislikes")
+
 async def send_profile(message: Message, user_data: dict, lang: Lang):
     user_id = message.from_user.id
     bot = message.bot
     
-    # Получаем свежие данные из БД
-    fresh_user = await db.get_user(user_id)
+    # Получаем свежие данные из БД (только поля профиля)
+    fresh_user = await db.get_user_fields(user_id, PROFILE_FIELDS)
     if fresh_user: 
         user_data.update(fresh_user)
     
@@ -227,8 +222,7 @@ async def send_profile(message: Message, user_data: dict, lang: Lang):
         await db.update_user(user_id, last_level_checked=current_level)
         user_data["last_level_checked"] = current_level
     
-    challenges = user_data.get("challenges", [])
-    completed_count = len([c for c in challenges if isinstance(c, dict) and c.get("completed")])
+    challenge_counts = await db.get_challenge_counts(user_id)
     
     # Получаем название уровня
     level_name = t(level_info["current_level"], lang)
@@ -246,8 +240,8 @@ async def send_profile(message: Message, user_data: dict, lang: Lang):
         f"👤 <b>{t('profile_title', lang)}</b>\n\n"
         f"📛 {t('profile_name', lang)}: <b>{user_data.get('name') or message.from_user.first_name}</b>\n"
         f"💰 {t('profile_status', lang)}: <b>{t('status_premium', lang) if user_data.get('is_paid') else t('status_demo', lang)}</b>\n\n"
-        f"⚔️ {t('profile_challenges_accepted', lang)}: <b>{len(challenges)}</b>\n"
-        f"✅ {t('profile_challenges_completed', lang)}: <b>{completed_count}</b>\n"
+        f"⚔️ {t('profile_challenges_accepted', lang)}: <b>{challenge_counts['accepted']}</b>\n"
+        f"✅ {t('profile_challenges_completed', lang)}: <b>{challenge_counts['completed']}</b>\n"
         f"🔥 {t('profile_challenge_streak', lang)}: <b>{streak} дней</b>\n"
         f"🏆 Уровень {level_info['level_number']}: <b>{level_name}</b> {progress_bar} {level_info['progress_percent']}%\n"
         f"{next_level_text}\n\n"
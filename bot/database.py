@@ -4,86 +4,422 @@
 # ✅ ПРОВЕРЕНО: WAL режим, защита от дублей рассылки, реферальная система
 
 import aiosqlite
+import asyncio
 import json
 import logging
-from datetime import datetime, timedelta
-from typing import Dict, Any, Optional
+import time
+from collections import OrderedDict, deque
+from collections.abc import MutableMapping
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, Optional, AsyncIterator, Callable, Iterable, List, Tuple
 
 from bot.config import settings
+from bot.migrations import run_migrations
 
 logger = logging.getLogger(__name__)
 
 # Константа безопасности для рекурсии JSON
 MAX_JSON_DEPTH = 5
 
+# Поля, которые можно менять через update_user
+ALLOWED_FIELDS = {
+    "username", "name", "language", "timezone", "is_paid", "status",
+    "demo_expiration", "active", "last_challenge_date", "challenge_accepted",
+    "challenges", "challenge_streak", "fsm_state", "fsm_data",
+    "last_rules_date", "rules_shown_count", "rules_indices_today",
+    "sent_expiry_warning", "stats_likes", "stats_dislikes", "demo_count",
+    "challenges_today", "data", "last_level_checked",
+    "referred_by", "created_at", "last_broadcast_date",
+    "blocked_reason", "blocked_at", "active_before_block",
+}
+USER_COLUMNS = ALLOWED_FIELDS | {"user_id"}
+JSON_FIELDS = {"challenges", "rules_indices_today", "data", "fsm_data"}
+JSON_LIST_FIELDS = {"challenges", "rules_indices_today"}
+# Профиль без JSON-колонок: то, что middleware кладёт в user_data для хендлеров
+SCALAR_FIELDS = tuple(sorted(USER_COLUMNS - JSON_FIELDS))
+
+# Напоминание о невыполненном челлендже: через час после принятия, не позже чем через полчаса после срока
+CHALLENGE_FOLLOWUP_DELAY = timedelta(hours=1)
+FOLLOWUP_MAX_DELAY = timedelta(minutes=30)
+
+# PRAGMA, которые применяются один раз на каждое соединение пула
+CONNECTION_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+# Выборки кандидатов для задач планировщика.
+# Каждая опирается на свой индекс — проверяется EXPLAIN QUERY PLAN при старте (check_query_plans).
+# CROSS JOIN в SQLite фиксирует порядок таблиц: сначала idx_due_reminders_due, затем остальные по ключу.
+SQL_EXPIRING_DEMOS = """
+    SELECT user_id, language, demo_expiration FROM users
+    WHERE is_paid = 0 AND demo_expiration IS NOT NULL
+      AND demo_expiration > ? AND demo_expiration <= ?
+      AND sent_expiry_warning = 0
+"""
+SQL_TIMEZONE_BUCKETS = "SELECT timezone, COUNT(*) FROM users WHERE active = 1 GROUP BY timezone"
+SQL_DUE_FOLLOWUPS = """
+    SELECT r.user_id, r.ref AS day, h.text, h.accepted_at, u.name, u.language, u.timezone
+    FROM due_reminders r
+    CROSS JOIN challenge_history h ON h.user_id = r.user_id AND h.day = r.ref
+    CROSS JOIN users u ON u.user_id = r.user_id
+    WHERE r.kind = 'challenge_followup' AND r.due_at > ? AND r.due_at <= ?
+      AND h.completed_at IS NULL AND u.active = 1
+"""
+SQL_DUE_PLAN = """
+    SELECT p.id AS plan_id, p.due_utc, p.kind, p.payload_key, {columns}
+    FROM send_plan p CROSS JOIN users u ON u.user_id = p.user_id
+    WHERE p.due_utc > ? AND p.due_utc <= ?
+    ORDER BY p.due_utc LIMIT ?
+"""
+# Условие "сегодня челлендж ещё не принят" для get_users_in_timezones
+SQL_NO_CHALLENGE_ON_DAY = (
+    "NOT EXISTS (SELECT 1 FROM challenge_history h WHERE h.user_id = users.user_id AND h.day = ?)"
+)
+
+def _percentile(samples, pct: float) -> float:
+    """Перцентиль по выборке (в миллисекундах)."""
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return round(ordered[idx] * 1000, 3)
+
+# ========== 🔌 ПУЛ СОЕДИНЕНИЙ ==========
+
+class ConnectionPool:
+    """
+    Пул долгоживущих соединений aiosqlite.
+    Один писатель (под замком) и N читателей — в WAL режиме читатели не блокируют запись.
+    """
+    def __init__(self, db_path: str, readers: int = 3, samples: int = 2048):
+        self.db_path = db_path
+        self.readers_count = max(1, readers)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._writer_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+        self._readers: Optional[asyncio.Queue] = None
+        self._all_readers: list = []
+        # Замеры: (ожидание соединения, время удержания) в секундах
+        self._timings = {
+            "read": (deque(maxlen=samples), deque(maxlen=samples)),
+            "write": (deque(maxlen=samples), deque(maxlen=samples)),
+        }
+        # Накопительно с открытия: [число захватов, суммарное удержание в секундах]
+        self._totals = {"read": [0, 0.0], "write": [0, 0.0]}
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self, readonly: bool = False) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.db_path)
+        conn.row_factory = aiosqlite.Row
+        for pragma in CONNECTION_PRAGMAS:
+            await conn.execute(pragma)
+        if readonly:
+            await conn.execute("PRAGMA query_only=1")
+        return conn
+
+    async def open(self):
+        """Открывает соединения один раз (повторный вызов безопасен)."""
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            # Писатель открывается первым: он переводит файл в WAL
+            self._writer = await self._connect()
+            self._readers = asyncio.Queue()
+            for _ in range(self.readers_count):
+                conn = await self._connect(readonly=True)
+                self._all_readers.append(conn)
+                self._readers.put_nowait(conn)
+            logger.info(f"Database: pool opened (1 writer + {self.readers_count} readers).")
+
+    async def close(self):
+        """Закрывает все соединения пула."""
+        async with self._open_lock:
+            if self._writer is None:
+                return
+            async with self._writer_lock:
+                for conn in self._all_readers:
+                    try:
+                        await conn.close()
+                    except Exception as e:
+                        logger.error(f"Database: error closing reader: {e}")
+                try:
+                    await self._writer.close()
+                except Exception as e:
+                    logger.error(f"Database: error closing writer: {e}")
+            self._writer = None
+            self._readers = None
+            self._all_readers = []
+            logger.info("Database: pool closed.")
+
+    def _record(self, role: str, wait: float, hold: float):
+        waits, holds = self._timings[role]
+        waits.append(wait)
+        holds.append(hold)
+        totals = self._totals[role]
+        totals[0] += 1
+        totals[1] += hold
+
+    @asynccontextmanager
+    async def writer(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Единственное соединение для записи. Незакоммиченное при ошибке откатывается."""
+        if not self.is_open:
+            await self.open()
+        started = time.perf_counter()
+        async with self._writer_lock:
+            acquired = time.perf_counter()
+            try:
+                yield self._writer
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            finally:
+                self._record("write", acquired - started, time.perf_counter() - acquired)
+
+    @asynccontextmanager
+    async def reader(self) -> AsyncIterator[aiosqlite.Connection]:
+        """Соединение только для чтения из очереди читателей."""
+        if not self.is_open:
+            await self.open()
+        started = time.perf_counter()
+        conn = await self._readers.get()
+        acquired = time.perf_counter()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+            self._record("read", acquired - started, time.perf_counter() - acquired)
+
+    def stats(self) -> Dict[str, Any]:
+        """Тайминги захвата/удержания соединений (p50/p99/max в мс)."""
+        result: Dict[str, Any] = {"readers": self.readers_count, "open": self.is_open}
+        for role, (waits, holds) in self._timings.items():
+            result[role] = {
+                "samples": len(waits),
+                "wait_p50_ms": _percentile(waits, 50),
+                "wait_p99_ms": _percentile(waits, 99),
+                "hold_p50_ms": _percentile(holds, 50),
+                "hold_p99_ms": _percentile(holds, 99),
+                "hold_max_ms": round(max(holds) * 1000, 3) if holds else 0.0,
+                "count": self._totals[role][0],
+                "hold_total_ms": round(self._totals[role][1] * 1000, 1),
+            }
+        return result
+
+# ========== 🧠 КЭШ ПОЛЬЗОВАТЕЛЕЙ ==========
+
+class UserCache:
+    """
+    LRU-кэш строк users с TTL. Хранит значения как в SQLite (JSON — строками),
+    декодирование делает читатель. Обновляется записями Database, а не по таймеру:
+    TTL лишь страхует от правок в обход Database (ручной SQL). Кэш на процесс, поэтому
+    при нескольких процессах (LEADER_ELECTION) Database.init его выключает.
+    """
+    def __init__(self, max_size: int = 5000, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items: "OrderedDict[int, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+        # user_id -> [сколько чтений из БД идёт, поколение]. Запись увеличивает поколение:
+        # чтение, начатое до неё, свою строку уже не кэширует (даже если чтения пересеклись)
+        self._loading: Dict[int, List[int]] = {}
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expired": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_size > 0
+
+    def get(self, user_id: int) -> Optional[Dict[str, Any]]:
+        item = self._items.get(user_id)
+        if item is not None:
+            if time.monotonic() - item[0] < self.ttl:
+                self._items.move_to_end(user_id)
+                self.stats["hits"] += 1
+                return _copy_row(item[1])
+            del self._items[user_id]
+            self.stats["expired"] += 1
+        self.stats["misses"] += 1
+        return None
+
+    def begin_load(self, user_id: int) -> int:
+        """Начало чтения из БД; возвращает поколение, с которым сверится finish_load."""
+        state = self._loading.setdefault(user_id, [0, 0])
+        state[0] += 1
+        return state[1]
+
+    def _end_load(self, user_id: int) -> int:
+        state = self._loading[user_id]
+        state[0] -= 1
+        if state[0] <= 0:
+            del self._loading[user_id]
+        return state[1]
+
+    def finish_load(self, user_id: int, row: Dict[str, Any], generation: int):
+        """Кладёт прочитанную строку, если за время этого чтения её никто не менял."""
+        if user_id not in self._loading:
+            return
+        if self._end_load(user_id) != generation or not self.enabled:
+            return
+        self._items[user_id] = (time.monotonic(), _copy_row(row))
+        self._items.move_to_end(user_id)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def cancel_load(self, user_id: int):
+        if user_id in self._loading:
+            self._end_load(user_id)
+
+    def _bump(self, user_id: int):
+        state = self._loading.get(user_id)
+        if state is not None:
+            state[1] += 1
+
+    def update(self, user_id: int, fields: Dict[str, Any]):
+        """Применяет записанные поля к закэшированной строке (если она есть)."""
+        self._bump(user_id)
+        item = self._items.get(user_id)
+        if item is not None:
+            item[1].update(_copy_row(fields))
+
+    def invalidate(self, user_id: int):
+        self._bump(user_id)
+        self._items.pop(user_id, None)
+
+    def clear(self):
+        for state in self._loading.values():
+            state[1] += 1
+        self._items.clear()
+
+    def snapshot(self) -> Dict[str, Any]:
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return {
+            "size": len(self._items),
+            "max_size": self.max_size,
+            "ttl_s": self.ttl,
+            **self.stats,
+            "hit_rate": round(self.stats["hits"] / lookups, 3) if lookups else 0.0,
+        }
+
+def _copy_row(row: Dict[str, Any]) -> Dict[str, Any]:
+    """Поверхностная копия: в кэше только неизменяемые значения (числа и строки)."""
+    return dict(row)
+
+# ========== 📄 ЛЕНИВАЯ СТРОКА ПОЛЬЗОВАТЕЛЯ ==========
+
+class UserRow(MutableMapping):
+    """
+    Строка users, которая разбирает JSON-колонки только при первом обращении.
+    Ведёт себя как dict: get/[]/update/in; изменения не пишутся в БД сами по себе.
+    """
+    __slots__ = ("_raw", "_values", "_loader")
+
+    def __init__(self, raw: Dict[str, Any], loader: Callable[[Any], Any]):
+        self._raw = raw
+        self._values: Dict[str, Any] = {}
+        self._loader = loader
+
+    def __getitem__(self, key: str) -> Any:
+        if key in self._values:
+            return self._values[key]
+        value = self._raw[key]
+        if key in JSON_FIELDS:
+            value = self._values[key] = self._loader(value)
+        return value
+
+    def __setitem__(self, key: str, value: Any):
+        self._raw.setdefault(key, None)
+        self._values[key] = value
+
+    def __delitem__(self, key: str):
+        del self._raw[key]
+        self._values.pop(key, None)
+
+    def __iter__(self):
+        return iter(self._raw)
+
+    def __len__(self) -> int:
+        return len(self._raw)
+
+    def __repr__(self) -> str:
+        return f"UserRow({dict(self)!r})"
+
+
 class Database:
-    def __init__(self, db_path: str):
+    def __init__(self, db_path: str, readers: int = 3, cache_size: int = 5000, cache_ttl: float = 300):
+        self.db_path = db_path
+        self.pool = ConnectionPool(db_path, readers=readers)
+        self.cache = UserCache(cache_size, cache_ttl)
+        # Write-behind очередь: user_id -> {поле: параметр SQL}
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self._inflight: Dict[int, Dict[str, Any]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        self._flush_stopping = False
+        self._flush_event = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._flush_interval = 0.2
+        self._flush_max_rows = 500
+        self._wb_stats = {"flushes": 0, "rows": 0, "last_flush_ms": 0.0}
+        # Блокировки: сколько юзеров помечено и сколько отправок им не сделано (с момента старта)
+        self._delivery_stats = {"blocked_marked": 0, "unblocked": 0, "sends_avoided": 0}
+
+    def use_file(self, db_path: str):
+        """Переключает ещё не открытую базу на другой файл (симуляция на копии, bot/simulate.py)."""
+        if self.pool.is_open:
+            raise RuntimeError("Database is already open")
         self.db_path = db_path
+        self.pool = ConnectionPool(db_path, readers=self.pool.readers_count)
+        self.cache.clear()
 
     async def init(self):
-        """Инициализация базы с атомарными миграциями и индексами."""
-        async with aiosqlite.connect(self.db_path) as conn:
-            await conn.execute("PRAGMA journal_mode=WAL")
-            await conn.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    name TEXT,
-                    language TEXT DEFAULT 'ru',
-                    data TEXT NOT NULL DEFAULT '{}'
-                )
-            ''')
-            
-            # Индексы для производительности
-            await conn.execute("CREATE INDEX IF NOT EXISTS idx_user_id ON users(user_id)")
-            
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_demo_expiration 
-                ON users(demo_expiration, is_paid) 
-                WHERE is_paid = 0 AND demo_expiration IS NOT NULL
-            """)
-            
-            await conn.execute("""
-                CREATE INDEX IF NOT EXISTS idx_active_timezone 
-                ON users(active, timezone) 
-                WHERE active = 1
-            """)
-
-            # Список колонок для миграции
-            cols = [
-                ("timezone", "TEXT DEFAULT 'Europe/Kiev'"),
-                ("is_paid", "INTEGER DEFAULT 0"),
-                ("status", "TEXT DEFAULT 'demo'"),
-                ("demo_expiration", "TEXT"),
-                ("active", "INTEGER DEFAULT 1"),
-                ("last_challenge_date", "TEXT"),
-                ("challenge_accepted", "INTEGER DEFAULT 0"),
-                ("challenges", "TEXT NOT NULL DEFAULT '[]'"),
-                ("challenge_streak", "INTEGER DEFAULT 0"),
-                ("fsm_state", "TEXT"),
-                ("fsm_data", "TEXT"),
-                ("last_rules_date", "TEXT"),
-                ("rules_shown_count", "INTEGER DEFAULT 0"),
-                ("rules_indices_today", "TEXT NOT NULL DEFAULT '[]'"),
-                ("sent_expiry_warning", "INTEGER DEFAULT 0"),
-                ("stats_likes", "INTEGER DEFAULT 0"),
-                ("stats_dislikes", "INTEGER DEFAULT 0"),
-                ("demo_count", "INTEGER DEFAULT 1"),
-                ("challenges_today", "INTEGER DEFAULT 0"),
-                ("last_level_checked", "TEXT DEFAULT 'level_0'"),
-                ("referred_by", "INTEGER"),
-                ("created_at", "TEXT"),
-                ("last_broadcast_date", "TEXT"),  # ✅ Защита от дублей рассылки
-            ]
-            
-            for col, definition in cols:
-                try:
-                    await conn.execute(f"ALTER TABLE users ADD COLUMN {col} {definition}")
-                except Exception:
-                    pass  # Колонка уже существует
-            
-            await conn.commit()
-            logger.info("Database: ULTIMATE init complete. All fields and methods ready.")
+        """Инициализация базы: пул соединений и версионные миграции (bot/migrations.py)."""
+        await self.pool.open()
+        if settings.LEADER_ELECTION and self.cache.enabled:
+            # Кэш в памяти процесса: записи других процессов он бы не увидел до TTL
+            logger.warning("Database: user cache disabled, LEADER_ELECTION means several processes share the DB.")
+            self.cache.max_size = 0
+            self.cache.clear()
+        async with self.pool.writer() as conn:
+            version = await run_migrations(self, conn)
+        logger.info(f"Database: ULTIMATE init complete. Schema version {version}.")
+
+        await self.check_query_plans()
+
+        if settings.DB_WRITE_BEHIND and settings.LEADER_ELECTION:
+            # Несколько процессов: отложенные записи одного затирали бы свежие записи другого
+            logger.warning("Database: DB_WRITE_BEHIND ignored, LEADER_ELECTION means several processes share the DB.")
+        elif settings.DB_WRITE_BEHIND:
+            self.enable_write_behind(settings.DB_FLUSH_INTERVAL_MS, settings.DB_FLUSH_MAX_ROWS)
+
+    async def close(self):
+        """Закрытие пула соединений (вызывается при остановке)."""
+        if self._flush_task is not None:
+            # Без cancel(): цикл сам выходит после последнего сброса
+            self._flush_stopping = True
+            self._flush_event.set()
+            await self._flush_task
+            self._flush_task = None
+            self._flush_stopping = False
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Database: final flush failed: {e}")
+        await self.pool.close()
+
+    def pool_stats(self) -> Dict[str, Any]:
+        stats = self.pool.stats()
+        stats["write_behind"] = {
+            "enabled": self._flush_task is not None,
+            "pending": len(self._pending),
+            **self._wb_stats,
+        }
+        stats["user_cache"] = self.cache.snapshot()
+        return stats
 
     def _safe_load(self, val: Any, depth: int = 0) -> Any:
         """Безопасная десериализация JSON."""
@@ -104,8 +440,15 @@ class Database:
     async def add_user(self, user_id: int, username: Optional[str], name: str, language: str = "ru", **kwargs):
         """Добавляет пользователя. Сохраняет дату создания created_at."""
         now = datetime.now().isoformat()
-        
-        async with aiosqlite.connect(self.db_path) as conn:
+
+        # Upsert перезаписывает эти поля — отложенные значения для них устарели
+        for fields in (self._pending.get(user_id), self._inflight.get(user_id)):
+            if fields:
+                for k in ("username", "name", "language"):
+                    fields.pop(k, None)
+        self.cache.invalidate(user_id)
+
+        async with self.pool.writer() as conn:
             await conn.execute('''
                 INSERT INTO users (user_id, username, name, language, created_at)
                 VALUES (?, ?, ?, ?, ?)
@@ -115,6 +458,7 @@ class Database:
                     language=excluded.language
             ''', (user_id, username, name, language, now))
             await conn.commit()
+        self.cache.invalidate(user_id)
         
         if kwargs:
             await self.update_user(user_id, **kwargs)
@@ -122,65 +466,233 @@ class Database:
         return await self.get_user(user_id)
 
     async def get_user(self, user_id: int) -> Optional[Dict[str, Any]]:
-        async with aiosqlite.connect(self.db_path) as conn:
-            conn.row_factory = aiosqlite.Row
-            async with conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)) as cursor:
+        """Строка пользователя: из кэша, иначе из БД (с кэшированием)."""
+        raw = await self._get_raw(user_id)
+        if raw is None:
+            return None
+        for k in JSON_FIELDS:
+            if k in raw:
+                raw[k] = self._safe_load(raw[k])
+        return raw
+
+    async def get_user_fields(self, user_id: int, fields: Iterable[str]) -> Optional[UserRow]:
+        """
+        Только нужные колонки (user_id всегда есть). JSON-колонки разбираются при первом обращении.
+        С кэшем — из полной строки кэша (промах читает её целиком и кладёт в кэш, как get_user),
+        без кэша — SELECT только этих колонок. Пустой fields — вся строка.
+        """
+        fields = tuple(fields)
+        if not fields or self.cache.enabled:
+            raw = await self._get_raw(user_id)
+            if raw is None:
+                return None
+            if not fields:
+                return UserRow(raw, self._safe_load)
+            cols, _ = self._projection(fields)
+            return UserRow({c: raw.get(c) for c in cols}, self._safe_load)
+
+        cols, _ = self._projection(fields)
+        async with self.pool.reader() as conn:
+            async with conn.execute(f"SELECT {', '.join(cols)} FROM users WHERE user_id = ?", (user_id,)) as cursor:
                 row = await cursor.fetchone()
-            if row:
-                d = dict(row)
-                for k in ["challenges", "rules_indices_today", "data", "fsm_data"]:
-                    if k in d:
-                        d[k] = self._safe_load(d.get(k))
-                return d
-        return None
+        if row is None:
+            return None
+        return UserRow(self._apply_pending(user_id, dict(row), only=cols, raw=True), self._safe_load)
+
+    async def _get_raw(self, user_id: int) -> Optional[Dict[str, Any]]:
+        """Полная строка в виде SQLite-значений (JSON не разобран): из кэша или из БД."""
+        cached = self.cache.get(user_id)
+        if cached is not None:
+            return cached
+
+        generation = self.cache.begin_load(user_id)
+        try:
+            async with self.pool.reader() as conn:
+                async with conn.execute('SELECT * FROM users WHERE user_id = ?', (user_id,)) as cursor:
+                    row = await cursor.fetchone()
+        except BaseException:
+            self.cache.cancel_load(user_id)
+            raise
+        if row is None:
+            self.cache.cancel_load(user_id)
+            return None
+        raw = self._apply_pending(user_id, dict(row), raw=True)
+        self.cache.finish_load(user_id, raw, generation)
+        return raw
+
+    def _prepare_fields(self, kwargs: Dict[str, Any]) -> Dict[str, Any]:
+        """Фильтрует поля по белому списку и сериализует JSON-колонки в параметры SQL."""
+        prepared = {}
+        for k, v in kwargs.items():
+            if k not in ALLOWED_FIELDS:
+                continue
+            if k in JSON_FIELDS:
+                if isinstance(v, str):
+                    try:
+                        json.loads(v)
+                        prepared[k] = v
+                    except:
+                        prepared[k] = "[]" if k in JSON_LIST_FIELDS else "{}"
+                elif isinstance(v, (dict, list)):
+                    prepared[k] = json.dumps(v, ensure_ascii=False)
+                else:
+                    prepared[k] = "[]" if k in JSON_LIST_FIELDS else "{}"
+            else:
+                prepared[k] = v
+        return prepared
 
     async def update_user(self, user_id: int, **kwargs):
         """Обновление данных с защитой и валидацией JSON."""
         if not kwargs:
             return
-        
-        ALLOWED_FIELDS = {
-            "username", "name", "language", "timezone", "is_paid", "status", 
-            "demo_expiration", "active", "last_challenge_date", "challenge_accepted",
-            "challenges", "challenge_streak", "fsm_state", "fsm_data",
-            "last_rules_date", "rules_shown_count", "rules_indices_today",
-            "sent_expiry_warning", "stats_likes", "stats_dislikes", "demo_count",
-            "challenges_today", "data", "last_level_checked",
-            "referred_by", "created_at", "last_broadcast_date",
-        }
 
-        JSON_FIELDS = {"challenges", "rules_indices_today", "data", "fsm_data"}
-        safe_kwargs = {k: v for k, v in kwargs.items() if k in ALLOWED_FIELDS}
-        
-        if not safe_kwargs:
+        safe_fields = self._prepare_fields(kwargs)
+        if not safe_fields:
             return
 
-        async with aiosqlite.connect(self.db_path) as conn:
-            params = []
-            sql_parts = []
-            for k, v in safe_kwargs.items():
-                sql_parts.append(f"{k} = ?")
-                if k in JSON_FIELDS:
-                    if isinstance(v, str):
-                        try:
-                            json.loads(v)
-                            params.append(v)
-                        except:
-                            params.append("[]" if k in {"challenges", "rules_indices_today"} else "{}")
-                    elif isinstance(v, (dict, list)):
-                        params.append(json.dumps(v, ensure_ascii=False))
-                    else:
-                        params.append("[]" if k in {"challenges", "rules_indices_today"} else "{}")
-                else:
-                    params.append(v)
-            
-            params.append(user_id)
+        # Write-behind: копим изменения в памяти, сброс делает _flush_loop
+        if self._flush_task is not None:
+            self.cache.update(user_id, safe_fields)
+            self._pending.setdefault(user_id, {}).update(safe_fields)
+            if len(self._pending) >= self._flush_max_rows:
+                self._flush_event.set()
+            return
+
+        async with self.pool.writer() as conn:
+            sql_parts = [f"{k} = ?" for k in safe_fields]
+            params = list(safe_fields.values()) + [user_id]
             await conn.execute(f"UPDATE users SET {', '.join(sql_parts)} WHERE user_id = ?", params)
             await conn.commit()
+        # Кэш — только после успешного commit: несохранённое не должно отдаваться читателям
+        self.cache.update(user_id, safe_fields)
+
+    async def update_users_bulk(self, rows: Iterable[Dict[str, Any]]) -> int:
+        """
+        Массовое обновление: rows — словари с user_id и полями.
+        Всё пишется одной транзакцией через executemany. Возвращает число юзеров.
+        """
+        updates: Dict[int, Dict[str, Any]] = {}
+        for row in rows:
+            fields = dict(row)
+            user_id = fields.pop("user_id", None)
+            safe_fields = self._prepare_fields(fields) if user_id is not None else None
+            if safe_fields:
+                updates.setdefault(user_id, {}).update(safe_fields)
+        if not updates:
+            return 0
+
+        # В режиме write-behind массовые изменения идут той же очередью, что и update_user
+        if self._flush_task is not None:
+            for user_id, fields in updates.items():
+                self.cache.update(user_id, fields)
+                self._pending.setdefault(user_id, {}).update(fields)
+            if len(self._pending) >= self._flush_max_rows:
+                self._flush_event.set()
+            return len(updates)
+
+        async with self.pool.writer() as conn:
+            await self._execute_updates(conn, updates)
+            await conn.commit()
+        for user_id, fields in updates.items():
+            self.cache.update(user_id, fields)
+        return len(updates)
+
+    async def set_field_for_ids(self, field: str, value: Any, ids: Iterable[int], chunk_size: int = 500) -> int:
+        """Одно и то же значение поля для списка юзеров (UPDATE ... WHERE user_id IN (...) пачками)."""
+        ids = list(dict.fromkeys(ids))
+        safe_fields = self._prepare_fields({field: value})
+        if not ids or not safe_fields:
+            return 0
+        value = safe_fields[field]
+
+        if self._flush_task is not None:
+            return await self.update_users_bulk({"user_id": uid, field: value} for uid in ids)
+
+        async with self.pool.writer() as conn:
+            for i in range(0, len(ids), chunk_size):
+                chunk = ids[i:i + chunk_size]
+                marks = ", ".join("?" * len(chunk))
+                await conn.execute(f"UPDATE users SET {field} = ? WHERE user_id IN ({marks})", (value, *chunk))
+            await conn.commit()
+        for user_id in ids:
+            self.cache.update(user_id, safe_fields)
+        return len(ids)
+
+    # ========== ⏳ WRITE-BEHIND (ОТЛОЖЕННАЯ ЗАПИСЬ) ==========
+
+    def enable_write_behind(self, interval_ms: int = 200, max_rows: int = 500):
+        """Включает отложенную запись update_user со сбросом раз в interval_ms или по max_rows юзеров."""
+        if self._flush_task is not None:
+            return
+        self._flush_interval = max(1, interval_ms) / 1000
+        self._flush_max_rows = max(1, max_rows)
+        self._flush_task = asyncio.create_task(self._flush_loop())
+        logger.info(f"Database: write-behind enabled ({interval_ms} ms / {max_rows} rows).")
+
+    async def _flush_loop(self):
+        while not self._flush_stopping:
+            try:
+                await asyncio.wait_for(self._flush_event.wait(), timeout=self._flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_event.clear()
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Database: write-behind flush failed: {e}")
+
+    async def flush(self) -> int:
+        """Сбрасывает накопленные изменения одной транзакцией. Возвращает число юзеров."""
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            self._inflight, self._pending = self._pending, {}
+
+            started = time.perf_counter()
+            try:
+                async with self.pool.writer() as conn:
+                    await self._execute_updates(conn, self._inflight)
+                    await conn.commit()
+            except BaseException:
+                # Возвращаем в очередь, не затирая более свежие изменения
+                for user_id, fields in self._inflight.items():
+                    merged = dict(fields)
+                    merged.update(self._pending.get(user_id, {}))
+                    self._pending[user_id] = merged
+                raise
+            finally:
+                flushed = len(self._inflight)
+                self._inflight = {}
+
+            self._wb_stats["flushes"] += 1
+            self._wb_stats["rows"] += flushed
+            self._wb_stats["last_flush_ms"] = round((time.perf_counter() - started) * 1000, 3)
+            return flushed
+
+    async def _execute_updates(self, conn: aiosqlite.Connection, updates: Dict[int, Dict[str, Any]]):
+        """UPDATE для многих юзеров без commit: executemany требует одинаковый SQL — группируем по набору полей."""
+        groups: Dict[tuple, list] = {}
+        for user_id, fields in updates.items():
+            cols = tuple(sorted(fields))
+            groups.setdefault(cols, []).append([fields[c] for c in cols] + [user_id])
+        for cols, rows in groups.items():
+            sql_parts = ", ".join(f"{c} = ?" for c in cols)
+            await conn.executemany(f"UPDATE users SET {sql_parts} WHERE user_id = ?", rows)
+
+    def _apply_pending(
+        self, user_id: int, d: Dict[str, Any], only: Optional[Iterable[str]] = None, raw: bool = False
+    ) -> Dict[str, Any]:
+        """Накладывает ещё не записанные изменения юзера поверх прочитанной строки (raw — без разбора JSON)."""
+        for src in (self._inflight.get(user_id), self._pending.get(user_id)):
+            if src:
+                for k, v in src.items():
+                    if only is not None and k not in only:
+                        continue
+                    d[k] = self._safe_load(v) if k in JSON_FIELDS and not raw else v
+        return d
 
     async def get_all_users(self) -> Dict[str, Any]:
-        async with aiosqlite.connect(self.db_path) as conn:
-            conn.row_factory = aiosqlite.Row
+        async with self.pool.reader() as conn:
             async with conn.execute('SELECT * FROM users') as cursor:
                 rows = await cursor.fetchall()
         
@@ -190,27 +702,699 @@ class Database:
             for k in ["challenges", "rules_indices_today", "data", "fsm_data"]:
                 if k in d:
                     d[k] = self._safe_load(d.get(k))
-            result[str(r["user_id"])] = d
+            result[str(r["user_id"])] = self._apply_pending(r["user_id"], d)
         return result
 
+    async def iter_users(
+        self,
+        columns: Optional[Iterable[str]] = None,
+        where: str = "",
+        params: tuple = (),
+        batch_size: int = 500,
+    ) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Потоковый обход пользователей пачками (keyset-пагинация по user_id).
+        Декодируются только запрошенные JSON-колонки; соединение не держится между пачками.
+        """
+        cols, json_cols = self._projection(columns)
+        select = ", ".join(cols)
+        cond = f" AND ({where})" if where else ""
+
+        # Условие WHERE должно видеть отложенные изменения
+        if self._pending:
+            await self.flush()
+
+        last_id = None
+        while True:
+            if last_id is None:
+                sql = f"SELECT {select} FROM users WHERE 1 = 1{cond} ORDER BY user_id LIMIT ?"
+                args = (*params, batch_size)
+            else:
+                sql = f"SELECT {select} FROM users WHERE user_id > ?{cond} ORDER BY user_id LIMIT ?"
+                args = (last_id, *params, batch_size)
+
+            async with self.pool.reader() as conn:
+                async with conn.execute(sql, args) as cursor:
+                    rows = await cursor.fetchall()
+            if not rows:
+                return
+
+            for r in rows:
+                yield self._decode_row(r, cols, json_cols)
+
+            if len(rows) < batch_size:
+                return
+            last_id = rows[-1]["user_id"]
+
+    def _projection(self, columns: Optional[Iterable[str]]) -> Tuple[List[str], set]:
+        """Список колонок для SELECT (user_id всегда первым) и JSON-колонки среди них."""
+        if not columns:
+            return ["*"], JSON_FIELDS
+        cols = ["user_id"] + [c for c in dict.fromkeys(columns) if c in USER_COLUMNS and c != "user_id"]
+        return cols, JSON_FIELDS.intersection(cols)
+
+    def _decode_row(self, row: aiosqlite.Row, cols: List[str], json_cols: set) -> Dict[str, Any]:
+        """Строка users -> dict с декодированными JSON-полями и отложенными изменениями."""
+        d = dict(row)
+        for k in json_cols:
+            if k in d:
+                d[k] = self._safe_load(d[k])
+        return self._apply_pending(d["user_id"], d, only=None if cols == ["*"] else cols)
+
     async def delete_user(self, user_id: int):
         """Для тестов: полное удаление."""
-        async with aiosqlite.connect(self.db_path) as conn:
+        self._pending.pop(user_id, None)
+        async with self.pool.writer() as conn:
             await conn.execute('DELETE FROM users WHERE user_id = ?', (user_id,))
+            await conn.execute('DELETE FROM challenge_history WHERE user_id = ?', (user_id,))
+            await conn.execute('DELETE FROM due_reminders WHERE user_id = ?', (user_id,))
+            await conn.execute('DELETE FROM send_plan WHERE user_id = ?', (user_id,))
             await conn.commit()
+            # После commit: чтение, начатое до удаления, получит новое поколение и строку не вернёт в кэш
+            self.cache.invalidate(user_id)
             logger.warning(f"Database: User {user_id} deleted (Test mode).")
 
+    # ========== ⚔️ ИСТОРИЯ ЧЕЛЛЕНДЖЕЙ ==========
+
+    async def _migrate_challenges_json(self, conn: aiosqlite.Connection):
+        """Разовый перенос JSON-колонки users.challenges в challenge_history."""
+        async with conn.execute(
+            "SELECT user_id, challenges FROM users WHERE challenges IS NOT NULL AND challenges NOT IN ('', '[]')"
+        ) as cursor:
+            rows = await cursor.fetchall()
+        if not rows:
+            return
+
+        history = []
+        for r in rows:
+            items = self._safe_load(r["challenges"])
+            if not isinstance(items, list):
+                continue
+            for item in items:
+                if isinstance(item, dict) and item.get("date"):
+                    history.append((
+                        r["user_id"], item["date"], item.get("text"),
+                        item.get("accepted"), item.get("completed"),
+                    ))
+
+        # При нескольких записях за день побеждает последняя
+        await conn.executemany('''
+            INSERT INTO challenge_history (user_id, day, text, accepted_at, completed_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(user_id, day) DO UPDATE SET
+                text=excluded.text,
+                accepted_at=excluded.accepted_at,
+                completed_at=COALESCE(excluded.completed_at, challenge_history.completed_at)
+        ''', history)
+        await conn.executemany(
+            "UPDATE users SET challenges = '[]' WHERE user_id = ?",
+            [(r["user_id"],) for r in rows]
+        )
+        logger.info(f"Database: migrated {len(history)} challenges of {len(rows)} users to challenge_history.")
+
+    async def _migrate_pending_followups(self, conn: aiosqlite.Connection):
+        """Недавно принятые и не выполненные челленджи → due_reminders (чтобы не потерять напоминания при обновлении)."""
+        since = (datetime.now(timezone.utc) - CHALLENGE_FOLLOWUP_DELAY - FOLLOWUP_MAX_DELAY).isoformat()
+        async with conn.execute(
+            "SELECT user_id, day, accepted_at FROM challenge_history WHERE completed_at IS NULL AND accepted_at > ?",
+            (since,)
+        ) as cursor:
+            rows = await cursor.fetchall()
+        reminders = []
+        for r in rows:
+            try:
+                accepted = datetime.fromisoformat(r["accepted_at"])
+            except (TypeError, ValueError):
+                continue
+            reminders.append((r["user_id"], (accepted + CHALLENGE_FOLLOWUP_DELAY).isoformat(), r["day"]))
+        await conn.executemany(
+            "INSERT OR IGNORE INTO due_reminders (user_id, kind, due_at, ref) VALUES (?, 'challenge_followup', ?, ?)",
+            reminders
+        )
+
+    async def get_challenge(self, user_id: int, day: str) -> Optional[Dict[str, Any]]:
+        """Челлендж пользователя за день (поиск по первичному ключу)."""
+        async with self.pool.reader() as conn:
+            async with conn.execute(
+                "SELECT * FROM challenge_history WHERE user_id = ? AND day = ?", (user_id, day)
+            ) as cursor:
+                row = await cursor.fetchone()
+        return dict(row) if row else None
+
+    async def accept_challenge(self, user_id: int, day: str, text_idx: Optional[int], text: str):
+        """Фиксирует принятый челлендж дня (повторное принятие перезаписывает строку) и ставит напоминание."""
+        now = datetime.now(timezone.utc)
+        async with self.pool.writer() as conn:
+            await conn.execute('''
+                INSERT INTO challenge_history (user_id, day, text_idx, text, accepted_at, completed_at)
+                VALUES (?, ?, ?, ?, ?, NULL)
+                ON CONFLICT(user_id, day) DO UPDATE SET
+                    text_idx=excluded.text_idx,
+                    text=excluded.text,
+                    accepted_at=excluded.accepted_at,
+                    completed_at=NULL
+            ''', (user_id, day, text_idx, text, now.isoformat()))
+            # Напоминание через час — строкой со сроком, её заберёт challenge_followup_job
+            await conn.execute('''
+                INSERT INTO due_reminders (user_id, kind, due_at, ref) VALUES (?, 'challenge_followup', ?, ?)
+                ON CONFLICT(user_id, kind) DO UPDATE SET due_at=excluded.due_at, ref=excluded.ref
+            ''', (user_id, (now + CHALLENGE_FOLLOWUP_DELAY).isoformat(), day))
+            await conn.commit()
+
+    async def complete_challenge(self, user_id: int, day: str) -> bool:
+        """Отмечает челлендж выполненным. False — если уже выполнен или не найден."""
+        async with self.pool.writer() as conn:
+            cursor = await conn.execute(
+                "UPDATE challenge_history SET completed_at = ? WHERE user_id = ? AND day = ? AND completed_at IS NULL",
+                (datetime.now(timezone.utc).isoformat(), user_id, day)
+            )
+            done = cursor.rowcount == 1
+            if done:
+                await conn.execute(
+                    "DELETE FROM due_reminders WHERE user_id = ? AND kind = 'challenge_followup' AND ref = ?",
+                    (user_id, day)
+                )
+            await conn.commit()
+            return done
+
+    async def get_challenge_counts(self, user_id: int) -> Dict[str, int]:
+        """Количество принятых и выполненных челленджей (для профиля)."""
+        async with self.pool.reader() as conn:
+            async with conn.execute(
+                "SELECT COUNT(*), COUNT(completed_at) FROM challenge_history WHERE user_id = ?", (user_id,)
+            ) as cursor:
+                res = await cursor.fetchone()
+        return {"accepted": res[0] if res else 0, "completed": res[1] if res else 0}
+
+    async def clear_challenge_history(self, user_id: int):
+        """Сброс истории челленджей (новый демо-цикл, сброс из админки)."""
+        async with self.pool.writer() as conn:
+            await conn.execute("DELETE FROM challenge_history WHERE user_id = ?", (user_id,))
+            await conn.execute("DELETE FROM due_reminders WHERE user_id = ?", (user_id,))
+            await conn.commit()
+
+    # ========== 🎯 ВЫБОРКИ ДЛЯ ПЛАНИРОВЩИКА ==========
+
+    async def get_expiring_demos(self, start: str, end: str) -> List[Dict[str, Any]]:
+        """Неоплаченные демо, истекающие в (start, end], без отправленного предупреждения."""
+        if self._pending:
+            await self.flush()
+        async with self.pool.reader() as conn:
+            async with conn.execute(SQL_EXPIRING_DEMOS, (start, end)) as cursor:
+                rows = await cursor.fetchall()
+        return [dict(r) for r in rows]
+
+    async def get_timezone_buckets(self) -> Dict[Optional[str], int]:
+        """Часовые пояса активных пользователей с числом юзеров (GROUP BY по индексу idx_active_timezone)."""
+        if self._pending:
+            await self.flush()
+        async with self.pool.reader() as conn:
+            async with conn.execute(SQL_TIMEZONE_BUCKETS) as cursor:
+                rows = await cursor.fetchall()
+        return {r[0]: r[1] for r in rows}
+
+    async def get_users_in_timezones(
+        self,
+        timezones: Iterable[Optional[str]],
+        columns: Optional[Iterable[str]] = None,
+        where: str = "",
+        params: tuple = (),
+    ) -> List[Dict[str, Any]]:
+        """
+        Активные пользователи из указанных часовых поясов (поиск по idx_active_timezone).
+        None в списке поясов означает пользователей без timezone.
+        """
+        zones = list(dict.fromkeys(timezones))
+        named = [z for z in zones if z is not None]
+        cols, json_cols = self._projection(columns)
+        select = ", ".join(cols)
+        cond = f" AND ({where})" if where else ""
+
+        queries = []
+        if named:
+            marks = ", ".join("?" * len(named))
+            queries.append((f"SELECT {select} FROM users WHERE active = 1 AND timezone IN ({marks}){cond}", (*named, *params)))
+        if len(named) != len(zones):
+            queries.append((f"SELECT {select} FROM users WHERE active = 1 AND timezone IS NULL{cond}", params))
+        if not queries:
+            return []
+
+        if self._pending:
+            await self.flush()
+        result = []
+        async with self.pool.reader() as conn:
+            for sql, args in queries:
+                async with conn.execute(sql, args) as cursor:
+                    result.extend(self._decode_row(r, cols, json_cols) for r in await cursor.fetchall())
+        return result
+
+    async def take_due_followups(self, now: str, since: str) -> List[Dict[str, Any]]:
+        """
+        Забирает наступившие напоминания «через час» (срок в (since, now]) и удаляет все строки
+        со сроком <= now — в одной транзакции писателя, так что каждое уходит не больше одного раза.
+        Просроченные (бот стоял дольше окна) удаляются без отправки.
+        """
+        if self._pending:
+            await self.flush()
+        async with self.pool.writer() as conn:
+            async with conn.execute(SQL_DUE_FOLLOWUPS, (since, now)) as cursor:
+                rows = await cursor.fetchall()
+            await conn.execute(
+                "DELETE FROM due_reminders WHERE kind = 'challenge_followup' AND due_at <= ?", (now,)
+            )
+            await conn.commit()
+        return [dict(r) for r in rows]
+
+    async def explain(self, sql: str, params: tuple = ()) -> List[str]:
+        """План запроса (EXPLAIN QUERY PLAN) в виде списка строк."""
+        # Через писателя: читатели, открытые до миграций, могут держать старую схему
+        async with self.pool.writer() as conn:
+            async with conn.execute(f"EXPLAIN QUERY PLAN {sql}", params) as cursor:
+                rows = await cursor.fetchall()
+        return [r["detail"] for r in rows]
+
+    async def check_query_plans(self) -> Dict[str, List[str]]:
+        """
+        Проверка, что выборки планировщика идут по индексам, а не полным сканом.
+        Полный SCAN таблицы пишется в лог как предупреждение.
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        checks = {
+            "expiring_demos": (SQL_EXPIRING_DEMOS, (now, now)),
+            "timezone_buckets": (SQL_TIMEZONE_BUCKETS, ()),
+            "users_in_timezones": (
+                "SELECT user_id FROM users WHERE active = 1 AND timezone IN (?, ?)", ("UTC", "Europe/Kyiv")
+            ),
+            "due_followups": (SQL_DUE_FOLLOWUPS, (now, now)),
+            "due_plan": (SQL_DUE_PLAN.format(columns="u.name"), (now, now, 500)),
+            "outbox_open": (
+                "SELECT id FROM broadcast_outbox WHERE status = 'pending' ORDER BY id LIMIT ?", (100,)
+            ),
+            "no_challenge_today": (
+                f"SELECT user_id FROM users WHERE active = 1 AND timezone IN (?) AND {SQL_NO_CHALLENGE_ON_DAY}",
+                ("UTC", now[:10])
+            ),
+        }
+        plans = {}
+        for name, (sql, params) in checks.items():
+            plan = await self.explain(sql, params)
+            plans[name] = plan
+            full_scans = [p for p in plan if p.startswith("SCAN") and "USING" not in p]
+            if full_scans:
+                logger.warning(f"Database: query '{name}' does a full scan: {'; '.join(full_scans)}")
+            else:
+                logger.info(f"Database: query '{name}' plan: {'; '.join(plan)}")
+        return plans
+
+    # ========== 🗓️ ПЛАН ОТПРАВОК (SEND_PLAN) ==========
+
+    async def add_plan_rows(self, rows: Iterable[Tuple[int, str, str, Optional[str]]], chunk_size: int = 5000) -> int:
+        """Строки плана (user_id, due_utc, kind, payload_key); уже запланированные игнорируются. Возвращает число новых."""
+        rows = list(rows)
+        added = 0
+        async with self.pool.writer() as conn:
+            for i in range(0, len(rows), chunk_size):
+                before = conn.total_changes
+                await conn.executemany(
+                    "INSERT OR IGNORE INTO send_plan (user_id, due_utc, kind, payload_key) VALUES (?, ?, ?, ?)",
+                    rows[i:i + chunk_size]
+                )
+                await conn.commit()
+                added += conn.total_changes - before
+        return added
+
+    async def get_due_plan(
+        self, since: str, now: str, columns: Iterable[str], limit: int = 500
+    ) -> List[Dict[str, Any]]:
+        """Наступившие строки плана (due_utc в (since, now]) вместе с нужными колонками users."""
+        cols, json_cols = self._projection(columns)
+        select = ", ".join(f"u.{c}" for c in cols)
+        if self._pending:
+            await self.flush()
+        async with self.pool.reader() as conn:
+            async with conn.execute(SQL_DUE_PLAN.format(columns=select), (since, now, limit)) as cursor:
+                rows = await cursor.fetchall()
+        result = []
+        for r in rows:
+            d = self._decode_row(r, cols, json_cols)
+            for k in ("plan_id", "due_utc", "kind", "payload_key"):
+                d[k] = r[k]
+            result.append(d)
+        return result
+
+    async def delete_plan_rows(self, ids: Iterable[int], chunk_size: int = 500) -> int:
+        ids = list(ids)
+        async with self.pool.writer() as conn:
+            for i in range(0, len(ids), chunk_size):
+                chunk = ids[i:i + chunk_size]
+                await conn.execute(f"DELETE FROM send_plan WHERE id IN ({', '.join('?' * len(chunk))})", chunk)
+            await conn.commit()
+        return len(ids)
+
+    async def drop_overdue_plan(self, before: str) -> int:
+        """Удаляет строки плана со сроком <= before (бот стоял, время отправки прошло)."""
+        async with self.pool.writer() as conn:
+            cursor = await conn.execute("DELETE FROM send_plan WHERE due_utc <= ?", (before,))
+            await conn.commit()
+            return cursor.rowcount
+
+    async def get_plan_summary(self, start: str, end: str) -> Dict[str, Any]:
+        """Объём плана в [start, end): по типам и по UTC-часам (предпросмотр в админке)."""
+        async with self.pool.reader() as conn:
+            async with conn.execute('''
+                SELECT kind, payload_key, substr(due_utc, 1, 13) AS hour, COUNT(*) AS n
+                FROM send_plan WHERE due_utc >= ? AND due_utc < ?
+                GROUP BY kind, payload_key, hour
+            ''', (start, end)) as cursor:
+                rows = await cursor.fetchall()
+        summary: Dict[str, Any] = {"total": 0, "by_kind": {}, "by_hour": {}}
+        for r in rows:
+            key = f"{r['kind']}:{r['payload_key']}" if r["payload_key"] else r["kind"]
+            summary["total"] += r["n"]
+            summary["by_kind"][key] = summary["by_kind"].get(key, 0) + r["n"]
+            summary["by_hour"][r["hour"]] = summary["by_hour"].get(r["hour"], 0) + r["n"]
+        return summary
+
+    async def get_users_with_challenge(self, day: str, user_ids: Iterable[int], chunk_size: int = 500) -> set:
+        """Кто из user_ids уже принимал челлендж в этот день (поиск по первичному ключу challenge_history)."""
+        ids = list(user_ids)
+        found = set()
+        async with self.pool.reader() as conn:
+            for i in range(0, len(ids), chunk_size):
+                chunk = ids[i:i + chunk_size]
+                async with conn.execute(
+                    f"SELECT user_id FROM challenge_history WHERE day = ? AND user_id IN ({', '.join('?' * len(chunk))})",
+                    (day, *chunk)
+                ) as cursor:
+                    found.update(r[0] for r in await cursor.fetchall())
+        return found
+
+    # ========== 📮 ОЧЕРЕДЬ РАССЫЛОК (OUTBOX) ==========
+    # Статусы: pending → sending → sent / failed; expired — не успели отправить вовремя
+
+    async def enqueue_outbox(self, run_id: str, items: Iterable[Dict[str, Any]]) -> int:
+        """
+        Ставит сообщения в очередь: items — словари user_id, text, reply_markup (JSON или None).
+        Повтор того же run_id для пользователя игнорируется (UNIQUE). Возвращает число новых строк.
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        rows = [(run_id, i["user_id"], i["text"], i.get("reply_markup"), now) for i in items]
+        if not rows:
+            return 0
+        async with self.pool.writer() as conn:
+            before = conn.total_changes
+            await conn.executemany(
+                "INSERT OR IGNORE INTO broadcast_outbox (run_id, user_id, text, reply_markup, created_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            await conn.commit()
+            return conn.total_changes - before
+
+    async def claim_outbox(self, limit: int, run_id: Optional[str] = None) -> Tuple[List[Dict[str, Any]], int]:
+        """
+        Забирает до limit ожидающих строк одним UPDATE ... RETURNING: pending → sending,
+        а строки неактивных пользователей (active = 0) сразу → skipped, без запроса к Telegram.
+        Возвращает (строки для отправки, сколько строк затронуто). Пачка может целиком уйти
+        в skipped — тогда строк для отправки нет, но очередь ещё не пуста: конец — только при 0.
+        """
+        cond = " AND o.run_id = :run_id" if run_id is not None else ""
+        params = {"now": datetime.now(timezone.utc).isoformat(), "run_id": run_id, "limit": limit}
+        async with self.pool.writer() as conn:
+            async with conn.execute(f'''
+                WITH c AS (
+                    SELECT o.id, IFNULL(u.active, 1) != 0 AS live, u.blocked_reason
+                    FROM broadcast_outbox o LEFT JOIN users u ON u.user_id = o.user_id
+                    WHERE o.status = 'pending'{cond} ORDER BY o.id LIMIT :limit
+                )
+                UPDATE broadcast_outbox SET
+                    status = CASE WHEN c.live THEN 'sending' ELSE 'skipped' END,
+                    error = CASE WHEN c.live THEN NULL ELSE IFNULL(c.blocked_reason, 'inactive') END,
+                    attempts = attempts + c.live,
+                    claimed_at = :now,
+                    finished_at = CASE WHEN c.live THEN NULL ELSE :now END
+                FROM c WHERE c.id = broadcast_outbox.id
+                RETURNING broadcast_outbox.id, run_id, user_id, text, reply_markup, status, error
+            ''', params) as cursor:
+                rows = await cursor.fetchall()
+            await conn.commit()
+        claimed = []
+        for r in rows:
+            if r["status"] == "sending":
+                claimed.append(dict(r))
+            elif r["error"] != "inactive":
+                self._delivery_stats["sends_avoided"] += 1
+        # RETURNING не гарантирует порядок строк
+        return sorted(claimed, key=lambda r: r["id"]), len(rows)
+
+    async def finish_outbox(self, results: Iterable[Tuple[int, bool, Optional[str]]]) -> int:
+        """Отмечает строки (id, ok, error) как sent или failed с текстом ошибки Telegram."""
+        now = datetime.now(timezone.utc).isoformat()
+        rows = [("sent" if ok else "failed", None if ok else error, now, row_id) for row_id, ok, error in results]
+        if not rows:
+            return 0
+        async with self.pool.writer() as conn:
+            await conn.executemany(
+                "UPDATE broadcast_outbox SET status = ?, error = ?, finished_at = ? WHERE id = ? AND status = 'sending'",
+                rows
+            )
+            await conn.commit()
+        return len(rows)
+
+    async def recover_outbox(self, expire_before: str) -> Dict[str, int]:
+        """
+        После рестарта: строки, застрявшие в sending, возвращаются в pending
+        (сообщение могло уйти — возможен один дубль на строку), а pending старше expire_before
+        помечаются expired, чтобы не слать утреннюю фразу вечером.
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        async with self.pool.writer() as conn:
+            cursor = await conn.execute(
+                "UPDATE broadcast_outbox SET status = 'pending' WHERE status = 'sending'"
+            )
+            requeued = cursor.rowcount
+            cursor = await conn.execute(
+                "UPDATE broadcast_outbox SET status = 'expired', finished_at = ? "
+                "WHERE status = 'pending' AND created_at < ?",
+                (now, expire_before)
+            )
+            expired = cursor.rowcount
+            await conn.commit()
+        return {"requeued": requeued, "expired": expired}
+
+    async def get_outbox_stats(self, run_id: Optional[str] = None) -> Dict[str, int]:
+        """Количество строк по статусам (для запуска или всей очереди)."""
+        sql = "SELECT status, COUNT(*) FROM broadcast_outbox"
+        params: tuple = ()
+        if run_id is not None:
+            sql += " WHERE run_id = ?"
+            params = (run_id,)
+        async with self.pool.reader() as conn:
+            async with conn.execute(f"{sql} GROUP BY status", params) as cursor:
+                rows = await cursor.fetchall()
+        return {r[0]: r[1] for r in rows}
+
+    async def cleanup_outbox(self, before: str) -> int:
+        """Удаляет завершённые строки, созданные раньше before."""
+        async with self.pool.writer() as conn:
+            cursor = await conn.execute(
+                "DELETE FROM broadcast_outbox WHERE status NOT IN ('pending', 'sending') AND created_at < ?",
+                (before,)
+            )
+            await conn.commit()
+            return cursor.rowcount
+
+    # ========== 🪦 DEAD LETTERS (НЕДОСТАВЛЕННОЕ) ==========
+
+    async def add_dead_letters(self, source: str, items: Iterable[Dict[str, Any]]) -> int:
+        """items — словари user_id, text, reply_markup (JSON или None), error, attempts."""
+        now = datetime.now(timezone.utc).isoformat()
+        rows = [
+            (source, i["user_id"], i["text"], i.get("reply_markup"), i.get("error"), i.get("attempts", 0), now)
+            for i in items
+        ]
+        if not rows:
+            return 0
+        async with self.pool.writer() as conn:
+            await conn.executemany(
+                "INSERT INTO dead_letters (source, user_id, text, reply_markup, error, attempts, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                rows
+            )
+            await conn.commit()
+        return len(rows)
+
+    async def get_dead_letters(self, limit: int = 100, replayed: bool = False) -> List[Dict[str, Any]]:
+        """Последние записи (по умолчанию только ещё не переотправленные)."""
+        cond = "" if replayed else " WHERE replayed_at IS NULL"
+        async with self.pool.reader() as conn:
+            async with conn.execute(
+                f"SELECT * FROM dead_letters{cond} ORDER BY id DESC LIMIT ?", (limit,)
+            ) as cursor:
+                return [dict(r) for r in await cursor.fetchall()]
+
+    async def get_dead_letter_stats(self) -> Dict[str, int]:
+        """Непереотправленные записи по тексту ошибки."""
+        async with self.pool.reader() as conn:
+            async with conn.execute(
+                "SELECT IFNULL(error, ''), COUNT(*) FROM dead_letters WHERE replayed_at IS NULL GROUP BY 1"
+            ) as cursor:
+                return {r[0]: r[1] for r in await cursor.fetchall()}
+
+    async def replay_dead_letters(self, run_id: str, ids: Optional[List[int]] = None) -> int:
+        """
+        Переносит записи (ids или все непереотправленные) в outbox как run_id:<id> и отмечает replayed_at.
+        Одна транзакция: запись не может попасть в очередь дважды. Возвращает число поставленных строк.
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        cond, params = "replayed_at IS NULL", []
+        if ids is not None:
+            if not ids:
+                return 0
+            cond += f" AND id IN ({', '.join('?' * len(ids))})"
+            params = list(ids)
+        async with self.pool.writer() as conn:
+            before = conn.total_changes
+            await conn.execute(
+                "INSERT OR IGNORE INTO broadcast_outbox (run_id, user_id, text, reply_markup, created_at) "
+                f"SELECT ? || ':' || id, user_id, text, reply_markup, ? FROM dead_letters WHERE {cond} ORDER BY id",
+                (run_id, now, *params)
+            )
+            queued = conn.total_changes - before
+            await conn.execute(f"UPDATE dead_letters SET replayed_at = ? WHERE {cond}", (now, *params))
+            await conn.commit()
+        return queued
+
+    async def cleanup_dead_letters(self, before: str) -> int:
+        async with self.pool.writer() as conn:
+            cursor = await conn.execute("DELETE FROM dead_letters WHERE created_at < ?", (before,))
+            await conn.commit()
+            return cursor.rowcount
+
+    # ========== 🔒 АРЕНДА ЗАДАЧ И ЖУРНАЛ ЗАПУСКОВ ==========
+
+    async def acquire_lease(self, job_id: str, holder: str, ttl: float, now: Optional[datetime] = None) -> bool:
+        """
+        Берёт аренду job_id на ttl секунд, если она свободна, истекла или уже наша (тогда продлевает).
+        Один UPSERT: два процесса не могут получить аренду одновременно.
+        """
+        now = now or datetime.now(timezone.utc)
+        async with self.pool.writer() as conn:
+            before = conn.total_changes
+            await conn.execute('''
+                INSERT INTO job_leases (job_id, holder, acquired_at, expires_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(job_id) DO UPDATE SET
+                    holder = excluded.holder,
+                    acquired_at = CASE WHEN job_leases.holder = excluded.holder
+                                       THEN job_leases.acquired_at ELSE excluded.acquired_at END,
+                    expires_at = excluded.expires_at
+                WHERE job_leases.holder = excluded.holder OR job_leases.expires_at <= excluded.acquired_at
+            ''', (job_id, holder, now.isoformat(), (now + timedelta(seconds=ttl)).isoformat()))
+            await conn.commit()
+            return conn.total_changes > before
+
+    async def release_lease(self, job_id: str, holder: str):
+        """Отпускает аренду, только если она наша."""
+        async with self.pool.writer() as conn:
+            await conn.execute("DELETE FROM job_leases WHERE job_id = ? AND holder = ?", (job_id, holder))
+            await conn.commit()
+
+    async def get_leases(self) -> List[Dict[str, Any]]:
+        async with self.pool.reader() as conn:
+            async with conn.execute("SELECT * FROM job_leases ORDER BY job_id") as cursor:
+                return [dict(r) for r in await cursor.fetchall()]
+
+    async def add_job_run(self, run: Dict[str, Any]):
+        """run — словарь с колонками job_runs (без id)."""
+        cols = [c for c in (
+            "job_id", "holder", "status", "started_at", "finished_at", "duration_ms",
+            "rows_scanned", "messages_sent", "error",
+        ) if c in run]
+        async with self.pool.writer() as conn:
+            await conn.execute(
+                f"INSERT INTO job_runs ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+                [run[c] for c in cols]
+            )
+            await conn.commit()
+
+    async def get_job_run_stats(self, since: str) -> List[Dict[str, Any]]:
+        """Сводка по задачам с since: запуски, пропуски, ошибки, время, просмотренные строки и отправки."""
+        async with self.pool.reader() as conn:
+            async with conn.execute('''
+                SELECT job_id,
+                       SUM(status = 'ok') AS ok, SUM(status = 'error') AS errors, SUM(status = 'skipped') AS skipped,
+                       ROUND(AVG(duration_ms), 1) AS avg_ms, ROUND(MAX(duration_ms), 1) AS max_ms,
+                       ROUND(SUM(duration_ms), 1) AS total_ms,
+                       SUM(rows_scanned) AS rows_scanned, SUM(messages_sent) AS messages_sent,
+                       MAX(started_at) AS last_started
+                FROM job_runs WHERE started_at >= ? GROUP BY job_id ORDER BY total_ms DESC
+            ''', (since,)) as cursor:
+                return [dict(r) for r in await cursor.fetchall()]
+
+    async def get_job_runs(self, limit: int = 50, job_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        cond, params = ("WHERE job_id = ? ", (job_id, limit)) if job_id else ("", (limit,))
+        async with self.pool.reader() as conn:
+            async with conn.execute(f"SELECT * FROM job_runs {cond}ORDER BY id DESC LIMIT ?", params) as cursor:
+                return [dict(r) for r in await cursor.fetchall()]
+
+    async def cleanup_job_runs(self, before: str) -> int:
+        async with self.pool.writer() as conn:
+            cursor = await conn.execute("DELETE FROM job_runs WHERE started_at < ?", (before,))
+            await conn.commit()
+            return cursor.rowcount
+
+    # ========== 🚫 БЛОКИРОВКИ БОТА ==========
+
+    async def mark_blocked(self, user_id: int, reason: str):
+        """
+        Пользователь недоступен (Forbidden и т.п.): active = 0 + причина и время, рассылки его пропускают.
+        Прежнее active запоминается в active_before_block (только при первой отметке).
+        """
+        fields: Dict[str, Any] = {
+            "active": False, "blocked_reason": reason, "blocked_at": datetime.now(timezone.utc).isoformat(),
+        }
+        row = await self.get_user_fields(user_id, ("active", "blocked_at"))
+        if row is not None and not row.get("blocked_at"):
+            fields["active_before_block"] = row.get("active")
+        await self.update_user(user_id, **fields)
+        self._delivery_stats["blocked_marked"] += 1
+        logger.info(f"Database: user {user_id} marked inactive ({reason}).")
+
+    async def mark_unblocked(self, user_id: int) -> Any:
+        """
+        Пользователь снова доступен: снимает отметку блокировки и возвращает active к значению
+        до неё (неактивный или в "Дне тишины" не становится активным). Возвращает итоговое active.
+        """
+        row = await self.get_user_fields(user_id, ("active", "status", "blocked_at", "active_before_block"))
+        if row is None or not row.get("blocked_at"):
+            return row.get("active") if row is not None else None
+        active = row.get("active_before_block")
+        if active is None:
+            # Заблокирован до появления active_before_block: активен, если не "День тишины"
+            active = 0 if row.get("status") == "cooldown" else 1
+        await self.update_user(user_id, active=active, blocked_reason=None, blocked_at=None, active_before_block=None)
+        self._delivery_stats["unblocked"] += 1
+        logger.info(f"Database: user {user_id} unblocked (active={active}).")
+        return active
+
+    def count_avoided_sends(self, n: int = 1):
+        """Учёт отправок, не сделанных заблокировавшим бота пользователям (вне outbox)."""
+        self._delivery_stats["sends_avoided"] += n
+
+    def delivery_stats(self) -> Dict[str, int]:
+        return dict(self._delivery_stats)
+
     # ========== 📊 МЕТОДЫ СТАТИСТИКИ ==========
     
     async def get_total_users_count(self) -> int:
-        async with aiosqlite.connect(self.db_path) as conn:
+        async with self.pool.reader() as conn:
             async with conn.execute("SELECT COUNT(*) FROM users") as cursor:
                 res = await cursor.fetchone()
                 return res[0] if res else 0
 
     async def get_active_users_count(self, days: int = 7) -> int:
         limit = (datetime.now() - timedelta(days=days)).date().isoformat()
-        async with aiosqlite.connect(self.db_path) as conn:
+        async with self.pool.reader() as conn:
             async with conn.execute(
                 "SELECT COUNT(*) FROM users WHERE active = 1 AND last_challenge_date >= ?", 
                 (limit,)
@@ -219,7 +1403,7 @@ class Database:
                 return res[0] if res else 0
 
     async def get_referrals_count(self, user_id: int) -> int:
-        async with aiosqlite.connect(self.db_path) as conn:
+        async with self.pool.reader() as conn:
             async with conn.execute("SELECT COUNT(*) FROM users WHERE referred_by = ?", (user_id,)) as cursor:
                 res = await cursor.fetchone()
                 return res[0] if res else 0
@@ -234,8 +1418,8 @@ class Database:
         if upd: await self.update_user(user_id, **upd)
 
     async def get_fsm_storage(self, user_id: int) -> Dict[str, Any]:
-        """Получение состояния FSM для aiogram."""
-        u = await self.get_user(user_id)
+        """Получение состояния FSM для aiogram (читает только fsm_state/fsm_data)."""
+        u = await self.get_user_fields(user_id, ("fsm_state", "fsm_data"))
         if u:
             return {"state": u.get("fsm_state"), "data": u.get("fsm_data") or {}}
         return {"state": None, "data": {}}
@@ -244,13 +1428,20 @@ class Database:
     
     async def execute(self, sql: str, params: tuple = ()):
         """Прямой SQL запрос."""
-        async with aiosqlite.connect(self.db_path) as conn:
+        async with self.pool.writer() as conn:
             await conn.execute(sql, params)
             await conn.commit()
+        # Что именно изменил произвольный SQL, неизвестно — сбрасываем кэш целиком
+        self.cache.clear()
 
     async def commit(self):
         """Пустой метод для совместимости."""
         pass
 
 # Инициализация глобального экземпляра БД
-db = Database(str(settings.DB_FILE))
\ No newline at end of file
+db = Database(
+    str(settings.DB_FILE),
+    readers=settings.DB_POOL_READERS,
+    cache_size=settings.USER_CACHE_SIZE,
+    cache_ttl=settings.USER_CACHE_TTL,
+)
\ No newline at end of file
@@ -0,0 +1,141 @@
+# 18 - bot/jobs.py
+# ✅ Аренда задач планировщика в SQLite (job_leases): один запуск задачи за раз на все процессы
+# ✅ Аренда продлевается, пока задача работает; пересекающийся запуск пропускается и считается
+# ✅ Журнал запусков (job_runs): начало, конец, длительность, просмотрено строк, отправлено сообщений
+# ✅ Метрики пропусков APScheduler (max_instances, misfire) для health check
+
+import asyncio
+import contextvars
+import functools
+import os
+import socket
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from apscheduler.events import EVENT_JOB_MAX_INSTANCES, EVENT_JOB_MISSED, JobEvent
+
+from bot.config import logger, settings
+from bot.database import db
+
+# Кто держит аренду: машина Fly (hostname) + процесс
+HOLDER = f"{socket.gethostname()}:{os.getpid()}"
+
+# Общие параметры задач APScheduler: без наложений, пропущенные запуски схлопываются в один
+JOB_DEFAULTS = {"max_instances": 1, "coalesce": True, "misfire_grace_time": 30}
+
+# ========== 📊 МЕТРИКИ ==========
+
+@dataclass
+class JobRun:
+    """Счётчики текущего запуска: задача пополняет их через note_job."""
+    job_id: str
+    rows_scanned: int = 0
+    messages_sent: int = 0
+
+_current_run: contextvars.ContextVar[Optional[JobRun]] = contextvars.ContextVar("current_job_run", default=None)
+
+# С момента старта процесса, по задачам
+_metrics: Dict[str, Dict[str, Any]] = {}
+
+def _metric(job_id: str) -> Dict[str, Any]:
+    return _metrics.setdefault(job_id, {
+        "runs": 0, "errors": 0, "skipped_lease": 0, "skipped_overlap": 0, "missed": 0, "last_ms": 0.0,
+    })
+
+def job_metrics() -> Dict[str, Dict[str, Any]]:
+    return {job_id: dict(m) for job_id, m in _metrics.items()}
+
+def note_job(scanned: int = 0, sent: int = 0):
+    """Учёт работы внутри задачи (вне аренды, например при прямом вызове, ничего не делает)."""
+    run = _current_run.get()
+    if run is not None:
+        run.rows_scanned += scanned
+        run.messages_sent += sent
+
+def on_scheduler_event(event: JobEvent):
+    """Слушатель APScheduler: запуск не начался, потому что прошлый ещё идёт или опоздал."""
+    if event.code == EVENT_JOB_MAX_INSTANCES:
+        _metric(event.job_id)["skipped_overlap"] += 1
+        logger.warning(f"Jobs: {event.job_id} skipped, previous run is still going.")
+    elif event.code == EVENT_JOB_MISSED:
+        _metric(event.job_id)["missed"] += 1
+        logger.warning(f"Jobs: {event.job_id} missed its run time.")
+
+SCHEDULER_EVENTS = EVENT_JOB_MAX_INSTANCES | EVENT_JOB_MISSED
+
+# ========== 🔒 АРЕНДА ==========
+
+async def _renew(job_id: str, ttl: float, lost: asyncio.Event):
+    """Продлевает аренду каждые ttl/3 секунд, пока задача работает."""
+    while True:
+        await asyncio.sleep(ttl / 3)
+        try:
+            if not await db.acquire_lease(job_id, HOLDER, ttl):
+                lost.set()
+                logger.error(f"Jobs: lease for {job_id} was taken over while running.")
+                return
+        except Exception as e:
+            logger.error(f"Jobs: could not renew lease for {job_id}: {e}")
+
+def leased(job_id: str, ttl: Optional[float] = None) -> Callable:
+    """
+    Декоратор задачи планировщика: запуск только под арендой job_id.
+    Аренда занята другим запуском — запуск пропускается (status = skipped в job_runs).
+    """
+    ttl = ttl or settings.JOB_LEASE_SECONDS
+
+    def wrap(func: Callable[..., Awaitable[Any]]):
+        @functools.wraps(func)
+        async def run(*args, **kwargs):
+            metric = _metric(job_id)
+            started = datetime.now(timezone.utc)
+            record: Dict[str, Any] = {"job_id": job_id, "holder": HOLDER, "started_at": started.isoformat()}
+
+            if not await db.acquire_lease(job_id, HOLDER, ttl, started):
+                metric["skipped_lease"] += 1
+                logger.warning(f"Jobs: {job_id} skipped, lease is held by another run.")
+                await _store(record, status="skipped")
+                return None
+
+            job_run = JobRun(job_id)
+            token = _current_run.set(job_run)
+            lost = asyncio.Event()
+            renewer = asyncio.create_task(_renew(job_id, ttl, lost))
+            t0 = time.perf_counter()
+            status, error = "ok", None
+            try:
+                return await func(*args, **kwargs)
+            except Exception as e:
+                status, error = "error", str(e)
+                metric["errors"] += 1
+                logger.error(f"Jobs: {job_id} failed: {e}")
+                raise
+            except asyncio.CancelledError:
+                status = "cancelled"
+                raise
+            finally:
+                _current_run.reset(token)
+                renewer.cancel()
+                duration = round((time.perf_counter() - t0) * 1000, 1)
+                metric["runs"] += 1
+                metric["last_ms"] = duration
+                if not lost.is_set():
+                    try:
+                        await db.release_lease(job_id, HOLDER)
+                    except Exception as e:
+                        logger.error(f"Jobs: could not release lease for {job_id}: {e}")
+                await _store(
+                    record, status=status, error=error, duration_ms=duration,
+                    finished_at=datetime.now(timezone.utc).isoformat(),
+                    rows_scanned=job_run.rows_scanned, messages_sent=job_run.messages_sent,
+                )
+        return run
+    return wrap
+
+async def _store(record: Dict[str, Any], **fields):
+    try:
+        await db.add_job_run({**record, **fields})
+    except Exception as e:
+        logger.error(f"Jobs: could not store run of {record['job_id']}: {e}")
@@ -4,94 +4,150 @@
 # ✅ Inline-кнопки для челленджей, реакций, оплаты
 # ✅ Логика показа кнопок в зависимости от статуса (Demo/Premium/Cooldown)
 # ✅ Кнопка "Поделиться" с правильным форматированием
+# ✅ Клавиатуры кэшируются неизменяемыми объектами по входным данным (язык, роль, id)
+# ✅ Ряды кнопок общих клавиатур тоже только для чтения (FrozenRows)
+# ✅ Ссылка "Поделиться" считается один раз на фразу, а не на каждого получателя
+#   (фраза с {name}: на получателя только quote(имени) и склейка готовых кусков)
 
 # 04 - bot/keyboards.py - ФИНАЛЬНАЯ ВЕРСИЯ (30.01.2026)
 # Все клавиатуры бота (Reply и Inline)
 # ✅ ПРОВЕРЕНО: WebApp профиль, логика 3+1+3, кнопки реакций
 
+import functools
 from aiogram.types import (
     ReplyKeyboardMarkup, KeyboardButton,
     InlineKeyboardMarkup, InlineKeyboardButton,
     WebAppInfo
 )
-from aiogram.utils.keyboard import InlineKeyboardBuilder, ReplyKeyboardBuilder
-from typing import Dict, Any, Optional
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from typing import Dict, Any, Optional, Tuple
 from urllib.parse import quote
 
 from bot.localization import t, Lang
 from bot.config import settings
+from bot.content import ContentEntry
 
-# ====================== REPLY КЛАВИАТУРЫ ======================
+# Поля пользователя, от которых зависит выбор клавиатуры (для db.get_user_fields)
+KEYBOARD_FIELDS = ("is_paid", "status", "demo_expiration")
 
-def get_main_keyboard(lang: Lang, user_id: int) -> ReplyKeyboardMarkup:
-    """Основная клавиатура для активных пользователей."""
-    builder = ReplyKeyboardBuilder()
-    # 1 ряд: Основной контент
-    builder.row(
-        KeyboardButton(text=t('btn_motivate', lang)),
-        KeyboardButton(text=t('btn_rhythm', lang))
+LANGUAGES: Tuple[Lang, ...] = ("ru", "ua", "en")
+
+# ====================== ⚙️ НЕИЗМЕНЯЕМЫЕ КЛАВИАТУРЫ ======================
+# Один экземпляр отдаётся всем вызовам с теми же аргументами, поэтому менять нельзя ни поля,
+# ни ряды кнопок. Нужна своя клавиатура — собирайте новую (InlineKeyboardBuilder), а не правьте эту.
+
+class FrozenRows(list):
+    """
+    Ряды (и ряд) кнопок только для чтения. Именно list, а не tuple: aiogram при отправке
+    выкидывает пустые поля кнопок только внутри list/dict, а кортеж ушёл бы в Telegram с null.
+    """
+    def _read_only(self, *args, **kwargs):
+        raise TypeError("cached keyboard rows are read-only, build a new keyboard instead")
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = clear = sort = reverse = _read_only
+
+    def __reduce_ex__(self, protocol):
+        # copy/deepcopy (model_copy) собирают копию через конструктор, а не через append
+        return type(self), (list(self),)
+
+class FrozenReplyKeyboard(ReplyKeyboardMarkup):
+    model_config = {**ReplyKeyboardMarkup.model_config, "frozen": True}
+
+class FrozenInlineKeyboard(InlineKeyboardMarkup):
+    model_config = {**InlineKeyboardMarkup.model_config, "frozen": True}
+
+Rows = Tuple[Tuple[Any, ...], ...]
+
+def _frozen_rows(rows: Rows) -> FrozenRows:
+    return FrozenRows(FrozenRows(row) for row in rows)
+
+# Кнопки уже проверены при создании — собираем без повторной валидации
+# (она же заменила бы FrozenRows обычными списками)
+
+def _inline(rows: Rows) -> FrozenInlineKeyboard:
+    return FrozenInlineKeyboard.model_construct(inline_keyboard=_frozen_rows(rows))
+
+def _reply(rows: Rows) -> FrozenReplyKeyboard:
+    return FrozenReplyKeyboard.model_construct(
+        keyboard=_frozen_rows(rows), resize_keyboard=True, is_persistent=True
     )
-    # 2 ряд: Челленджи и правила
-    builder.row(
-        KeyboardButton(text=t('btn_challenge', lang)),
-        KeyboardButton(text=t('btn_rules', lang))
+
+def _buttons(lang: Lang, *keys: str) -> Tuple[KeyboardButton, ...]:
+    return tuple(KeyboardButton(text=t(key, lang)) for key in keys)
+
+# ====================== REPLY КЛАВИАТУРЫ ======================
+
+@functools.lru_cache(maxsize=None)
+def _reply_rows(role: str, lang: Lang) -> Tuple[Rows, Rows]:
+    """Общие для всех ряды (до и после ряда с WebApp профиля) по роли и языку."""
+    if role == "admin":
+        # Клавиатура для администратора (полный фарш)
+        return (
+            _buttons(lang, 'btn_motivate', 'btn_rhythm'),
+            _buttons(lang, 'btn_challenge', 'btn_rules'),
+            _buttons(lang, 'btn_stats', 'btn_show_users', 'btn_reload_data'),
+        ), ()
+    if role == "expired":
+        # "День тишины" или демо истекло: профиль, оплата, настройки
+        return (), (
+            _buttons(lang, 'btn_pay_premium'),
+            _buttons(lang, 'btn_settings'),
+        )
+    # Основная клавиатура для активных пользователей: контент, челленджи и правила
+    return (
+        _buttons(lang, 'btn_motivate', 'btn_rhythm'),
+        _buttons(lang, 'btn_challenge', 'btn_rules'),
+    ), (
+        _buttons(lang, 'btn_settings'),
     )
-    # 3 ряд: Профиль (WebApp) и Поделиться
-    builder.row(
-        KeyboardButton(
-            text=t('btn_profile', lang), 
-            web_app=WebAppInfo(url=f"{settings.BASE_URL}/profile/{user_id}")
-        ),
-        KeyboardButton(text=t('btn_share', lang))
+
+# Ряд с профилем: хвост после кнопки WebApp
+_PROFILE_TAIL = {
+    "admin": ('btn_test_broadcast', 'btn_settings'),
+    "main": ('btn_share',),
+    "expired": (),
+}
+
+@functools.lru_cache(maxsize=settings.KEYBOARD_CACHE_SIZE)
+def _reply_keyboard(role: str, lang: Lang, user_id: int) -> FrozenReplyKeyboard:
+    """От пользователя зависит только ссылка WebApp профиля, остальные кнопки общие."""
+    before, after = _reply_rows(role, lang)
+    profile = KeyboardButton(
+        text=t('btn_profile', lang),
+        web_app=WebAppInfo(url=f"{settings.BASE_URL}/profile/{user_id}")
     )
-    # 4 ряд: Настройки
-    builder.row(KeyboardButton(text=t('btn_settings', lang)))
-    
-    builder.adjust(2, 2, 2, 1)
-    return builder.as_markup(resize_keyboard=True, is_persistent=True)
+    tail = _profile_tail(role, lang)
+    return _reply((*before, (profile, *tail), *after))
+
+@functools.lru_cache(maxsize=None)
+def _profile_tail(role: str, lang: Lang) -> Tuple[KeyboardButton, ...]:
+    return _buttons(lang, *_PROFILE_TAIL[role])
+
+def get_main_keyboard(lang: Lang, user_id: int) -> ReplyKeyboardMarkup:
+    """Основная клавиатура для активных пользователей. Общий экземпляр из кэша — не менять."""
+    return _reply_keyboard("main", lang, int(user_id))
 
 def get_admin_keyboard(lang: Lang, user_id: int) -> ReplyKeyboardMarkup:
-    """Клавиатура для администратора (полный фарш)."""
-    builder = ReplyKeyboardBuilder()
-    builder.row(
-        KeyboardButton(text=t('btn_motivate', lang)),
-        KeyboardButton(text=t('btn_rhythm', lang))
-    )
-    builder.row(
-        KeyboardButton(text=t('btn_challenge', lang)),
-        KeyboardButton(text=t('btn_rules', lang))
-    )
-    builder.row(
-        KeyboardButton(text=t('btn_stats', lang)),
-        KeyboardButton(text=t('btn_show_users', lang)),
-        KeyboardButton(text=t('btn_reload_data', lang))
-    )
-    builder.row(
-        KeyboardButton(
-            text=t('btn_profile', lang), 
-            web_app=WebAppInfo(url=f"{settings.BASE_URL}/profile/{user_id}")
-        ),
-        KeyboardButton(text=t('btn_test_broadcast', lang)),
-        KeyboardButton(text=t('btn_settings', lang))
-    )
-    builder.adjust(2, 2, 3, 3)
-    return builder.as_markup(resize_keyboard=True, is_persistent=True)
+    """Клавиатура для администратора (полный фарш). Общий экземпляр из кэша — не менять."""
+    return _reply_keyboard("admin", lang, int(user_id))
 
+@functools.lru_cache(maxsize=None)
 def get_settings_keyboard(lang: Lang) -> ReplyKeyboardMarkup:
-    """Клавиатура выбора языка в настройках."""
-    builder = ReplyKeyboardBuilder()
-    builder.row(
-        KeyboardButton(text="🇺🇦 Українська"),
-        KeyboardButton(text="🇬🇧 English"),
-        KeyboardButton(text="🇷🇺 Русский")
-    )
-    builder.row(KeyboardButton(text=t('btn_back', lang)))
-    builder.adjust(3, 1)
-    return builder.as_markup(resize_keyboard=True, is_persistent=True)
+    """Клавиатура выбора языка в настройках. Общий экземпляр из кэша — не менять."""
+    return _reply((
+        (
+            KeyboardButton(text="🇺🇦 Українська"),
+            KeyboardButton(text="🇬🇧 English"),
+            KeyboardButton(text="🇷🇺 Русский"),
+        ),
+        _buttons(lang, 'btn_back'),
+    ))
 
 def get_reply_keyboard_for_user(chat_id: int, lang: Lang, user_data: Dict[str, Any]) -> ReplyKeyboardMarkup:
     """
     Определяет, какую клавиатуру выдать в зависимости от статуса 3+1+3.
+    Возвращает общий экземпляр из кэша: ни поля, ни ряды кнопок не менять.
     """
     # 1. Проверка на админа (Принудительное приведение типов)
     if int(chat_id) == int(settings.ADMIN_CHAT_ID):
@@ -115,83 +171,136 @@ def get_reply_keyboard_for_user(chat_id: int, lang: Lang, user_data: Dict[str, A
                 demo_expired = True
 
     if (demo_expired or status == "cooldown") and not is_paid:
-        builder = ReplyKeyboardBuilder()
-        builder.row(KeyboardButton(
-            text=t('btn_profile', lang),
-            web_app=WebAppInfo(url=f"{settings.BASE_URL}/profile/{chat_id}")
-        ))
-        builder.row(KeyboardButton(text=t('btn_pay_premium', lang)))
-        builder.row(KeyboardButton(text=t('btn_settings', lang)))
-        builder.adjust(1, 1, 1)
-        return builder.as_markup(resize_keyboard=True, is_persistent=True)
+        return _reply_keyboard("expired", lang, int(chat_id))
 
     # 3. Обычное меню для активных
     return get_main_keyboard(lang, chat_id)
 
 # ====================== INLINE КЛАВИАТУРЫ ======================
 
+@functools.lru_cache(maxsize=None)
 def get_lang_keyboard() -> InlineKeyboardMarkup:
-    """Выбор языка при первом старте."""
-    builder = InlineKeyboardBuilder()
-    builder.button(text="🇺🇦 Українська UA", callback_data="set_lang_ua")
-    builder.button(text="🇬🇧 English EN", callback_data="set_lang_en")
-    builder.button(text="🇷🇺 Русский RU", callback_data="set_lang_ru")
-    builder.adjust(1)
-    return builder.as_markup()
+    """Выбор языка при первом старте. Общий экземпляр из кэша — не менять."""
+    return _inline((
+        (InlineKeyboardButton(text="🇺🇦 Українська UA", callback_data="set_lang_ua"),),
+        (InlineKeyboardButton(text="🇬🇧 English EN", callback_data="set_lang_en"),),
+        (InlineKeyboardButton(text="🇷🇺 Русский RU", callback_data="set_lang_ru"),),
+    ))
+
+@functools.lru_cache(maxsize=None)
+def _reaction_row(current_reaction: Optional[str]) -> Tuple[InlineKeyboardButton, ...]:
+    """Реакции Like / Dislike (✅ и :done у уже выбранной)."""
+    row = []
+    for action, emoji in (("like", "👍"), ("dislike", "👎")):
+        done = current_reaction == action
+        row.append(InlineKeyboardButton(
+            text=f"{emoji} ✅" if done else emoji,
+            callback_data=f"reaction:{action}:done" if done else f"reaction:{action}",
+        ))
+    return tuple(row)
+
+SHARE_QUOTE_LIMIT = 280
+
+@functools.lru_cache(maxsize=settings.KEYBOARD_CACHE_SIZE)
+def share_url(lang: Lang, quote_text: str) -> str:
+    """Ссылка "Поделиться" для фразы: quote() один раз на фразу, а не на получателя."""
+    # Обрезаем для стабильности ссылки
+    safe_quote = quote_text[:SHARE_QUOTE_LIMIT] + "..." if len(quote_text) > SHARE_QUOTE_LIMIT else quote_text
+    # Формируем текст (Призыв первым согласно аудиту)
+    share_msg = t('share_text_with_quote', lang, quote=safe_quote, bot_username=settings.BOT_USERNAME)
+    return f"https://t.me/share/url?text={quote(share_msg)}"
+
+@functools.lru_cache(maxsize=settings.KEYBOARD_CACHE_SIZE)
+def _share_url_parts(lang: Lang, parts: Tuple[str, ...]) -> Tuple[str, ...]:
+    """Ссылка для фразы с {name}, уже в quote() и разрезанная по месту имени."""
+    share_msg = t('share_text_with_quote', lang, quote="\0".join(parts), bot_username=settings.BOT_USERNAME)
+    head, *rest = share_msg.split("\0")
+    return (f"https://t.me/share/url?text={quote(head)}", *(quote(part) for part in rest))
+
+def _named_share_url(lang: Lang, entry: ContentEntry, user_name: str) -> str:
+    """Та же ссылка, что share_url(lang, entry.render(user_name)), без quote() всей фразы на получателя."""
+    named = entry.render(user_name)
+    # Обрезка зависит от длины имени, а пробелы/запятые на краях имени правит чистка t() — медленный путь
+    if len(named) > SHARE_QUOTE_LIMIT or user_name != user_name.strip() or "  " in user_name or "," in user_name:
+        return share_url(lang, named)
+    return quote(user_name).join(_share_url_parts(lang, entry.parts))
+
+@functools.lru_cache(maxsize=settings.KEYBOARD_CACHE_SIZE)
+def _broadcast_keyboard(lang: Lang, quote_text: Optional[str], current_reaction: Optional[str]) -> FrozenInlineKeyboard:
+    rows: list = [_reaction_row(current_reaction)]
+    if quote_text:
+        rows.append((InlineKeyboardButton(text=t('btn_share', lang), url=share_url(lang, quote_text)),))
+    return _inline(tuple(rows))
 
 def get_broadcast_keyboard(
     lang: Lang, 
     quote_text: Optional[str] = None, 
-    category: str = "default", 
     current_reaction: Optional[str] = None, 
-    user_name: Optional[str] = None
+    user_name: Optional[str] = None,
+    entry: Optional[ContentEntry] = None,
 ) -> InlineKeyboardMarkup:
-    """Кнопки под сообщениями рассылки (Реакции + Поделиться)."""
-    builder = InlineKeyboardBuilder()
-    
-    # Реакция Like
-    like_txt = "👍 ✅" if current_reaction == "like" else "👍"
-    like_cb = "reaction:like:done" if current_reaction == "like" else "reaction:like"
-    
-    # Реакция Dislike
-    dis_txt = "👎 ✅" if current_reaction == "dislike" else "👎"
-    dis_cb = "reaction:dislike:done" if current_reaction == "dislike" else "reaction:dislike"
-
-    builder.button(text=like_txt, callback_data=like_cb)
-    builder.button(text=dis_txt, callback_data=dis_cb)
-
-    # Кнопка "Поделиться" (если есть текст)
-    if quote_text:
-        # Обрезаем для стабильности ссылки
-        safe_quote = quote_text[:280] + "..." if len(quote_text) > 280 else quote_text
-        # Формируем текст (Призыв первым согласно аудиту)
-        share_msg = t('share_text_with_quote', lang, quote=safe_quote, bot_username=settings.BOT_USERNAME)
-        share_url = f"https://t.me/share/url?text={quote(share_msg)}"
-        builder.button(text=t('btn_share', lang), url=share_url)
-
-    builder.adjust(2, 1)
-    return builder.as_markup()
+    """
+    Кнопки под сообщениями рассылки (Реакции + Поделиться).
+    entry + user_name — в "Поделиться" фраза с именем получателя, как в самом сообщении;
+    quote_text — готовый текст. Фраза без {name} даёт одну клавиатуру на фразу, общую для всех
+    получателей: ни поля, ни ряды кнопок не менять.
+    """
+    if entry is not None:
+        if entry.has_name and user_name:
+            share = InlineKeyboardButton(text=t('btn_share', lang), url=_named_share_url(lang, entry, user_name))
+            return _inline((_reaction_row(current_reaction), (share,)))
+        quote_text = entry.render(None)
+    return _broadcast_keyboard(lang, quote_text or None, current_reaction)
 
+@functools.lru_cache(maxsize=settings.KEYBOARD_CACHE_SIZE)
 def get_challenge_buttons(lang: Lang, challenge_id: Optional[int] = None) -> InlineKeyboardMarkup:
-    """Принятие или выбор нового челленджа."""
+    """Принятие или выбор нового челленджа. Общий экземпляр из кэша — не менять."""
     builder = InlineKeyboardBuilder()
     if challenge_id is not None:
         builder.button(text=t("btn_challenge_accept", lang), callback_data=f"accept_challenge_idx:{challenge_id}")
     builder.button(text=t("btn_challenge_new", lang), callback_data="new_challenge")
     builder.adjust(1)
-    return builder.as_markup()
+    return _inline(tuple(tuple(row) for row in builder.export()))
 
+@functools.lru_cache(maxsize=settings.KEYBOARD_CACHE_SIZE)
 def get_challenge_complete_button(lang: Lang, challenge_id: int) -> InlineKeyboardMarkup:
-    """Завершение челленджа."""
-    builder = InlineKeyboardBuilder()
-    builder.button(text=t("btn_challenge_complete", lang), callback_data=f"complete_challenge:{challenge_id}")
-    return builder.as_markup()
+    """Завершение челленджа. Общий экземпляр из кэша — не менять."""
+    return _inline((
+        (InlineKeyboardButton(text=t("btn_challenge_complete", lang), callback_data=f"complete_challenge:{challenge_id}"),),
+    ))
 
+@functools.lru_cache(maxsize=None)
 def get_payment_keyboard(lang: Lang, is_test_user: bool = False) -> InlineKeyboardMarkup:
-    """Клавиатура оплаты."""
-    kb = InlineKeyboardBuilder()
-    kb.button(text=t('btn_pay_premium', lang), url=settings.PAYMENT_LINK)
+    """Клавиатура оплаты. Общий экземпляр из кэша — не менять."""
+    rows = [(InlineKeyboardButton(text=t('btn_pay_premium', lang), url=settings.PAYMENT_LINK),)]
     if is_test_user:
-        kb.button(text="💳 Test Pay (Success)", callback_data="test_payment_success")
-    kb.adjust(1)
-    return kb.as_markup()
\ No newline at end of file
+        rows.append((InlineKeyboardButton(text="💳 Test Pay (Success)", callback_data="test_payment_success"),))
+    return _inline(tuple(rows))
+
+# ====================== 🔥 ПРОГРЕВ ======================
+
+def warm_keyboards(static_data: Optional[Dict[str, Any]] = None):
+    """При старте: все клавиатуры, не зависящие от пользователя, для трёх языков."""
+    from bot.content import ContentCategory
+
+    for lang in LANGUAGES:
+        for role in _PROFILE_TAIL:
+            _reply_rows(role, lang)
+            _profile_tail(role, lang)
+        get_admin_keyboard(lang, settings.ADMIN_CHAT_ID)
+        get_settings_keyboard(lang)
+        get_payment_keyboard(lang, False)
+        get_payment_keyboard(lang, True)
+        get_challenge_buttons(lang, None)
+    get_lang_keyboard()
+    for reaction in (None, "like", "dislike"):
+        _reaction_row(reaction)
+    # Ссылки "Поделиться" для утренней рассылки — самый частый путь
+    morning = (static_data or {}).get("morning_phrases")
+    if isinstance(morning, ContentCategory):
+        for lang in LANGUAGES:
+            for entry in morning.entries(lang):
+                if entry.has_name:
+                    _share_url_parts(lang, entry.parts)
+                else:
+                    get_broadcast_keyboard(lang, entry=entry)
@@ -0,0 +1,127 @@
+# 19 - bot/leader.py
+# ✅ Выбор лидера: задачи планировщика выполняет ровно один процесс, остальные только принимают вебхуки
+# ✅ Лидерство — аренда "leader" в job_leases (общий файл SQLite) или другой LeaseBackend
+# ✅ Лидер продлевает аренду каждые треть срока; упавшего лидера заменяют за один срок аренды
+# ✅ Потеря аренды → задачи снимаются и доставка outbox останавливается
+#
+# По умолчанию выключено (LEADER_ELECTION=false): бот рассчитан на один процесс.
+# Несколько процессов (uvicorn-воркеры на одной машине, общий файл SQLite) — только с
+# LEADER_ELECTION=true: тогда Database выключает кэш users и write-behind, потому что они
+# живут в памяти одного процесса и чужих записей не видят. Для нескольких машин без общего
+# тома нужен свой LeaseBackend с теми же двумя методами. Часы машин должны быть синхронны:
+# срок аренды сравнивается с временем претендента.
+
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Protocol
+
+from bot.config import logger, settings
+from bot.database import db
+from bot.jobs import HOLDER
+
+LEADER_LEASE = "leader"
+
+class LeaseBackend(Protocol):
+    async def acquire(self, name: str, holder: str, ttl: float) -> bool: ...
+    async def release(self, name: str, holder: str) -> None: ...
+
+class SQLiteLeaseBackend:
+    """Аренда в таблице job_leases (тот же UPSERT, что и у задач в bot/jobs.py)."""
+    async def acquire(self, name: str, holder: str, ttl: float) -> bool:
+        return await db.acquire_lease(name, holder, ttl)
+
+    async def release(self, name: str, holder: str) -> None:
+        await db.release_lease(name, holder)
+
+Callback = Callable[[], Awaitable[Any]]
+
+class LeaderElector:
+    """
+    Цикл выборов: каждые ttl/3 секунд взять или продлить аренду.
+    Получили — on_elected (запуск задач), потеряли — on_demoted (снятие задач).
+    """
+    def __init__(
+        self,
+        backend: Optional[LeaseBackend] = None,
+        holder: str = HOLDER,
+        ttl: Optional[float] = None,
+        name: str = LEADER_LEASE,
+    ):
+        self.backend = backend or SQLiteLeaseBackend()
+        self.holder = holder
+        self.ttl = ttl or settings.LEADER_LEASE_SECONDS
+        self.name = name
+        self.is_leader = False
+        self._valid_until = 0.0  # monotonic: до какого момента наша аренда точно действует
+        self._on_elected: Optional[Callback] = None
+        self._on_demoted: Optional[Callback] = None
+        self._task: Optional[asyncio.Task] = None
+        self._stats = {"elected": 0, "demoted": 0, "errors": 0}
+
+    async def start(self, on_elected: Callback, on_demoted: Callback):
+        """Первая попытка — сразу (старт не ждёт интервала), дальше цикл в фоне."""
+        self._on_elected, self._on_demoted = on_elected, on_demoted
+        await self._tick()
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        """Остановка процесса: снять задачи и отпустить аренду, чтобы другой процесс взял её сразу."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        if self.is_leader:
+            await self._demote()
+            try:
+                await self.backend.release(self.name, self.holder)
+            except Exception as e:
+                logger.error(f"Leader: could not release lease: {e}")
+
+    async def _loop(self):
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            await self._tick()
+
+    async def _tick(self):
+        started = time.monotonic()
+        try:
+            acquired = await self.backend.acquire(self.name, self.holder, self.ttl)
+        except Exception as e:
+            self._stats["errors"] += 1
+            logger.error(f"Leader: lease check failed: {e}")
+            # База недоступна: лидер остаётся, пока его аренда не могла истечь
+            if self.is_leader and time.monotonic() >= self._valid_until:
+                await self._demote()
+            return
+
+        if acquired:
+            self._valid_until = started + self.ttl
+            if not self.is_leader:
+                self.is_leader = True
+                self._stats["elected"] += 1
+                logger.info(f"👑 Leader: {self.holder} is now the scheduler leader.")
+                try:
+                    await self._on_elected()
+                except Exception as e:
+                    logger.error(f"Leader: on_elected failed: {e}")
+        elif self.is_leader:
+            logger.warning(f"Leader: {self.holder} lost the lease.")
+            await self._demote()
+
+    async def _demote(self):
+        self.is_leader = False
+        self._stats["demoted"] += 1
+        try:
+            await self._on_demoted()
+        except Exception as e:
+            logger.error(f"Leader: on_demoted failed: {e}")
+
+    def status(self) -> Dict[str, Any]:
+        return {"holder": self.holder, "is_leader": self.is_leader, "ttl_s": self.ttl, **self._stats}
+
+elector = LeaderElector()
+
+def is_leader() -> bool:
+    """Без выборов (LEADER_ELECTION=false) каждый процесс считает себя лидером, как раньше."""
+    return elector.is_leader or not settings.LEADER_ELECTION
@@ -14,8 +14,13 @@
 # Локализация и переводы (3 языка: RU/UA/EN)
 # ✅ ПРОВЕРЕНО: Все ключи для 3+1+3, маркетинг, челленджи, уровни, напоминания
 # ✅ ДОБАВЛЕНО: challenge_new_day_reminder и полные переводы UA/EN
+# ✅ Шаблоны компилируются при импорте: без плейсхолдеров — готовая строка, с ними — кэш результатов
+# ✅ Проверка переводов (ключи и плейсхолдеры RU/UA/EN): python -m bot.localization
 
-from typing import Literal, Dict
+import functools
+import string
+import sys
+from typing import Any, FrozenSet, Literal, Dict, List, Optional
 from bot.config import settings, logger
 
 # Типизация для языков
@@ -248,25 +253,136 @@ translations: Dict[Lang, Dict[str, str]] = {
 }
 
 
-def t(key: str, lang: Lang = DEFAULT_LANG, **kwargs) -> str:
-    """
-    Функция перевода с безопасным форматированием.
-    Если ключ отсутствует — возвращает сам ключ.
-    Если в тексте есть {name} без передачи — подставляет пустую строку.
-    """
-    text = translations.get(lang, translations.get(DEFAULT_LANG, {})).get(key, key)
-    
+# ========== ⚙️ СКОМПИЛИРОВАННЫЕ ШАБЛОНЫ ==========
+
+_formatter = string.Formatter()
+
+def _clean(text: str) -> str:
+    """Убираем лишние пробелы и запятые (после пустого {name})."""
+    return text.replace(" ,", ",").replace("  ", " ").strip()
+
+def _format_text(text: str, key: str, lang: str, kwargs: Dict[str, Any]) -> str:
+    """Медленный путь с безопасным форматированием: битые шаблоны и недостающие аргументы."""
     # Если в тексте есть {name}, но аргумент не передан — подставляем пустую строку
     if "{name}" in text and "name" not in kwargs:
         kwargs["name"] = ""
-    
+
     try:
-        formatted = text.format(**kwargs)
-        # Убираем лишние пробелы и запятые
-        return formatted.replace(" ,", ",").replace("  ", " ").strip()
+        return _clean(text.format(**kwargs))
     except KeyError as e:
         logger.error(f"Missing placeholder '{e}' in key '{key}' for lang '{lang}'")
         return text.replace(f"{{{str(e)}}}", "").strip()
     except Exception as e:
         logger.error(f"Error formatting translation '{key}' in lang '{lang}': {e}")
-        return text.strip()
\ No newline at end of file
+        return text.strip()
+
+def placeholders(text: str) -> Optional[FrozenSet[str]]:
+    """Имена плейсхолдеров шаблона; None — шаблон не разбирается (непарные скобки)."""
+    try:
+        return frozenset(
+            field.split(".")[0].split("[")[0] for _, field, _, _ in _formatter.parse(text) if field is not None
+        )
+    except ValueError:
+        return None
+
+class Template:
+    """Перевод, разобранный один раз: плейсхолдеры известны, текст без них уже отформатирован."""
+    __slots__ = ("key", "lang", "text", "fields", "static", "parts")
+
+    def __init__(self, key: str, lang: str, text: str):
+        self.key, self.lang, self.text = key, lang, text
+        self.fields = placeholders(text)
+        self.static: Optional[str] = None
+        # Только {name} (рассылки по пользователям): имя вставляется join'ом, кэш не нужен —
+        # имена у всех разные и только вытесняли бы остальное
+        self.parts: Optional[tuple] = None
+        try:
+            if self.fields is not None and not self.fields:
+                self.static = _clean(text.format())
+            elif self.fields == {"name"} and all(
+                not spec and not conv for _, field, spec, conv in _formatter.parse(text) if field is not None
+            ):
+                self.parts = tuple(text.format(name="\0").split("\0"))
+        except Exception:
+            pass
+
+    def render(self, kwargs: Dict[str, Any]) -> str:
+        if self.fields is not None:
+            if "name" in self.fields and "name" not in kwargs:
+                kwargs["name"] = ""
+            if self.fields <= kwargs.keys():
+                try:
+                    return _clean(self.text.format(**kwargs))
+                except Exception:
+                    pass
+        return _format_text(self.text, self.key, self.lang, kwargs)
+
+_templates: Dict[str, Dict[str, Template]] = {}
+
+def compile_translations():
+    """Пересобирает шаблоны из translations (вызывать после правки словаря в рантайме)."""
+    _templates.clear()
+    for lang, texts in translations.items():
+        _templates[lang] = {key: Template(key, lang, text) for key, text in texts.items()}
+    _render.cache_clear()
+
+@functools.lru_cache(maxsize=settings.LOCALIZATION_CACHE_SIZE)
+def _render(template: Template, items: tuple) -> str:
+    return template.render(dict(items))
+
+def t(key: str, lang: Lang = DEFAULT_LANG, **kwargs) -> str:
+    """
+    Функция перевода с безопасным форматированием.
+    Если ключ отсутствует — возвращает сам ключ.
+    Если в тексте есть {name} без передачи — подставляет пустую строку.
+    """
+    texts = _templates.get(lang) or _templates.get(DEFAULT_LANG, {})
+    template = texts.get(key)
+    if template is None:
+        return _format_text(key, key, lang, kwargs)
+    if template.static is not None:
+        return template.static
+    if template.parts is not None:
+        return _clean(str(kwargs.get("name", "")).join(template.parts))
+    try:
+        return _render(template, tuple(kwargs.items()))
+    except TypeError:
+        # Нехэшируемый аргумент — без кэша
+        return template.render(kwargs)
+
+compile_translations()
+
+# ========== 🔍 ПРОВЕРКА ПЕРЕВОДОВ ==========
+
+def validate() -> List[str]:
+    """Ключи, которых нет в одном из языков, разные плейсхолдеры и неразбираемые шаблоны."""
+    problems: List[str] = []
+    langs = list(translations)
+    all_keys = set().union(*(translations[lang].keys() for lang in langs))
+    for key in sorted(all_keys):
+        fields: Dict[str, FrozenSet[str]] = {}
+        for lang in langs:
+            text = translations[lang].get(key)
+            if text is None:
+                problems.append(f"{key}: missing in {lang}")
+                continue
+            parsed = placeholders(text)
+            if parsed is None:
+                problems.append(f"{key}: unbalanced braces in {lang}")
+            else:
+                fields[lang] = parsed
+        if len(set(fields.values())) > 1:
+            detail = ", ".join(f"{lang}={sorted(f)}" for lang, f in fields.items())
+            problems.append(f"{key}: placeholder mismatch ({detail})")
+    return problems
+
+def main() -> int:
+    problems = validate()
+    for problem in problems:
+        print(f"❌ {problem}")
+    keys = {lang: len(texts) for lang, texts in translations.items()}
+    print(f"{'✅' if not problems else '⚠️'} {keys}, problems: {len(problems)}")
+    return 1 if problems else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -18,14 +18,19 @@ from fastapi import FastAPI, Request
 from aiogram import Bot, Dispatcher
 from aiogram.client.default import DefaultBotProperties
 from aiogram.enums import ParseMode
+from aiogram.fsm.state import State
 from aiogram.fsm.storage.base import BaseStorage, StorageKey, StateType
 from aiogram.types import Update
 
 from bot.config import settings, logger
 from bot.database import db
-from bot.user_loader import load_users_with_fix, save_users_sync, load_static_data
+from bot.user_loader import content_watcher, load_static_data
 from bot.utils import AccessMiddleware
-from bot.scheduler import setup_jobs_and_cache
+from bot.keyboards import warm_keyboards
+from bot.scheduler import setup_jobs_and_cache, stop_jobs
+from bot.broadcast import broadcast_progress, resume_outbox, stop_delivery
+from bot.jobs import job_metrics
+from bot.leader import elector
 
 # Роутеры Aiogram
 from bot.commands import router as commands_router
@@ -37,17 +42,19 @@ from bot.admin_routes import router as admin_router, webapp_router
 class DBSStorage(BaseStorage):
     """FSM Storage с хранением в БД для устойчивости на Fly.io."""
     async def set_state(self, key: StorageKey, state: StateType = None) -> None:
-        await db.update_fsm_storage(key.user_id, key.chat_id, "state", state)
+        # None — сброс состояния, поэтому пишем напрямую, а не через update_fsm_storage
+        value = state.state if isinstance(state, State) else state
+        await db.update_user(key.user_id, fsm_state=value)
     
     async def get_state(self, key: StorageKey) -> str | None:
-        data = await db.get_fsm_storage(key.user_id, key.chat_id)
+        data = await db.get_fsm_storage(key.user_id)
         return data.get("state") if data else None
     
     async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
-        await db.update_fsm_storage(key.user_id, key.chat_id, "data", data)
+        await db.update_fsm_storage(key.user_id, data=data)
     
     async def get_data(self, key: StorageKey) -> Dict[str, Any]:
-        data = await db.get_fsm_storage(key.user_id, key.chat_id)
+        data = await db.get_fsm_storage(key.user_id)
         return data.get("data", {}) if data else {}
     
     async def close(self) -> None:
@@ -56,18 +63,17 @@ class DBSStorage(BaseStorage):
 # --- 🌍 Глобальные переменные ---
 bot: Bot = None
 dp: Dispatcher = None
-users_db: Dict[str, Any] = {}
 static_data: Dict[str, Any] = {}
 
 # --- 🚀 Lifespan (Запуск и Остановка) ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global bot, dp, users_db, static_data
+    global bot, dp, static_data
     
     logger.info("🚀 Starting Fotinia Bot...")
     
-    # 1. БД
-    await db.init_db()
+    # 1. БД (открывает пул соединений)
+    await db.init()
     
     # 2. Бот
     bot = Bot(
@@ -75,16 +81,20 @@ async def lifespan(app: FastAPI):
         default=DefaultBotProperties(parse_mode=ParseMode.HTML)
     )
     
-    # 3. Загрузка данных (Cache + Static)
-    users_db = await load_users_with_fix()
+    app.state.bot = bot  # Для WebApp профиля и повтора dead letters из админки
+    
+    # 3. Загрузка статики (пользователи читаются через кэш Database).
+    # Дальше изменившиеся файлы подменяются в этом же объекте (его держат middleware и планировщик)
     static_data = await load_static_data()
+    content_watcher.start(static_data)
+    warm_keyboards(static_data)
     
     # 4. Dispatcher
     storage = DBSStorage()
     dp = Dispatcher(storage=storage)
     
     # 5. Middlewares
-    middleware = AccessMiddleware(users_db, static_data)
+    middleware = AccessMiddleware(static_data)
     dp.message.middleware(middleware)
     dp.callback_query.middleware(middleware)
     
@@ -95,19 +105,28 @@ async def lifespan(app: FastAPI):
     dp.include_router(buttons_router)    # Текстовые кнопки
     dp.include_router(router_unknown)    # Fallback (всегда последний)
     
-    # 7. Планировщик задач
-    await setup_jobs_and_cache(bot, users_db, static_data)
+    # 7-8. Досылка прерванной рассылки и планировщик — только на процессе-лидере.
+    # Досылка идёт до планировщика, пока никто не доставляет (в фоне, старт не ждёт)
+    async def on_elected():
+        await resume_outbox(bot)
+        await setup_jobs_and_cache(bot, static_data)
+
+    if settings.LEADER_ELECTION:
+        await elector.start(on_elected, stop_jobs)
+    else:
+        await on_elected()
     
-    # 8. Установка вебхука
+    # 9. Установка вебхука
     webhook_url = f"{settings.WEBHOOK_URL}/webhook"
     await bot.set_webhook(
         url=webhook_url,
-        allowed_updates=["message", "callback_query"],
-        drop_pending_updates=True
+        allowed_updates=["message", "callback_query", "my_chat_member"],
+        # Вебхук общий для всех процессов: при выборах старт одного не должен терять чужие обновления
+        drop_pending_updates=not settings.LEADER_ELECTION
     )
     logger.info(f"✅ Webhook set to: {webhook_url}")
     
-    # 9. Приветствие админу (опционально)
+    # 10. Приветствие админу (опционально)
     try:
         from bot.localization import t
         await bot.send_message(settings.ADMIN_CHAT_ID, t("admin_bot_started", settings.DEFAULT_LANG))
@@ -117,9 +136,16 @@ async def lifespan(app: FastAPI):
     
     # --- SHUTDOWN ---
     logger.info("⏳ Stopping Fotinia Bot...")
-    await bot.delete_webhook()
-    await save_users_sync(users_db)
+    await content_watcher.stop()
+    if settings.LEADER_ELECTION:
+        # Отпускаем аренду сразу: другой процесс станет лидером, не дожидаясь её срока.
+        # Вебхук не удаляем — остальные процессы продолжают принимать обновления
+        await elector.stop()
+    else:
+        await stop_delivery()
+        await bot.delete_webhook()
     await bot.session.close()
+    await db.close()
 
 # --- 🛠️ FastAPI Приложение ---
 app = FastAPI(
@@ -145,7 +171,7 @@ async def webhook(request: Request):
 @app.get("/")
 async def health_check():
     """Проверка для Fly.io."""
-    return {"status": "ok", "version": "26.02.2026", "users": len(users_db)}
+    return {"status": "ok", "version": "26.02.2026", "users": await db.get_total_users_count(), "db_pool": db.pool_stats(), "broadcasts": broadcast_progress(), "delivery": db.delivery_stats(), "jobs": job_metrics(), "leader": elector.status(), "content": content_watcher.status()}
 
 if __name__ == "__main__":
     import uvicorn
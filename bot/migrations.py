@@ -0,0 +1,291 @@
+# 15 - bot/migrations.py
+# ✅ Версионные миграции схемы SQLite (таблица schema_version)
+# ✅ Каждый шаг идемпотентен и выполняется в отдельной транзакции
+# ✅ На актуальной базе старт = одна проверка версии
+# ✅ Колонки проверяются через PRAGMA table_info, индексы создаются после колонок
+
+import logging
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable, List, Tuple
+
+import aiosqlite
+
+logger = logging.getLogger(__name__)
+
+# Колонки users, добавленные после первой версии схемы (порядок важен для старых баз)
+USER_COLUMN_DEFS = [
+    ("timezone", "TEXT DEFAULT 'Europe/Kiev'"),
+    ("is_paid", "INTEGER DEFAULT 0"),
+    ("status", "TEXT DEFAULT 'demo'"),
+    ("demo_expiration", "TEXT"),
+    ("active", "INTEGER DEFAULT 1"),
+    ("last_challenge_date", "TEXT"),
+    ("challenge_accepted", "INTEGER DEFAULT 0"),
+    ("challenges", "TEXT NOT NULL DEFAULT '[]'"),
+    ("challenge_streak", "INTEGER DEFAULT 0"),
+    ("fsm_state", "TEXT"),
+    ("fsm_data", "TEXT"),
+    ("last_rules_date", "TEXT"),
+    ("rules_shown_count", "INTEGER DEFAULT 0"),
+    ("rules_indices_today", "TEXT NOT NULL DEFAULT '[]'"),
+    ("sent_expiry_warning", "INTEGER DEFAULT 0"),
+    ("stats_likes", "INTEGER DEFAULT 0"),
+    ("stats_dislikes", "INTEGER DEFAULT 0"),
+    ("demo_count", "INTEGER DEFAULT 1"),
+    ("challenges_today", "INTEGER DEFAULT 0"),
+    ("last_level_checked", "TEXT DEFAULT 'level_0'"),
+    ("referred_by", "INTEGER"),
+    ("created_at", "TEXT"),
+    ("last_broadcast_date", "TEXT"),  # ✅ Защита от дублей рассылки
+]
+
+# Кто и когда перестал принимать сообщения (Forbidden от Telegram) — шаг 8
+BLOCK_COLUMN_DEFS = [
+    ("blocked_reason", "TEXT"),
+    ("blocked_at", "TEXT"),
+]
+
+# ========== 🔧 ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ==========
+
+async def table_columns(conn: aiosqlite.Connection, table: str) -> set:
+    """Имена колонок таблицы (пустое множество, если таблицы нет)."""
+    async with conn.execute(f"PRAGMA table_info({table})") as cursor:
+        return {row[1] for row in await cursor.fetchall()}
+
+async def add_columns(conn: aiosqlite.Connection, table: str, columns: List[Tuple[str, str]]):
+    """Добавляет только отсутствующие колонки (без ALTER-и-игнорировать-ошибку)."""
+    existing = await table_columns(conn, table)
+    for col, definition in columns:
+        if col not in existing:
+            await conn.execute(f"ALTER TABLE {table} ADD COLUMN {col} {definition}")
+
+# ========== 📜 ШАГИ МИГРАЦИЙ ==========
+# Каждый шаг: async def step(db, conn). db — экземпляр Database (для разбора JSON и т.п.).
+# Шаги обязаны быть идемпотентными: базы без schema_version проходят их все заново.
+
+async def _m001_users(db: Any, conn: aiosqlite.Connection):
+    """Таблица users со всеми колонками."""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            name TEXT,
+            language TEXT DEFAULT 'ru',
+            data TEXT NOT NULL DEFAULT '{}'
+        )
+    ''')
+    await add_columns(conn, "users", USER_COLUMN_DEFS)
+
+async def _m002_users_indexes(db: Any, conn: aiosqlite.Connection):
+    """Частичные индексы для рассылок и проверки демо (после колонок из шага 1)."""
+    # idx_user_id дублировал INTEGER PRIMARY KEY и только замедлял запись
+    await conn.execute("DROP INDEX IF EXISTS idx_user_id")
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_demo_expiration
+        ON users(demo_expiration, is_paid)
+        WHERE is_paid = 0 AND demo_expiration IS NOT NULL
+    """)
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_active_timezone
+        ON users(active, timezone)
+        WHERE active = 1
+    """)
+
+async def _m003_challenge_history(db: Any, conn: aiosqlite.Connection):
+    """История челленджей: одна строка на пользователя и день + перенос из users.challenges."""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS challenge_history (
+            user_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            text_idx INTEGER,
+            text TEXT,
+            accepted_at TEXT,
+            completed_at TEXT,
+            PRIMARY KEY (user_id, day)
+        ) WITHOUT ROWID
+    ''')
+    await db._migrate_challenges_json(conn)
+
+async def _m004_challenge_pending_index(db: Any, conn: aiosqlite.Connection):
+    """Незавершённые челленджи по времени принятия (напоминание через час)."""
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_challenge_pending
+        ON challenge_history(accepted_at)
+        WHERE completed_at IS NULL
+    """)
+
+async def _m005_broadcast_outbox(db: Any, conn: aiosqlite.Connection):
+    """Очередь исходящих рассылок: одна строка на получателя в рамках запуска (run_id)."""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS broadcast_outbox (
+            id INTEGER PRIMARY KEY,
+            run_id TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            reply_markup TEXT,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            error TEXT,
+            created_at TEXT NOT NULL,
+            claimed_at TEXT,
+            finished_at TEXT,
+            UNIQUE (run_id, user_id)
+        )
+    ''')
+    # Ожидающие строки забираются по индексу, отправленные в него не попадают.
+    # Условие индекса должно совпадать с запросом дословно: IN ('pending', 'sending') SQLite не применит
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_outbox_pending
+        ON broadcast_outbox(id)
+        WHERE status = 'pending'
+    """)
+
+async def _m006_due_reminders(db: Any, conn: aiosqlite.Connection):
+    """
+    Отложенные напоминания со сроком (due_at): строка создаётся при принятии челленджа,
+    удаляется при выполнении. Заменяет поиск по challenge_history раз в полчаса.
+    """
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS due_reminders (
+            user_id INTEGER NOT NULL,
+            kind TEXT NOT NULL,
+            due_at TEXT NOT NULL,
+            ref TEXT,
+            PRIMARY KEY (user_id, kind)
+        ) WITHOUT ROWID
+    ''')
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_due_reminders_due ON due_reminders(kind, due_at)")
+    await db._migrate_pending_followups(conn)
+    # Индекс служил только для поиска напоминаний по challenge_history
+    await conn.execute("DROP INDEX IF EXISTS idx_challenge_pending")
+
+async def _m007_send_plan(db: Any, conn: aiosqlite.Connection):
+    """План отправок на сутки: кому (user_id), когда (due_utc), что (kind + payload_key)."""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS send_plan (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            due_utc TEXT NOT NULL,
+            kind TEXT NOT NULL,
+            payload_key TEXT,
+            UNIQUE (user_id, kind, due_utc)
+        )
+    ''')
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_send_plan_due ON send_plan(due_utc)")
+
+async def _m008_blocked_users(db: Any, conn: aiosqlite.Connection):
+    """Причина и время блокировки бота пользователем (users.active = 0 ставится вместе с ними)."""
+    await add_columns(conn, "users", BLOCK_COLUMN_DEFS)
+
+async def _m009_dead_letters(db: Any, conn: aiosqlite.Connection):
+    """Сообщения, не доставленные после всех попыток: ошибка + всё нужное для повторной отправки."""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS dead_letters (
+            id INTEGER PRIMARY KEY,
+            source TEXT NOT NULL,
+            user_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            reply_markup TEXT,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            created_at TEXT NOT NULL,
+            replayed_at TEXT
+        )
+    ''')
+    await conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_dead_letters_open
+        ON dead_letters(id)
+        WHERE replayed_at IS NULL
+    """)
+
+async def _m010_job_leases(db: Any, conn: aiosqlite.Connection):
+    """Аренда задач планировщика (кто выполняет и до какого времени) и журнал запусков."""
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS job_leases (
+            job_id TEXT PRIMARY KEY,
+            holder TEXT NOT NULL,
+            acquired_at TEXT NOT NULL,
+            expires_at TEXT NOT NULL
+        ) WITHOUT ROWID
+    ''')
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS job_runs (
+            id INTEGER PRIMARY KEY,
+            job_id TEXT NOT NULL,
+            holder TEXT NOT NULL,
+            status TEXT NOT NULL,
+            started_at TEXT NOT NULL,
+            finished_at TEXT,
+            duration_ms REAL,
+            rows_scanned INTEGER NOT NULL DEFAULT 0,
+            messages_sent INTEGER NOT NULL DEFAULT 0,
+            error TEXT
+        )
+    ''')
+    await conn.execute("CREATE INDEX IF NOT EXISTS idx_job_runs_started ON job_runs(started_at)")
+
+async def _m011_active_before_block(db: Any, conn: aiosqlite.Connection):
+    """Значение active до блокировки: снятие блокировки возвращает его, а не active = 1."""
+    await add_columns(conn, "users", [("active_before_block", "INTEGER")])
+
+# Порядок и номера версий не меняются задним числом — новые шаги только дописываются в конец
+MIGRATIONS: List[Tuple[int, str, Callable[[Any, aiosqlite.Connection], Awaitable[None]]]] = [
+    (1, "users", _m001_users),
+    (2, "users_indexes", _m002_users_indexes),
+    (3, "challenge_history", _m003_challenge_history),
+    (4, "challenge_pending_index", _m004_challenge_pending_index),
+    (5, "broadcast_outbox", _m005_broadcast_outbox),
+    (6, "due_reminders", _m006_due_reminders),
+    (7, "send_plan", _m007_send_plan),
+    (8, "blocked_users", _m008_blocked_users),
+    (9, "dead_letters", _m009_dead_letters),
+    (10, "job_leases", _m010_job_leases),
+    (11, "active_before_block", _m011_active_before_block),
+]
+
+# ========== 🚀 ЗАПУСК ==========
+
+async def get_schema_version(conn: aiosqlite.Connection) -> int:
+    """Текущая версия схемы (0 — база ещё не знает о миграциях)."""
+    try:
+        async with conn.execute("SELECT MAX(version) FROM schema_version") as cursor:
+            row = await cursor.fetchone()
+    except aiosqlite.OperationalError:
+        return 0
+    return row[0] or 0
+
+async def run_migrations(db: Any, conn: aiosqlite.Connection) -> int:
+    """
+    Применяет недостающие шаги по порядку, каждый — в своей транзакции вместе с записью версии.
+    Возвращает итоговую версию схемы.
+    """
+    version = await get_schema_version(conn)
+    pending = [m for m in MIGRATIONS if m[0] > version]
+    if not pending:
+        return version
+
+    await conn.execute('''
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TEXT NOT NULL
+        )
+    ''')
+    await conn.commit()
+
+    for step_version, name, step in pending:
+        await conn.execute("BEGIN")
+        try:
+            await step(db, conn)
+            await conn.execute(
+                "INSERT INTO schema_version (version, name, applied_at) VALUES (?, ?, ?)",
+                (step_version, name, datetime.now(timezone.utc).isoformat())
+            )
+            await conn.commit()
+        except BaseException:
+            await conn.rollback()
+            logger.error(f"Migrations: step {step_version} ({name}) failed, rolled back.")
+            raise
+        logger.info(f"Migrations: applied {step_version} ({name}).")
+        version = step_version
+    return version
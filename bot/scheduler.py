@@ -1,21 +1,21 @@
 # 07 - bot/scheduler.py
 # ✅ APScheduler - планировщик задач
-#✅ Центральная рассылка (03:00 UTC) с защитой от дублей
-#✅ Маркетинговые дожимы (8, 12, 15, 18 часов по локальному времени)
-#✅ Напоминания о челленджах (16:00 и +1 час)
-#✅ Проверка истечения демо
+#✅ План отправок на сутки (send_plan): утро 03:00 UTC, дожимы 8/12/15/18 и челлендж 16:00
+#   по локальному времени, предупреждение за 24 часа до конца демо
+#✅ Допланировка каждый час на 2 часа вперёд: новые пользователи и сменившие пояс/статус — в тот же день
+#✅ Диспетчер раз в минуту: наступившие строки плана → проверка условий → outbox
+#✅ Напоминание через час после принятия челленджа (таблица due_reminders)
 #✅ Ежедневный бэкап базы данных (03:05 UTC)
+#✅ Задачи без наложений: max_instances=1, coalesce, аренда в SQLite и журнал запусков (bot/jobs.py)
 
 # 07 - bot/scheduler.py - ФИНАЛЬНАЯ ВЕРСИЯ (30.01.2026)
 # Планировщик задач (APScheduler)
 # ✅ ПРОВЕРЕНО: Защита от дублей, маркетинг 3+1+3, бэкапы
 
 import asyncio
-import shutil
-import random
 import json
 from datetime import datetime, timezone, timedelta
-from typing import List, Any, Dict, Tuple
+from typing import List, Any, Dict, Iterable, Tuple
 from pathlib import Path
 
 from aiogram import Bot
@@ -24,50 +24,46 @@ from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
 
 from bot.config import logger, settings
-from bot.localization import t, DEFAULT_LANG
-from bot.database import db
-from bot.utils import get_user_tz, get_user_lang, is_demo_expired, safe_send
-from bot.challenges import check_challenges_reminder
-
-scheduler = AsyncIOScheduler(timezone="UTC")
+from bot.localization import t
+from bot.database import db, FOLLOWUP_MAX_DELAY
+from bot.backup import make_backup, cleanup
+from bot.content import get_category
+from bot.broadcast import Outgoing, ensure_delivery, outbox_row, stop_delivery
+from bot.utils import get_user_tz, get_user_lang
+from bot.challenges import challenge_day_reminder_text, send_challenge_hour_reminder
+from bot.jobs import JOB_DEFAULTS, SCHEDULER_EVENTS, leased, note_job, on_scheduler_event
+
+scheduler = AsyncIOScheduler(timezone="UTC", job_defaults=JOB_DEFAULTS)
+scheduler.add_listener(on_scheduler_event, SCHEDULER_EVENTS)
+
+# Колонки, которые реально читает диспетчер (без JSON-истории и FSM)
+PLAN_COLUMNS = (
+    "name", "language", "timezone", "active", "is_paid", "status",
+    "demo_expiration", "last_broadcast_date", "sent_expiry_warning", "blocked_at",
+)
+
+MORNING_HOUR_UTC = 3
+MARKETING_HOURS = {8: "reminder_8", 12: "reminder_12", 15: "reminder_15", 18: "reminder_18"}
+CHALLENGE_REMINDER_HOUR = 16
+DEMO_WARNING_BEFORE = timedelta(hours=24)
+BOOKKEEPING_BATCH = 500  # сколько строк плана обрабатывать и сколько служебных обновлений копить за раз
+PLAN_MAX_DELAY = timedelta(minutes=30)  # строки плана, опоздавшие сильнее (бот стоял), не отправляются
+PLAN_REFRESH_AHEAD = timedelta(hours=2)  # окно ежечасной допланировки (больше часа между запусками)
+
+# Типы строк send_plan
+KIND_MORNING = "morning"
+KIND_MARKETING = "marketing"  # payload_key — ключ текста reminder_8 ... reminder_18
+KIND_CHALLENGE = "challenge_nudge"
+KIND_DEMO_EXPIRY = "demo_expiry"
+
+# Дожим: демо истекло (или не задано), не оплачено, не "День тишины"
+MARKETING_WHERE = (
+    "is_paid = 0 AND (demo_expiration IS NULL OR demo_expiration <= ?) "
+    "AND IFNULL(status, '') != 'cooldown'"
+)
 
 # --- 🛡️ ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ БЕЗОПАСНОСТИ ---
 
-def safe_choice(items: List[Any]) -> Any | None:
-    """Безопасный выбор случайного элемента из списка."""
-    if not items:
-        return None
-    return random.choice(items)
-
-def _safe_get_text(phrase_raw: Any) -> str | None:
-    """Безопасное извлечение текста из фразы."""
-    if not phrase_raw:
-        return None
-    try:
-        if isinstance(phrase_raw, dict):
-            text = phrase_raw.get("text")
-            if isinstance(text, str) and text.strip():
-                return text
-            return None
-        elif isinstance(phrase_raw, str) and phrase_raw.strip():
-            return phrase_raw
-        return None
-    except Exception as e:
-        logger.error(f"Error extracting text: {e}")
-        return None
-
-def _safe_format_text(text: str, user_name: str) -> str:
-    """Безопасное форматирование текста с именем."""
-    if not user_name:
-        return text.replace("{name}", "").strip()
-    try:
-        if "{name}" in text:
-            return text.format(name=user_name)
-        return text
-    except Exception as e:
-        logger.error(f"Error formatting text with name '{user_name}': {e}")
-        return text.replace("{name}", "").strip()
-
 def _safe_get_user_tz(user_data: Dict[str, Any]):
     """Безопасное получение часового пояса."""
     try:
@@ -76,186 +72,375 @@ def _safe_get_user_tz(user_data: Dict[str, Any]):
         logger.warning(f"Error getting user timezone, using default: {e}")
         return get_user_tz({})
 
-# --- 📢 ГЛАВНАЯ РАССЫЛКА (КОНТЕНТ + МАРКЕТИНГ) ---
-
-async def centralized_broadcast_job(bot: Bot, static_data: dict):
+class ZoneClock:
     """
-    Ультимативная рассылка:
-    1. 03:00 UTC - Утренний контент или Маркетинг 'Дня тишины'.
-    2. 08, 12, 15, 18 Local - Дожим на оплату (если демо истекло).
+    Локальное время по часовым поясам на один момент now_utc.
+    Пояс вычисляется один раз за прогон (юзеров тысячи, поясов — десятки); DST учитывает zoneinfo.
     """
-    from bot.keyboards import get_broadcast_keyboard
-    
-    now_utc = datetime.now(timezone.utc)
-    today_str = now_utc.date().isoformat()
-    MARKETING_HOURS = {8: "reminder_8", 12: "reminder_12", 15: "reminder_15", 18: "reminder_18"}
-    
+    def __init__(self, now_utc: datetime):
+        self.now_utc = now_utc
+        self._local: Dict[Any, datetime] = {}
+
+    def local(self, tz_name: Any) -> datetime:
+        local_now = self._local.get(tz_name)
+        if local_now is None:
+            local_now = self._local[tz_name] = self.now_utc.astimezone(_safe_get_user_tz({"timezone": tz_name}))
+        return local_now
+
+def _local_hour_starts(tz_name: Any, hour: int, start: datetime, end: datetime) -> List[datetime]:
+    """UTC-моменты начала локального часа hour в поясе tz_name, попадающие в [start, end) (с учётом DST)."""
+    tz = _safe_get_user_tz({"timezone": tz_name})
+    day = start.astimezone(tz).date() - timedelta(days=1)
+    last = end.astimezone(tz).date() + timedelta(days=1)
+    starts = []
+    while day <= last:
+        due = datetime(day.year, day.month, day.day, hour, tzinfo=tz).astimezone(timezone.utc)
+        if start <= due < end:
+            starts.append(due)
+        day += timedelta(days=1)
+    return starts
+
+def _parse_utc(value: Any) -> datetime | None:
     try:
-        users_db = await db.get_all_users()
-    except Exception as e:
-        logger.critical(f"Failed to load users: {e}")
-        return
-
-    sent_count = 0
-    for chat_id_str, user_data in users_db.items():
-        try:
-            chat_id = int(chat_id_str)
-            lang = get_user_lang(user_data)
-            user_tz = _safe_get_user_tz(user_data)
-            
-            # Локальное время пользователя
-            local_now = now_utc.astimezone(user_tz)
-            local_hour = local_now.hour
-
-            # 🛡️ ЗАЩИТА ОТ ДУБЛЕЙ (Проверка Часа)
-            # Формат: "2026-01-30_08" - если уже слали в этот час, пропускаем
-            last_ts = user_data.get("last_broadcast_date", "")
-            if last_ts == f"{today_str}_{local_hour}":
-                continue
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00')).replace(tzinfo=timezone.utc)
+    except (TypeError, ValueError):
+        return None
 
-            # 🛡️ SMART BAN (Если заблокировал или неактивен)
-            if not user_data.get("active", True):
-                continue
+def _is_expired_at(user_data: Dict[str, Any], moment: datetime) -> bool:
+    """is_demo_expired на заданный момент (диспетчер проверяет условия на время строки плана)."""
+    if user_data.get("is_paid"):
+        return False
+    exp_dt = _parse_utc(user_data.get("demo_expiration"))
+    return exp_dt is None or moment > exp_dt
 
-            is_expired = await is_demo_expired(user_data)
-            is_paid = user_data.get("is_paid", False)
-
-            # --- А) УТРЕННИЙ БЛОК (03:00 UTC) ---
-            if now_utc.hour == 3:
-                # Для активных - контент
-                if not is_expired or is_paid:
-                    data = static_data.get("morning_phrases", {})
-                    phrases = data.get(lang, data.get(DEFAULT_LANG, []))
-                    phrase_raw = safe_choice(phrases)
-                    text = _safe_get_text(phrase_raw)
-                    if text:
-                        phrase = _safe_format_text(text, user_data.get("name") or "друг")
-                        kb = get_broadcast_keyboard(lang, quote_text=phrase, category="morning_phrases", user_name=user_data.get("name") or "друг")
-                        await safe_send(bot, chat_id, phrase, reply_markup=kb)
-                
-                # Для "Дня тишины" - маркетинговый призыв
-                elif user_data.get("status") == "cooldown":
-                    await safe_send(bot, chat_id, t('marketing_quiet_day', lang))
-
-            # --- Б) МАРКЕТИНГОВЫЙ ДОЖИМ (8, 12, 15, 18 Local Time) ---
-            elif local_hour in MARKETING_HOURS and is_expired and not is_paid:
-                msg_key = MARKETING_HOURS[local_hour]
-                # Шлем только если это не статус cooldown (в тишине не дожимаем лишний раз)
-                if user_data.get("status") != "cooldown":
-                    await safe_send(bot, chat_id, t(msg_key, lang, name=user_data.get("name") or "друг"))
-
-            # Обновляем метку времени, чтобы не было дублей в рамках этого часа
-            await db.update_user(chat_id, last_broadcast_date=f"{today_str}_{local_hour}")
-            sent_count += 1
-            await asyncio.sleep(0.05)  # Flood protection
-
-        except Exception as e:
-            logger.error(f"Error in broadcast loop for {chat_id_str}: {e}")
-
-    if sent_count > 0:
-        logger.info(f"📊 Broadcast: Sent {sent_count} messages.")
-
-# --- 🎯 ЧЕЛЛЕНДЖИ (ЕЖЕЧАСНАЯ ПРОВЕРКА) ---
-
-async def challenges_reminder_job(bot: Bot):
+# --- 🗓️ ПЛАН ОТПРАВОК НА СУТКИ ---
+
+def _is_morning_slot(due: datetime) -> bool:
+    return due.hour == MORNING_HOUR_UTC and due.minute == 0
+
+async def build_send_plan(start: datetime, end: datetime) -> Dict[str, int]:
+    """
+    Заполняет send_plan на [start, end). Повторный вызов добавляет только новое (UNIQUE),
+    поэтому план можно пересобирать — например, чтобы захватить новых пользователей.
+    Условия, которые могут измениться (оплата, выполнение челленджа), диспетчер проверяет ещё раз.
     """
-    Вызывает логику из challenges.py.
-    Сама определяет: 16:00 (принятие) или +1 час (выполнение).
+    rows: List[Tuple[int, str, str, str | None]] = []
+    planned: Dict[str, int] = {}
+
+    def add(user_ids: Iterable[int], due: datetime, kind: str, key: str | None = None):
+        due_str = due.isoformat()
+        before = len(rows)
+        rows.extend((uid, due_str, kind, key) for uid in user_ids)
+        planned[kind] = planned.get(kind, 0) + len(rows) - before
+
+    # А) Утро: 03:00 UTC каждого дня — всем активным
+    day = start.replace(hour=MORNING_HOUR_UTC, minute=0, second=0, microsecond=0)
+    mornings = []
+    while day < end:
+        if day >= start:
+            mornings.append(day)
+        day += timedelta(days=1)
+    if mornings:
+        active_ids = [u["user_id"] async for u in db.iter_users(columns=("timezone",), where="active = 1")]
+        for due in mornings:
+            add(active_ids, due, KIND_MORNING)
+
+    # Б) Дожимы и челлендж 16:00: пояса с одинаковым UTC-моментом — одним запросом
+    groups: Dict[Tuple[str, str | None, datetime], List[Any]] = {}
+    for tz_name in await db.get_timezone_buckets():
+        for hour, key in MARKETING_HOURS.items():
+            for due in _local_hour_starts(tz_name, hour, start, end):
+                # Дожим, совпавший с утренней рассылкой (08:00 при UTC+5 = 03:00 UTC), не планируется:
+                # обе строки проверялись бы по одному last_broadcast_date и ушли бы обе.
+                # Как и раньше (if/elif в одном запуске), в этот момент — только утро
+                if _is_morning_slot(due):
+                    continue
+                groups.setdefault((KIND_MARKETING, key, due), []).append(tz_name)
+        for due in _local_hour_starts(tz_name, CHALLENGE_REMINDER_HOUR, start, end):
+            groups.setdefault((KIND_CHALLENGE, None, due), []).append(tz_name)
+    for (kind, key, due), zones in sorted(groups.items(), key=lambda g: g[0][2]):
+        if kind == KIND_MARKETING:
+            users = await db.get_users_in_timezones(
+                zones, columns=("timezone",), where=MARKETING_WHERE, params=(due.isoformat(),)
+            )
+        else:
+            users = await db.get_users_in_timezones(zones, columns=("timezone",))
+        add((u["user_id"] for u in users), due, kind, key)
+
+    # В) Предупреждение за 24 часа до конца демо (уже попавшие в окно — сразу, с начала плана)
+    for u in await db.get_expiring_demos(start.isoformat(), (end + DEMO_WARNING_BEFORE).isoformat()):
+        exp_dt = _parse_utc(u.get("demo_expiration"))
+        if exp_dt is not None:
+            add((u["user_id"],), max(exp_dt - DEMO_WARNING_BEFORE, start), KIND_DEMO_EXPIRY)
+
+    added = await db.add_plan_rows(rows)
+    logger.info(f"🗓️ Send plan {start:%Y-%m-%d %H:%M}..{end:%Y-%m-%d %H:%M}: {planned}, {added} new rows.")
+    return planned
+
+async def send_plan_job(now: datetime | None = None, ahead: timedelta | None = None):
     """
-    users_db = await db.get_all_users()
-    for chat_id_str, user_data in users_db.items():
-        if not user_data.get("active", True):
-            continue
-        try:
-            lang = get_user_lang(user_data)
-            await check_challenges_reminder(bot, int(chat_id_str), user_data, lang)
-        except Exception as e:
-            logger.error(f"Error in challenge reminder: {e}")
+    План на остаток сегодняшних UTC-суток и на завтра (завтра виден в предпросмотре админки).
+    ahead — только ближайшее окно: ежечасная допланировка новых пользователей и тех, кто сменил
+    пояс, вернулся из "Дня тишины" или снова стал активным (план строится по состоянию на момент сборки).
+    """
+    now_utc = now or datetime.now(timezone.utc)
+    if ahead is not None:
+        end = now_utc + ahead
+    else:
+        end = (now_utc + timedelta(days=2)).replace(hour=0, minute=0, second=0, microsecond=0)
+    planned = await build_send_plan(now_utc, end)
+    note_job(scanned=sum(planned.values()))
 
-# --- ⏰ СИСТЕМНЫЕ ЗАДАЧИ ---
+# --- 📢 ДИСПЕТЧЕР: ПЛАН → OUTBOX ---
 
-async def check_demo_expiry_job(bot: Bot):
-    """Предупреждение за 24 часа до конца демо."""
-    users_db = await db.get_all_users()
-    now_utc = datetime.now(timezone.utc)
-    for chat_id_str, u in users_db.items():
-        if u.get("is_paid") or u.get("sent_expiry_warning"):
-            continue
-        exp_str = u.get("demo_expiration")
-        if exp_str:
-            exp_dt = datetime.fromisoformat(exp_str.replace('Z', '+00:00')).replace(tzinfo=timezone.utc)
-            if timedelta(hours=0) < (exp_dt - now_utc) <= timedelta(hours=24):
-                lang = get_user_lang(u)
-                await safe_send(bot, int(chat_id_str), t("demo_expiry_warning", lang))
-                await db.update_user(int(chat_id_str), sent_expiry_warning=True)
+def _render_planned(
+    row: Dict[str, Any], static_data: dict, due: datetime, local_now: datetime, has_challenge: bool
+) -> Tuple[Outgoing | None, Dict[str, Any]]:
+    """
+    Повторная проверка условий на момент строки плана и текст сообщения.
+    Возвращает (сообщение или None, служебные поля users для записи).
+    """
+    from bot.keyboards import get_broadcast_keyboard
+
+    user_id, kind = row["user_id"], row["kind"]
+    lang = get_user_lang(row)
+    name = row.get("name") or "друг"
+    # 🛡️ ЗАЩИТА ОТ ДУБЛЕЙ (Проверка Часа) — формат "2026-01-30_08"
+    slot = f"{due.date().isoformat()}_{local_now.hour}"
+    stamp = {"user_id": user_id, "last_broadcast_date": slot}
+
+    # 🛡️ SMART BAN (Если заблокировал или неактивен)
+    if not row.get("active", True):
+        return None, {}
+
+    if kind == KIND_DEMO_EXPIRY:
+        exp_dt = _parse_utc(row.get("demo_expiration"))
+        if row.get("is_paid") or row.get("sent_expiry_warning") or exp_dt is None:
+            return None, {}
+        if not timedelta(0) < exp_dt - due <= DEMO_WARNING_BEFORE:
+            return None, {}
+        return Outgoing(user_id, t("demo_expiry_warning", lang)), {"user_id": user_id, "sent_expiry_warning": True}
+
+    if kind == KIND_CHALLENGE:
+        # Пояс сменили после планирования — в этом поясе сейчас не 16:00
+        if local_now.hour != CHALLENGE_REMINDER_HOUR or has_challenge:
+            return None, {}
+        return Outgoing(user_id, challenge_day_reminder_text(row)), {}
+
+    if row.get("last_broadcast_date", "") == slot:
+        return None, {}
+    is_expired = _is_expired_at(row, due)
+    is_paid = row.get("is_paid", False)
+
+    # --- А) УТРЕННИЙ БЛОК (03:00 UTC) ---
+    if kind == KIND_MORNING:
+        # Для активных - контент
+        if not is_expired or is_paid:
+            entry = get_category(static_data, "morning_phrases").choice(lang)
+            if entry is not None:
+                phrase = entry.render(name)
+                kb = get_broadcast_keyboard(lang, user_name=name, entry=entry)
+                return Outgoing(user_id, phrase, {"reply_markup": kb}), stamp
+        # Для "Дня тишины" - маркетинговый призыв
+        elif row.get("status") == "cooldown":
+            return Outgoing(user_id, t('marketing_quiet_day', lang)), stamp
+        return None, stamp
+
+    # --- Б) МАРКЕТИНГОВЫЙ ДОЖИМ (8, 12, 15, 18 Local Time) ---
+    if kind == KIND_MARKETING:
+        # Текст — по локальному часу сейчас, а не по payload_key: после смены пояса строка старого
+        # пояса может прийтись на другой час дожима нового (UNIQUE не даст запланировать вторую)
+        key = MARKETING_HOURS.get(local_now.hour)
+        if key is None:
+            return None, {}
+        # Шлем только если это не статус cooldown (в тишине не дожимаем лишний раз)
+        if is_expired and not is_paid and row.get("status") != "cooldown":
+            return Outgoing(user_id, t(key, lang, name=name)), stamp
+        return None, stamp
+
+    logger.warning(f"Send plan: unknown kind '{kind}' for user {user_id}")
+    return None, {}
+
+async def dispatch_due_job(bot: Bot, static_data: dict, now: datetime | None = None) -> int:
+    """
+    Раз в минуту: наступившие строки плана → проверка условий → outbox → доставка в фоне.
+    Работа за тик зависит только от числа наступивших строк. Возвращает число поставленных сообщений.
+    """
+    now_utc = now or datetime.now(timezone.utc)
+    since = now_utc - PLAN_MAX_DELAY
+    dropped = await db.drop_overdue_plan(since.isoformat())
+    if dropped:
+        logger.warning(f"Send plan: {dropped} overdue rows dropped (older than {PLAN_MAX_DELAY}).")
+
+    clocks: Dict[str, ZoneClock] = {}
+    queued = 0
+    while rows := await db.get_due_plan(since.isoformat(), now_utc.isoformat(), PLAN_COLUMNS, BOOKKEEPING_BATCH):
+        # Челлендж 16:00: кто уже принял челлендж в свой локальный день — одним запросом на день
+        local: Dict[int, datetime] = {}
+        by_day: Dict[str, List[int]] = {}
+        for row in rows:
+            clock = clocks.get(row["due_utc"])
+            if clock is None:
+                clock = clocks[row["due_utc"]] = ZoneClock(datetime.fromisoformat(row["due_utc"]))
+            local[row["plan_id"]] = clock.local(row.get("timezone", settings.DEFAULT_TZ_KEY))
+            if row["kind"] == KIND_CHALLENGE:
+                by_day.setdefault(local[row["plan_id"]].date().isoformat(), []).append(row["user_id"])
+        challenged = {(day, uid) for day, ids in by_day.items() for uid in await db.get_users_with_challenge(day, ids)}
+
+        by_run: Dict[str, List[Dict[str, Any]]] = {}
+        stamps: List[Dict[str, Any]] = []
+        for row in rows:
+            if row.get("blocked_at"):
+                # Заблокировал бота: строка плана снимается без запроса к Telegram
+                db.count_avoided_sends()
+                continue
+            try:
+                local_now = local[row["plan_id"]]
+                outgoing, stamp = _render_planned(
+                    row, static_data, datetime.fromisoformat(row["due_utc"]), local_now,
+                    (local_now.date().isoformat(), row["user_id"]) in challenged,
+                )
+            except Exception as e:
+                logger.error(f"Error in send plan for {row['user_id']} ({row['kind']}): {e}")
+                continue
+            if outgoing is not None:
+                # Один запуск outbox на (тип, момент): повторная обработка строки не даст дубля
+                by_run.setdefault(f"{row['kind']}_{row['due_utc']}", []).append(outbox_row(outgoing))
+            if stamp:
+                stamps.append(stamp)
+
+        # Порядок важен: outbox → метки → удаление строк плана. Сбой между шагами повторит
+        # обработку строки на следующем тике, а UNIQUE(run_id, user_id) в outbox отсечёт дубль
+        for run_id, items in by_run.items():
+            queued += await db.enqueue_outbox(run_id, items)
+        if stamps:
+            await db.update_users_bulk(stamps)
+        await db.delete_plan_rows(row["plan_id"] for row in rows)
+        note_job(scanned=len(rows))
+
+    note_job(sent=queued)
+    if queued:
+        logger.info(f"📢 Send plan: {queued} messages queued.")
+    # Доставка идёт в фоне и не держит тик; заодно подбирает недоставленное раньше
+    ensure_delivery(bot)
+    return queued
+
+# --- 🎯 ЧЕЛЛЕНДЖИ: НАПОМИНАНИЕ ЧЕРЕЗ ЧАС ---
+
+async def challenge_followup_job(bot: Bot, now: datetime | None = None):
+    """Напоминание через час после принятия челленджа: строки due_reminders, чей срок наступил."""
+    now_utc = now or datetime.now(timezone.utc)
+    rows = await db.take_due_followups(now_utc.isoformat(), (now_utc - FOLLOWUP_MAX_DELAY).isoformat())
+    sent = 0
+    for row in rows:
+        sent += bool(await send_challenge_hour_reminder(bot, row))
+    note_job(scanned=len(rows), sent=sent)
+
+# --- ⏰ СИСТЕМНЫЕ ЗАДАЧИ ---
 
 async def backup_job(bot: Bot):
-    """Ежедневный бэкап базы в 03:05 UTC."""
+    """Ежедневный бэкап базы в 03:05 UTC (полный снимок или дельта, см. bot/backup.py)."""
     if not settings.DB_FILE.exists(): return
-    BACKUP_DIR = settings.DATA_DIR / "backups"
-    timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M")
-    backup_path = BACKUP_DIR / f"fotinia_{timestamp}.db"
     
     try:
-        BACKUP_DIR.mkdir(exist_ok=True, parents=True)
-        shutil.copy2(settings.DB_FILE, backup_path)
+        result = await asyncio.to_thread(
+            make_backup, settings.DB_FILE, settings.BACKUP_DIR,
+            settings.BACKUP_FULL_EVERY_DAYS, settings.BACKUP_COMPRESS,
+        )
+        kind = "Full" if result.kind == "full" else "Delta"
+        check = "✅ restore verified" if result.verified else "❌ restore check FAILED"
         await bot.send_document(
             chat_id=settings.ADMIN_CHAT_ID, 
-            document=FSInputFile(backup_path), 
-            caption=f"📦 <b>Daily Backup</b>\n📅 {timestamp}"
+            document=FSInputFile(result.path), 
+            caption=(
+                f"📦 <b>Daily Backup ({kind})</b>\n📄 {result.path.name}\n"
+                f"🧩 {result.pages_changed}/{result.pages_total} pages, {result.size // 1024} KB\n{check}"
+            )
         )
-        # Очистка старых (30+ дней)
-        limit = datetime.now(timezone.utc) - timedelta(days=30)
-        for old in BACKUP_DIR.glob("fotinia_*.db"):
-            if datetime.fromtimestamp(old.stat().st_mtime, tz=timezone.utc) < limit:
-                old.unlink()
+        # Очистка старых (BACKUP_KEEP_DAYS+ дней), базовый полный снимок не удаляется
+        await asyncio.to_thread(cleanup, settings.BACKUP_DIR, settings.BACKUP_KEEP_DAYS)
     except Exception as e:
         logger.error(f"Backup failed: {e}")
 
+    try:
+        # Журнал доставленных рассылок за OUTBOX_KEEP_DAYS+ дней больше не нужен
+        keep_from = (datetime.now(timezone.utc) - timedelta(days=settings.OUTBOX_KEEP_DAYS)).isoformat()
+        removed = await db.cleanup_outbox(keep_from)
+        removed_dead = await db.cleanup_dead_letters(keep_from)
+        await db.cleanup_job_runs(
+            (datetime.now(timezone.utc) - timedelta(days=settings.JOB_RUNS_KEEP_DAYS)).isoformat()
+        )
+        if removed or removed_dead:
+            logger.info(f"Outbox: removed {removed} old rows and {removed_dead} dead letters.")
+    except Exception as e:
+        logger.error(f"Outbox cleanup failed: {e}")
+
 # --- 🔧 НАСТРОЙКА ПЛАНИРОВЩИКА ---
 
-async def setup_jobs_and_cache(bot: Bot, users_db: dict, static_data: dict):
+async def setup_jobs_and_cache(bot: Bot, static_data: dict):
     """Инициализация APScheduler с новой логикой."""
     logger.info("⏰ Настройка планировщика (Ultimate Production)...")
     
     for job in scheduler.get_jobs():
         scheduler.remove_job(job.id)
 
-    # 1. Центральная рассылка (Каждые 30 минут, чтобы точно ловить начало часа)
-    # Защита внутри функции не даст отправить дважды.
+    # Каждая задача выполняется под арендой (bot/jobs.py): один запуск за раз на все процессы,
+    # плюс JOB_DEFAULTS планировщика (max_instances=1, coalesce, misfire_grace_time)
+
+    # 1. План отправок: сразу при старте и каждый день в 02:40 UTC (до утренней рассылки,
+    # чтобы захватить пользователей, пришедших после вчерашнего планирования)
     scheduler.add_job(
-        centralized_broadcast_job,
-        CronTrigger(minute="0,30"),
-        args=[bot, static_data],
-        id="main_broadcast_job"
+        leased("send_plan_job", ttl=300)(send_plan_job),
+        CronTrigger(hour=2, minute=40),
+        id="send_plan_job",
+        next_run_time=datetime.now(timezone.utc),
+        misfire_grace_time=3600,
     )
 
-    # 2. Челленджи (Раз в 30 минут для 16:00 и напоминаний через час)
+    # 1а. Допланировка каждый час на PLAN_REFRESH_AHEAD вперёд: новые пользователи и сменившие
+    # пояс/статус получают рассылки в тот же день, а не после ночного плана. Уже запланированное
+    # не дублируется (UNIQUE), устаревшие строки отсеивает диспетчер (активность, пояс, статус)
     scheduler.add_job(
-        challenges_reminder_job,
-        CronTrigger(minute="5,35"),
-        args=[bot],
-        id="challenge_reminder_job"
+        leased("send_plan_refresh_job", ttl=300)(send_plan_job),
+        CronTrigger(minute=50),
+        kwargs={"ahead": PLAN_REFRESH_AHEAD},
+        id="send_plan_refresh_job",
+    )
+
+    # 2. Диспетчер плана: утро, дожимы, челлендж 16:00, предупреждение о конце демо
+    scheduler.add_job(
+        leased("send_plan_dispatch_job")(dispatch_due_job),
+        CronTrigger(minute="*"),
+        args=[bot, static_data],
+        id="send_plan_dispatch_job"
     )
 
-    # 3. Демо-статус (Раз в 4 часа)
+    # 3. Напоминания через час после принятия челленджа (каждую минуту по сроку)
     scheduler.add_job(
-        check_demo_expiry_job,
-        CronTrigger(hour="0,4,8,12,16,20"),
+        leased("challenge_followup_job")(challenge_followup_job),
+        CronTrigger(minute="*"),
         args=[bot],
-        id="demo_status_job"
+        id="challenge_followup_job"
     )
 
     # 4. Бэкап (Раз в сутки в 03:05 UTC)
     scheduler.add_job(
-        backup_job,
+        leased("backup_system_job", ttl=600)(backup_job),
         CronTrigger(hour=3, minute=5),
         args=[bot],
-        id="backup_system_job"
+        id="backup_system_job",
+        misfire_grace_time=3600,
     )
 
     if not scheduler.running:
         scheduler.start()
         logger.info("✅ APScheduler запущен успешно.")
     else:
-        logger.info("✅ APScheduler задачи обновлены.")
\ No newline at end of file
+        logger.info("✅ APScheduler задачи обновлены.")
+
+async def stop_jobs():
+    """Процесс перестал быть лидером: задачи снимаются, фоновая доставка outbox останавливается."""
+    for job in scheduler.get_jobs():
+        scheduler.remove_job(job.id)
+    await stop_delivery()
+    logger.info("⏸️ Scheduler jobs removed (not the leader).")
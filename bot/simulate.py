@@ -0,0 +1,231 @@
+# 20 - bot/simulate.py
+# ✅ Пробный прогон задач планировщика без реальных отправок: Bot подменяется записывающим SimulatedBot
+# ✅ Задержка Telegram, RetryAfter и Forbidden с настраиваемой частотой (повторяемо через --seed)
+# ✅ Работа на копии базы (SQLite backup API), живая база и data/ не меняются
+# ✅ Отчёт: сообщений в секунду, время в базе против времени отправки, что получил бы каждый пользователь
+#
+# Требует те же переменные окружения, что и бот (.env). Примеры:
+#   python -m bot.simulate dispatch --at 2026-10-19T03:00:00+00:00 --rate 1000
+#   python -m bot.simulate day --date 2026-10-19 --content ./new_content --out received.jsonl
+#   python -m bot.simulate followup --at 2026-10-19T12:00:00+00:00 --forbidden-rate 0.05
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import tempfile
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
+
+from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+
+from bot.backup import snapshot
+from bot.config import logger, settings
+from bot.database import db
+
+JOBS = ("plan", "dispatch", "followup", "day")
+
+# ========== 🤖 ПОДМЕНА BOT ==========
+
+@dataclass
+class SimulatedBot:
+    """
+    Вместо Telegram: записывает сообщения и ждёт latency (± jitter) секунд.
+    forbidden_rate — доля чатов, "заблокировавших бота" (решается один раз на чат),
+    retry_after_rate — доля отправок, получивших Flood control на retry_after секунд.
+    """
+    latency: float = 0.05
+    jitter: float = 0.02
+    forbidden_rate: float = 0.0
+    retry_after_rate: float = 0.0
+    retry_after: int = 1
+    seed: int = 0
+    sent: List[Dict[str, Any]] = field(default_factory=list)
+    send_seconds: float = 0.0
+    calls: int = 0
+    forbidden: int = 0
+    flood: int = 0
+
+    def __post_init__(self):
+        self._rng = random.Random(self.seed)
+        self._blocked: Dict[int, bool] = {}
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        self.calls += 1
+        delay = max(0.0, self.latency + self._rng.uniform(-self.jitter, self.jitter))
+        self.send_seconds += delay
+        await asyncio.sleep(delay)
+        if chat_id not in self._blocked:
+            self._blocked[chat_id] = self._rng.random() < self.forbidden_rate
+        if self._blocked[chat_id]:
+            self.forbidden += 1
+            raise TelegramForbiddenError(method=None, message="Forbidden: bot was blocked by the user")
+        if self._rng.random() < self.retry_after_rate:
+            self.flood += 1
+            raise TelegramRetryAfter(method=None, message="Flood control exceeded", retry_after=self.retry_after)
+        markup = kwargs.get("reply_markup")
+        self.sent.append({
+            "user_id": chat_id,
+            "text": text,
+            "buttons": [b.text for row in markup.inline_keyboard for b in row] if markup is not None else [],
+        })
+        return SimpleNamespace(message_id=len(self.sent), chat=SimpleNamespace(id=chat_id), text=text)
+
+    async def send_document(self, chat_id: int, document: Any, caption: str = "", **kwargs):
+        self.sent.append({"user_id": chat_id, "text": caption, "document": str(getattr(document, "path", document))})
+        return SimpleNamespace(message_id=len(self.sent), chat=SimpleNamespace(id=chat_id))
+
+# ========== 🧪 ПРОГОН ==========
+
+def _db_seconds() -> float:
+    stats = db.pool.stats()
+    return (stats["read"]["hold_total_ms"] + stats["write"]["hold_total_ms"]) / 1000
+
+async def run_job(
+    job: str, bot: SimulatedBot, static_data: dict, at: datetime, hours: float = 24
+) -> Dict[str, Any]:
+    """
+    Выполняет задачу на момент at и дожидается доставки outbox.
+    day — план в 02:40 UTC и диспетчер каждую минуту в течение hours часов (время сжато).
+    """
+    from bot import broadcast
+    from bot.scheduler import challenge_followup_job, dispatch_due_job, send_plan_job
+
+    started, db_before = time.perf_counter(), _db_seconds()
+    queued, job_seconds = 0, 0.0
+
+    async def timed(coro):
+        nonlocal job_seconds
+        t0 = time.perf_counter()
+        result = await coro
+        job_seconds += time.perf_counter() - t0
+        return result
+
+    if job == "plan":
+        await timed(send_plan_job(now=at))
+    elif job == "dispatch":
+        queued = await timed(dispatch_due_job(bot, static_data, now=at))
+    elif job == "followup":
+        await timed(challenge_followup_job(bot, now=at))
+    elif job == "day":
+        day = at.replace(hour=0, minute=0, second=0, microsecond=0)
+        await timed(send_plan_job(now=day.replace(hour=2, minute=40)))
+        tick = at
+        while tick < at + timedelta(hours=hours):
+            queued += await timed(dispatch_due_job(bot, static_data, now=tick))
+            await timed(challenge_followup_job(bot, now=tick))
+            # Доставка каждого тика до конца: порядок отправок как в проде, только без ожидания минуты
+            await broadcast.wait_delivery()
+            tick += timedelta(minutes=1)
+    else:
+        raise ValueError(f"Unknown job {job}, expected one of {JOBS}")
+    await broadcast.wait_delivery()
+
+    wall = time.perf_counter() - started
+    per_user = Counter(m["user_id"] for m in bot.sent)
+    return {
+        "job": job,
+        "at": at.isoformat(),
+        "queued": queued,
+        "sent": len(bot.sent),
+        "send_calls": bot.calls,
+        "forbidden": bot.forbidden,
+        "flood_control": bot.flood,
+        "users_reached": len(per_user),
+        "max_per_user": max(per_user.values(), default=0),
+        "wall_s": round(wall, 2),
+        "job_s": round(job_seconds, 2),
+        "db_s": round(_db_seconds() - db_before, 2),
+        "send_s_total": round(bot.send_seconds, 2),  # Сумма задержек всех отправок (по всем воркерам)
+        "msg_per_s": round(len(bot.sent) / wall, 1) if wall > 0 else 0.0,
+        "outbox": await db.get_outbox_stats(),
+        "dead_letters": await db.get_dead_letter_stats(),
+        "delivery": db.delivery_stats(),
+    }
+
+async def simulate(
+    job: str,
+    db_file: Path,
+    at: datetime,
+    bot: SimulatedBot,
+    content_dir: Optional[Path] = None,
+    out: Optional[Path] = None,
+    rate: Optional[float] = None,
+    hours: float = 24,
+) -> Dict[str, Any]:
+    """Копия базы → задача с SimulatedBot → отчёт (и JSONL с полученными сообщениями в out)."""
+    from bot import broadcast
+    from bot.user_loader import load_static_data
+
+    if rate:
+        broadcast.global_limiter.rate = rate
+        broadcast.global_limiter.capacity = max(1.0, rate)
+
+    with tempfile.TemporaryDirectory(prefix="fotinia_sim_") as tmp:
+        copy = Path(tmp) / "fotinia.db"
+        if db_file.exists():
+            snapshot(db_file, copy)
+        else:
+            logger.warning(f"Simulate: {db_file} not found, starting from an empty database.")
+        content = Path(tmp) / "data"
+        content.mkdir()
+        static_data = await load_static_data(data_dir=content, source_dir=content_dir)
+
+        db.use_file(str(copy))
+        await db.init()
+        try:
+            report = await run_job(job, bot, static_data, at, hours)
+        finally:
+            await db.close()
+
+    if out is not None:
+        with open(out, "w", encoding="utf-8") as f:
+            for message in bot.sent:
+                f.write(json.dumps(message, ensure_ascii=False) + "\n")
+        report["out"] = str(out)
+    return report
+
+# ========== 🖥️ CLI ==========
+
+def _parse_at(value: str) -> datetime:
+    at = datetime.fromisoformat(value)
+    return at if at.tzinfo else at.replace(tzinfo=timezone.utc)
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog="python -m bot.simulate", description="Пробный прогон рассылок без Telegram")
+    parser.add_argument("job", choices=JOBS)
+    parser.add_argument("--db", type=Path, default=settings.DB_FILE, help="База-источник (копируется)")
+    parser.add_argument("--at", type=_parse_at, default=None, help="Момент запуска (ISO, по умолчанию сейчас)")
+    parser.add_argument("--date", default=None, help="Для day: дата YYYY-MM-DD (с 00:00 UTC)")
+    parser.add_argument("--hours", type=float, default=24, help="Для day: сколько часов прогнать")
+    parser.add_argument("--content", type=Path, default=None, help="Папка с JSON контента вместо data_initial/")
+    parser.add_argument("--out", type=Path, default=None, help="JSONL: что получил бы каждый пользователь")
+    parser.add_argument("--rate", type=float, default=None, help="Лимит сообщений/с (по умолчанию BROADCAST_RATE)")
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--jitter", type=float, default=0.02)
+    parser.add_argument("--forbidden-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after-rate", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    if args.date:
+        at = _parse_at(f"{args.date}T00:00:00")
+    else:
+        at = args.at or datetime.now(timezone.utc)
+    bot = SimulatedBot(
+        latency=args.latency, jitter=args.jitter, forbidden_rate=args.forbidden_rate,
+        retry_after_rate=args.retry_after_rate, retry_after=args.retry_after, seed=args.seed,
+    )
+    report = asyncio.run(simulate(args.job, args.db, at, bot, args.content, args.out, args.rate, args.hours))
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
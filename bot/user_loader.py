@@ -1,115 +1,207 @@
 # 06 - bot/user_loader.py
-# ✅ Загрузка кэша пользователей из SQLite
 # ✅ Загрузка статических данных (челленджи, правила, мотивации)
 # ✅ Копирование файлов из data_initial/ в data/
-# ✅ Резервное сохранение кэша в JSON (на случай аварии)
+# ✅ Результат — ContentCatalog (bot/content.py), а не сырые JSON
+# ✅ Копируются только изменившиеся файлы (sha256), горячая перезагрузка изменившихся категорий
+# ✅ data_initial → data только при старте и по /reload; наблюдатель смотрит только data/
 
 # 06 - bot/user_loader.py - ФИНАЛЬНАЯ ВЕРСИЯ (22.02.2026)
 # Загрузка данных и кэширование
 # ✅ ПРОВЕРЕНО: Загрузка из SQLite, копирование data_initial, бэкап в JSON
 
 import asyncio
+import hashlib
 import json
+import os
 import shutil
-import tempfile
-from typing import Dict, Any, Union, List
+from dataclasses import dataclass
+from typing import Dict, Any, List, Optional, Tuple
 from pathlib import Path
 
-from bot.database import db
 from bot.config import logger, settings, FILE_MAPPING, DEFAULT_BROADCAST_KEYS
-from bot.localization import DEFAULT_LANG
+from bot.content import ContentCatalog, ContentCategory
 
-# --- Адаптер для загрузки пользователей ---
-async def load_users_with_fix() -> Dict[str, Any]:
-    """
-    Загружает кэш пользователей из SQLite.
-    """
-    users = await db.get_all_users()
-    logger.info(f"📖 Loaded {len(users)} users from SQLite (cache).")
-    return users
-
-# --- Адаптер для сохранения ---
-async def save_users_sync(users_db: Dict[str, Any]) -> None:
-    """
-    Делает экстренный снимок кэша в JSON файл (backup).
-    Основная работа идет в SQLite.
-    """
-    try:
-        settings.DATA_DIR.mkdir(exist_ok=True, parents=True)
-        await asyncio.to_thread(_save_json_snapshot, users_db)
-        logger.info("💾 Emergency JSON snapshot saved.")
-    except Exception as e:
-        logger.error(f"❌ Emergency save failed: {e}")
+@dataclass(frozen=True)
+class FileStamp:
+    """Подпись файла контента: mtime и размер — дешёвая проверка, sha256 — настоящая."""
+    mtime_ns: int
+    size: int
+    digest: str
 
-def _save_json_snapshot(users_db: Dict[str, Any]) -> None:
-    with tempfile.NamedTemporaryFile("w", delete=False, encoding="utf-8", dir=settings.DATA_DIR) as tmp:
-        clean_users_db = {uid: u for uid, u in users_db.items()}
-        json.dump(clean_users_db, tmp, ensure_ascii=False, indent=2)
-    shutil.move(tmp.name, settings.USERS_FILE)
+def _digest(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
 
 # --- Загрузка статики (Челленджи, Правила и т.д.) ---
-async def load_static_data() -> dict:
-    return await asyncio.to_thread(_load_static_data_sync)
-
-def _load_static_data_sync() -> dict:
-    DATA_DIR = settings.DATA_DIR
-    
-    # 1. Копируем файлы из data_initial (если есть новые)
-    source_data_dir = settings.DATA_INITIAL_DIR
+async def load_static_data(data_dir: Optional[Path] = None, source_dir: Optional[Path] = None) -> ContentCatalog:
+    """По умолчанию data_initial/ → data/. Симуляция передаёт свои папки, чтобы не трогать data/."""
+    return await asyncio.to_thread(_load_static_data_sync, data_dir, source_dir)
+
+def _sync_initial(source_data_dir: Path, data_dir: Path) -> List[str]:
+    """Копирует из data_initial только файлы с другим содержимым. Возвращает имена скопированных."""
+    copied: List[str] = []
     if not source_data_dir.exists():
         logger.warning(f"⚠️ data_initial not found at {source_data_dir}")
-    else:
-        DATA_DIR.mkdir(exist_ok=True, parents=True)
-        for item in source_data_dir.iterdir():
-            if item.is_file() and item.suffix == '.json' and item.name != 'users.json':
-                try:
-                    shutil.copy2(item, DATA_DIR / item.name)
-                except Exception as e:
-                    logger.error(f"❌ Failed to copy {item.name}: {e}")
-
-    static_data: Dict[str, Any] = {}
-    
-    def load_json(path: Path) -> Union[Dict, List, {}]:
-        if not path.exists():
-            logger.warning(f"⚠️ File not found: {path}")
-            return {}
+        return copied
+    data_dir.mkdir(exist_ok=True, parents=True)
+    for item in source_data_dir.iterdir():
+        if not (item.is_file() and item.suffix == '.json' and item.name != 'users.json'):
+            continue
+        target = data_dir / item.name
         try:
-            with open(path, 'r', encoding='utf-8-sig') as f:
-                return json.load(f)
-        except json.JSONDecodeError as e:
-            logger.error(f"❌ JSON Error in {path.name}: {e}")
-            return {}
+            src = item.stat()
+            if target.exists():
+                dst = target.stat()
+                # copy2 переносит mtime: совпали время и размер — файл уже скопирован
+                if (dst.st_mtime_ns, dst.st_size) == (src.st_mtime_ns, src.st_size):
+                    continue
+                if dst.st_size == src.st_size and _digest(target.read_bytes()) == _digest(item.read_bytes()):
+                    os.utime(target, ns=(src.st_atime_ns, src.st_mtime_ns))
+                    continue
+            shutil.copy2(item, target)
+            copied.append(item.name)
         except Exception as e:
-            logger.error(f"❌ Error loading {path.name}: {e}")
-            return {}
+            logger.error(f"❌ Failed to copy {item.name}: {e}")
+    if copied:
+        logger.info(f"📂 Copied from data_initial: {', '.join(sorted(copied))}")
+    return copied
 
-    # 2. Загружаем файлы по карте FILE_MAPPING
+def _read(path: Path) -> Tuple[Any, Optional[FileStamp], bool]:
+    """Сырые JSON, подпись файла и признак успешного разбора (ошибка — {} как раньше)."""
+    if not path.exists():
+        logger.warning(f"⚠️ File not found: {path}")
+        return {}, None, False
+    try:
+        st = path.stat()
+        data = path.read_bytes()
+    except Exception as e:
+        logger.error(f"❌ Error loading {path.name}: {e}")
+        return {}, None, False
+    stamp = FileStamp(st.st_mtime_ns, st.st_size, _digest(data))
+    try:
+        return json.loads(data.decode('utf-8-sig')), stamp, True
+    except (json.JSONDecodeError, UnicodeDecodeError) as e:
+        logger.error(f"❌ JSON Error in {path.name}: {e}")
+        return {}, stamp, False
+
+def _load_static_data_sync(data_dir: Optional[Path] = None, source_dir: Optional[Path] = None) -> ContentCatalog:
+    DATA_DIR = data_dir or settings.DATA_DIR
+
+    # 1. Копируем файлы из data_initial (только изменившиеся)
+    _sync_initial(source_dir or settings.DATA_INITIAL_DIR, DATA_DIR)
+
+    # 2. Загружаем файлы по карте FILE_MAPPING в каталог (кортежи записей, запасной язык уже подставлен)
+    catalog = ContentCatalog()
     for key, filename in FILE_MAPPING.items():
-        file_path = DATA_DIR / filename
-        raw_data = load_json(file_path)
-        
-        if not raw_data:
-            static_data[key] = {}
-            continue
-        
+        raw_data, stamp, _ = _read(DATA_DIR / filename)
+        catalog.swap(key, ContentCategory.build(key, raw_data), stamp)
         if key == "challenges":
-            if isinstance(raw_data, list):
-                logger.info(f"✅ Loaded {len(raw_data)} challenges (List format).")
-            elif isinstance(raw_data, dict):
-                count = sum(len(v) for v in raw_data.values())
-                logger.info(f"✅ Loaded {count} challenges (Dict format).")
-        
-        if isinstance(raw_data, list):
-            static_data[key] = {DEFAULT_LANG: raw_data}
-        elif isinstance(raw_data, dict):
-            static_data[key] = raw_data
-        else:
-            static_data[key] = {}
+            logger.info(f"✅ Loaded challenges: {catalog[key].stats()}")
 
     # --- Финальная проверка обязательных ключей ---
     for key in DEFAULT_BROADCAST_KEYS:
-        if key not in static_data or not static_data.get(key):
+        if not catalog.get(key):
             logger.error(f"❌ CRITICAL: Broadcast key '{key}' missing or empty in static_data!")
-            static_data[key] = {}
+            catalog.setdefault(key, ContentCategory.build(key, {}))
+
+    return catalog
+
+# --- 🔄 Горячая перезагрузка контента ---
+
+def _changed_sync(
+    stamps: Dict[str, FileStamp], data_dir: Path, source_dir: Optional[Path]
+) -> Dict[str, Tuple[Optional[ContentCategory], Optional[FileStamp]]]:
+    """
+    Ключ → (новая категория или None, новая подпись) только для изменившихся файлов.
+    None — менять нечего: совпал sha256 (тронули только время) или файл не разобрался.
+    source_dir=None — без копирования из data_initial (только проверка data/).
+    """
+    if source_dir is not None:
+        _sync_initial(source_dir, data_dir)
+    changes: Dict[str, Tuple[Optional[ContentCategory], Optional[FileStamp]]] = {}
+    for key, filename in FILE_MAPPING.items():
+        path = data_dir / filename
+        old = stamps.get(key)
+        try:
+            st = path.stat()
+        except OSError:
+            continue  # Файл пропал — остаётся то, что уже загружено
+        if old is not None and (old.mtime_ns, old.size) == (st.st_mtime_ns, st.st_size):
+            continue
+        raw_data, stamp, ok = _read(path)
+        if stamp is None:
+            continue
+        if not ok or (old is not None and old.digest == stamp.digest):
+            changes[key] = (None, stamp)
+            continue
+        changes[key] = (ContentCategory.build(key, raw_data), stamp)
+    return changes
+
+_refresh_lock = asyncio.Lock()
+
+async def refresh_static_data(
+    static_data: ContentCatalog, data_dir: Optional[Path] = None, source_dir: Optional[Path] = None,
+    sync_initial: bool = True,
+) -> List[str]:
+    """
+    Пересобирает только изменившиеся категории и подменяет их в том же объекте static_data,
+    который держат middleware и планировщик. Возвращает ключи заменённых категорий.
+    sync_initial — сначала скопировать изменившееся из data_initial (явный /reload, как при старте).
+    """
+    async with _refresh_lock:
+        changes = await asyncio.to_thread(
+            _changed_sync, dict(static_data.stamps), data_dir or settings.DATA_DIR,
+            (source_dir or settings.DATA_INITIAL_DIR) if sync_initial else None,
+        )
+        swapped: List[str] = []
+        for key, (category, stamp) in changes.items():
+            if category is None:
+                static_data.stamps[key] = stamp
+            elif not category and static_data.get(key):
+                # Пустой файл не затирает рабочий контент (например, сохранён на середине правки)
+                static_data.stamps[key] = stamp
+                logger.error(f"❌ Content: {key} is empty after reload, keeping the previous version.")
+            else:
+                static_data.swap(key, category, stamp)
+                swapped.append(key)
+        if swapped:
+            logger.info(f"🔄 Content reloaded: {', '.join(swapped)}")
+        return swapped
+
+class ContentWatcher:
+    """
+    Фоновая проверка файлов контента в data/ каждые interval секунд (mtime, затем sha256).
+    data_initial не копируется: иначе правка в data/ откатывалась бы образом на следующем тике.
+    """
+    def __init__(self, interval: Optional[float] = None):
+        self.interval = settings.CONTENT_WATCH_SECONDS if interval is None else interval
+        self._task: Optional[asyncio.Task] = None
+        self._stats: Dict[str, Any] = {"checks": 0, "reloads": 0, "errors": 0, "last_swapped": []}
+
+    def start(self, static_data: ContentCatalog, **dirs):
+        if self.interval > 0 and self._task is None:
+            self._task = asyncio.create_task(self._loop(static_data, dirs))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self, static_data: ContentCatalog, dirs: Dict[str, Path]):
+        while True:
+            await asyncio.sleep(self.interval)
+            self._stats["checks"] += 1
+            try:
+                swapped = await refresh_static_data(static_data, sync_initial=False, **dirs)
+            except Exception as e:
+                self._stats["errors"] += 1
+                logger.error(f"Content: watcher check failed: {e}")
+                continue
+            if swapped:
+                self._stats["reloads"] += 1
+                self._stats["last_swapped"] = swapped
+
+    def status(self) -> Dict[str, Any]:
+        return {"interval_s": self.interval, "running": self._task is not None, **self._stats}
 
-    return static_data
\ No newline at end of file
+content_watcher = ContentWatcher()
@@ -4,6 +4,7 @@
 # ✅ Система уровней для челленджей
 # ✅ AccessMiddleware (проверка доступа, Smart Ban 24h)
 # ✅ Безопасная отправка сообщений
+# ✅ Forbidden → пользователь помечается неактивным (причина + время), письмо боту снимает отметку
 
 # 05 - bot/utils.py - ФИНАЛЬНАЯ ВЕРСИЯ (30.01.2026)
 # Вспомогательные утилиты + Middlewares
@@ -16,12 +17,14 @@ import asyncio
 import json
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
-from typing import Any, Optional
+from typing import Any, Optional, Tuple
 
 from aiogram import Bot, BaseMiddleware
-from aiogram.types import Message
+from aiogram.types import Message, CallbackQuery
 from aiogram.enums import ParseMode
-from aiogram.exceptions import TelegramForbiddenError, TelegramRetryAfter
+from aiogram.exceptions import (
+    TelegramBadRequest, TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError,
+)
 
 from bot.config import settings, logger
 from bot.localization import t, Lang
@@ -82,18 +85,84 @@ def get_user_tz(user_data: dict):
 
 # --- 📤 БЕЗОПАСНАЯ ОТПРАВКА ---
 
-async def safe_send(bot: Bot, chat_id: int, text: str, **kwargs):
-    """Отправка сообщения с обработкой блокировок и Flood лимитов."""
+# Текст ошибки Telegram → код причины в users.blocked_reason
+BLOCK_REASONS = (
+    ("blocked by the user", "blocked_by_user"),
+    ("user is deactivated", "user_deactivated"),
+    ("kicked", "kicked"),
+    ("chat not found", "chat_not_found"),
+)
+
+def block_reason(error: str) -> str:
+    error = error.lower()
+    return next((code for text, code in BLOCK_REASONS if text in error), "forbidden")
+
+async def _mark_blocked(chat_id: int, error: str):
+    from bot.database import db
     try:
-        return await bot.send_message(chat_id, text, parse_mode=ParseMode.HTML, **kwargs)
-    except TelegramForbiddenError:
+        await db.mark_blocked(chat_id, block_reason(error))
+    except Exception as e:
+        logger.error(f"SafeSend: could not mark {chat_id} inactive: {e}")
+
+# Временные ошибки: сообщение можно отправить позже (у Flood control свой срок retry_after)
+TRANSIENT_ERRORS = (TelegramRetryAfter, TelegramNetworkError, TelegramServerError)
+
+def is_block_error(error: Optional[str]) -> bool:
+    """Ошибка означает, что пользователь недоступен (повторная отправка бесполезна)."""
+    error = (error or "").lower()
+    return "forbidden" in error or "chat not found" in error
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    """Через сколько секунд повторять: срок Telegram для Flood control, иначе 1, 2, 4... с."""
+    if isinstance(error, TelegramRetryAfter):
+        return float(error.retry_after)
+    return float(min(2 ** max(0, attempt - 1), 60))
+
+async def send_once(bot: Bot, chat_id: int, text: str, **kwargs) -> Tuple[Optional[Message], Optional[str]]:
+    """
+    Одна попытка отправки. Блокировки и постоянные ошибки → (None, текст ошибки),
+    временные (TRANSIENT_ERRORS) пробрасываются — повтор решает вызывающий.
+    """
+    try:
+        return await bot.send_message(chat_id, text, parse_mode=ParseMode.HTML, **kwargs), None
+    except TelegramForbiddenError as e:
         logger.warning(f"SafeSend: User {chat_id} blocked bot.")
-    except TelegramRetryAfter as e:
-        await asyncio.sleep(e.retry_after)
-        return await safe_send(bot, chat_id, text, **kwargs)
+        await _mark_blocked(chat_id, str(e))
+        return None, str(e)
+    except TelegramBadRequest as e:
+        logger.error(f"SafeSend: Error to {chat_id}: {e}")
+        # Удалённый аккаунт/чат: повторять отправку бесполезно, как и при Forbidden
+        if "chat not found" in str(e).lower():
+            await _mark_blocked(chat_id, str(e))
+        return None, str(e)
+    except TRANSIENT_ERRORS:
+        raise
     except Exception as e:
         logger.error(f"SafeSend: Error to {chat_id}: {e}")
-    return None
+        return None, str(e)
+
+async def send_with_error(bot: Bot, chat_id: int, text: str, **kwargs) -> Tuple[Optional[Message], Optional[str]]:
+    """
+    Как safe_send, но вместе с сообщением возвращает текст ошибки Telegram.
+    Временные ошибки повторяются на месте, не больше SEND_MAX_ATTEMPTS попыток
+    и не дольше SEND_RETRY_MAX_WAIT секунд ожидания за раз.
+    """
+    for attempt in range(1, settings.SEND_MAX_ATTEMPTS + 1):
+        try:
+            return await send_once(bot, chat_id, text, **kwargs)
+        except TRANSIENT_ERRORS as e:
+            delay = retry_delay(e, attempt)
+            if attempt == settings.SEND_MAX_ATTEMPTS or delay > settings.SEND_RETRY_MAX_WAIT:
+                logger.error(f"SafeSend: Giving up on {chat_id} after {attempt} attempts: {e}")
+                return None, str(e)
+            logger.warning(f"SafeSend: {chat_id} attempt {attempt} failed ({e}), retry in {delay:.0f} s.")
+            await asyncio.sleep(delay)
+    return None, "no attempts"
+
+async def safe_send(bot: Bot, chat_id: int, text: str, **kwargs):
+    """Отправка сообщения с обработкой блокировок и Flood лимитов."""
+    message, _ = await send_with_error(bot, chat_id, text, **kwargs)
+    return message
 
 def get_progress_bar(percent: int, length: int = 10) -> str:
     """Визуальный прогресс-бар (0-100%)."""
@@ -107,20 +176,20 @@ class AccessMiddleware(BaseMiddleware):
     Middleware для проверки статуса пользователя перед каждым хендлером.
     Инжектирует user_data, lang и admin-статус.
     """
-    def __init__(self, users_db: dict, static_data: dict):
-        self.users_db = users_db
+    def __init__(self, static_data: dict):
         self.static_data = static_data
         super().__init__()
 
     async def __call__(self, handler, event: Message, data: dict):
-        if not isinstance(event, Message) or not event.from_user:
+        if not isinstance(event, (Message, CallbackQuery)) or not event.from_user:
             return await handler(event, data)
 
         user_id = event.from_user.id
-        from bot.database import db
+        from bot.database import db, SCALAR_FIELDS
         
-        # Получаем свежие данные из БД
-        user_data = await db.get_user(user_id)
+        # Профиль без JSON-колонок (из кэша Database; без кэша — SELECT только этих полей).
+        # Хендлеры, которым нужны другие поля, читают их сами через db.get_user_fields
+        user_data = await db.get_user_fields(user_id, SCALAR_FIELDS)
         if not user_data:
             return await handler(event, data)
 
@@ -132,12 +201,20 @@ class AccessMiddleware(BaseMiddleware):
                 if datetime.now(timezone.utc) < ban_dt:
                     h = int((ban_dt - datetime.now(timezone.utc)).total_seconds() // 3600)
                     lang = get_user_lang(user_data)
-                    await event.answer(t("ban_timeout_msg", lang, h=h, m=0), parse_mode=ParseMode.HTML)
+                    if isinstance(event, CallbackQuery):
+                        await event.answer(t("ban_timeout_msg", lang, h=h, m=0), show_alert=True)
+                    else:
+                        await event.answer(t("ban_timeout_msg", lang, h=h, m=0), parse_mode=ParseMode.HTML)
                     return
                 else:
                     await db.update_user(user_id, active=1)
             except: pass
 
+        # Пишет боту — значит, снова доступен (блокировку ставила отправка с Forbidden)
+        if user_data.get("blocked_at"):
+            active = await db.mark_unblocked(user_id)
+            user_data.update(active=active, blocked_reason=None, blocked_at=None, active_before_block=None)
+
         # 2. DEMO LOGIC (авто-переход в cooldown)
         lang = get_user_lang(user_data)
         if await is_demo_expired(user_data) and not user_data.get("is_paid"):